@@ -1,14 +1,91 @@
 import logging
 import os
-import requests
 from flask import Flask
 
 EXTERNAL_PROXY = os.getenv("EXTERNAL_PROXY")
 ENABLE_STREAMING_SAFETY_CHECK = (
     os.getenv("ENABLE_STREAMING_SAFETY_CHECK", "false").lower() == "true"
 )
+UPSTREAM_POOL_HOSTS = int(os.getenv("UPSTREAM_POOL_HOSTS", 100))
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", 16))
+UPSTREAM_HOST_POOL_SIZES = os.getenv("UPSTREAM_HOST_POOL_SIZES", "")
+UPSTREAM_RETRIES = int(os.getenv("UPSTREAM_RETRIES", 2))
+UPSTREAM_RETRY_BACKOFF = float(os.getenv("UPSTREAM_RETRY_BACKOFF", 0.5))
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 10))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", 30))
+# Created once in CACHE_DIR and shared by all workers unless configured
+STREAM_URL_SECRET = os.getenv("STREAM_URL_SECRET")
+METRICS_SHARE_INTERVAL = int(os.getenv("METRICS_SHARE_INTERVAL", 5))
+DNS_CACHE_TTL = int(os.getenv("DNS_CACHE_TTL", 60))
+DNS_NEGATIVE_CACHE_TTL = int(os.getenv("DNS_NEGATIVE_CACHE_TTL", 10))
+DNS_CACHE_MAX_HOSTS = int(os.getenv("DNS_CACHE_MAX_HOSTS", 10000))
+ENABLE_EPISODE_CACHE = os.getenv("ENABLE_EPISODE_CACHE", "false").lower() == "true"
+EPISODE_CACHE_TTL = int(os.getenv("EPISODE_CACHE_TTL", 7 * 24 * 60 * 60))
+EPISODE_CACHE_MAX_EPISODE_BYTES = int(
+    os.getenv("EPISODE_CACHE_MAX_EPISODE_BYTES", 300000000)
+)
+STREAM_REDIRECT_CACHE_TTL = int(os.getenv("STREAM_REDIRECT_CACHE_TTL", 60 * 60))
+STREAM_REDIRECT_CACHE_MAX_URLS = int(os.getenv("STREAM_REDIRECT_CACHE_MAX_URLS", 10000))
+STREAM_MIN_CHUNK_SIZE = int(os.getenv("STREAM_MIN_CHUNK_SIZE", 64 * 1024))
+STREAM_MAX_CHUNK_SIZE = int(os.getenv("STREAM_MAX_CHUNK_SIZE", 1024 * 1024))
+ASGI_MAX_UPSTREAM_CONNECTIONS = int(os.getenv("ASGI_MAX_UPSTREAM_CONNECTIONS", 1000))
+# Server worker processes per host, which gunicorn and uvicorn also start by default
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", 1))
+# Bytes per second, 0 for no limit
+STREAM_MAX_BANDWIDTH = int(os.getenv("STREAM_MAX_BANDWIDTH", 0))
+STREAM_CLIENT_BANDWIDTH = int(os.getenv("STREAM_CLIENT_BANDWIDTH", 0))
+STREAM_UPSTREAM_BANDWIDTH = int(os.getenv("STREAM_UPSTREAM_BANDWIDTH", 0))
+STREAM_BULK_SHARE = float(os.getenv("STREAM_BULK_SHARE", 0.5))
+CACHE_DIR = os.getenv("CACHE_DIR")
+DISK_CACHE_MAX_BYTES = int(os.getenv("DISK_CACHE_MAX_BYTES", 10 * 1024 * 1024 * 1024))
+DISK_CACHE_EVICTION_POLICY = os.getenv("DISK_CACHE_EVICTION_POLICY", "lru").lower()
+DISK_CACHE_PINNED_PER_CHANNEL = int(os.getenv("DISK_CACHE_PINNED_PER_CHANNEL", 0))
+ENABLE_YOUTUBE_PREFETCH = (
+    os.getenv("ENABLE_YOUTUBE_PREFETCH", "false").lower() == "true"
+)
+YOUTUBE_PREFETCH_COUNT = int(os.getenv("YOUTUBE_PREFETCH_COUNT", 3))
+YOUTUBE_PREFETCH_WORKERS = int(os.getenv("YOUTUBE_PREFETCH_WORKERS", 2))
+YOUTUBE_PREFETCH_PER_CHANNEL = int(os.getenv("YOUTUBE_PREFETCH_PER_CHANNEL", 1))
+YOUTUBE_PREFETCH_MAX_QUEUED = int(os.getenv("YOUTUBE_PREFETCH_MAX_QUEUED", 100))
+YOUTUBE_EXTRACTORS = int(os.getenv("YOUTUBE_EXTRACTORS", 2))
+YOUTUBE_METADATA_TTL = int(os.getenv("YOUTUBE_METADATA_TTL", 60 * 60))
+YOUTUBE_METADATA_MAX_VIDEOS = int(os.getenv("YOUTUBE_METADATA_MAX_VIDEOS", 1000))
+YOUTUBE_FEED_MAX_CACHED_ITEMS = int(os.getenv("YOUTUBE_FEED_MAX_CACHED_ITEMS", 10000))
+FEED_CACHE_MAX_BYTES = int(os.getenv("FEED_CACHE_MAX_BYTES", 64 * 1024 * 1024))
+FEED_CACHE_MAX_FEED_BYTES = int(
+    os.getenv("FEED_CACHE_MAX_FEED_BYTES", 16 * 1024 * 1024)
+)
+FEED_CACHE_TTL = int(os.getenv("FEED_CACHE_TTL", 24 * 60 * 60))
+FEED_CACHE_FRESHNESS = int(os.getenv("FEED_CACHE_FRESHNESS", 5 * 60))
+ENABLE_FEED_REFRESHER = os.getenv("ENABLE_FEED_REFRESHER", "false").lower() == "true"
+FEED_REFRESH_MIN_INTERVAL = int(os.getenv("FEED_REFRESH_MIN_INTERVAL", 5 * 60))
+FEED_REFRESH_MAX_INTERVAL = int(os.getenv("FEED_REFRESH_MAX_INTERVAL", 6 * 60 * 60))
+FEED_REFRESH_IDLE_TIMEOUT = int(os.getenv("FEED_REFRESH_IDLE_TIMEOUT", 24 * 60 * 60))
+FEED_REFRESH_MAX_FEEDS = int(os.getenv("FEED_REFRESH_MAX_FEEDS", 1000))
+FEED_REFRESH_WORKERS = int(os.getenv("FEED_REFRESH_WORKERS", 4))
+OPML_IMPORT_WORKERS = int(os.getenv("OPML_IMPORT_WORKERS", 8))
+SHARED_CACHE_BACKEND = os.getenv("SHARED_CACHE_BACKEND", "memory").lower()
+SHARED_CACHE_DIR = os.getenv("SHARED_CACHE_DIR")
+SHARED_CACHE_URL = os.getenv("SHARED_CACHE_URL", "redis://localhost:6379/0")
+SHARED_CACHE_MAX_FILE_BYTES = int(os.getenv("SHARED_CACHE_MAX_FILE_BYTES", 100 * 1024 * 1024))
+SHARED_CACHE_FILE_TTL = int(os.getenv("SHARED_CACHE_FILE_TTL", 7 * 24 * 60 * 60))
 
-session = requests.Session()
+# Imported once the settings above are defined, as the utils modules read them
+from app.utils.metrics import metrics
+from app.utils.resolver import host_resolver
+from app.utils.upstream import create_session, parse_host_pool_sizes
+
+session = create_session(
+    UPSTREAM_POOL_HOSTS,
+    UPSTREAM_POOL_SIZE,
+    parse_host_pool_sizes(UPSTREAM_HOST_POOL_SIZES),
+    UPSTREAM_RETRIES,
+    UPSTREAM_RETRY_BACKOFF,
+    UPSTREAM_CONNECT_TIMEOUT,
+    UPSTREAM_READ_TIMEOUT,
+    resolver=host_resolver,
+)
+session.hooks["response"].append(metrics.record_upstream_response)
 
 
 def create_app():
@@ -20,6 +97,32 @@ def create_app():
 
     logging.info(f"Using proxy server: {EXTERNAL_PROXY}")
     logging.info(f"Streaming safety check enabled: {ENABLE_STREAMING_SAFETY_CHECK}")
+    logging.info(f"Background feed refresher enabled: {ENABLE_FEED_REFRESHER}")
+    logging.info(f"YouTube prefetch enabled: {ENABLE_YOUTUBE_PREFETCH}")
+    logging.info(f"Episode cache enabled: {ENABLE_EPISODE_CACHE}")
+    logging.info(f"Shared cache backend: {SHARED_CACHE_BACKEND}")
+
+    from app.utils.disk_cache import disk_cache
+
+    cache_dir = CACHE_DIR or os.path.abspath(os.path.join(app.root_path, "..", "cache"))
+    disk_cache.open(cache_dir)
+    metrics.start(os.path.join(cache_dir, "metrics"), METRICS_SHARE_INTERVAL)
+
+    from app.stream.tokens import stream_tokens
+
+    stream_tokens.open(cache_dir)
+
+    from app.utils.shared_cache import create_backend, shared_cache
+
+    shared_cache.open(
+        create_backend(
+            SHARED_CACHE_BACKEND,
+            SHARED_CACHE_DIR or os.path.join(cache_dir, "shared"),
+            SHARED_CACHE_URL,
+            SHARED_CACHE_MAX_FILE_BYTES,
+            cache_dir,
+        )
+    )
 
     from app.main import bp as main_bp
 
@@ -33,4 +136,19 @@ def create_app():
 
     app.register_blueprint(stream_bp, url_prefix="/stream")
 
+    from app.stream.episode_cache import episode_cache
+
+    episode_cache.enabled = ENABLE_EPISODE_CACHE
+
+    if ENABLE_YOUTUBE_PREFETCH:
+        from app.stream.prefetch import youtube_prefetcher
+
+        youtube_prefetcher.start()
+
+    if ENABLE_FEED_REFRESHER:
+        from app.feed.refresher import feed_refresher
+        from app.feed.routes import refresh_feed
+
+        feed_refresher.start(app, refresh_feed)
+
     return app
@@ -0,0 +1,267 @@
+import asyncio
+import logging
+import httpx
+from asgiref.wsgi import WsgiToAsgi
+import app
+from app import create_app
+from app.stream.bandwidth import bandwidth_scheduler, content_range_length, stream_priority
+from app.stream.episode_cache import episode_cache
+from app.stream.mime import MIME_SNIFF_BYTES, stream_mime_verdicts
+from app.stream.redirects import stream_redirects
+from app.stream.routes import (
+    check_stream_mime,
+    check_stream_size,
+    decode_stream_url,
+    is_youtube_url,
+    needs_mime_check,
+    range_start,
+)
+from app.utils import check_hostname, filter_headers
+from app.utils.metrics import metrics
+
+STREAM_PREFIX = "/stream/"
+# Hop-by-hop headers describe the upstream connection, the ASGI server frames the response to the client itself
+HOP_BY_HOP_HEADERS = {
+    "connection",
+    "keep-alive",
+    "proxy-authenticate",
+    "proxy-authorization",
+    "te",
+    "trailer",
+    "transfer-encoding",
+    "upgrade",
+}
+
+
+def create_upstream_client():
+    """Pooled async HTTP client, proxying HTTPS through EXTERNAL_PROXY like the Flask stream route"""
+    limits = httpx.Limits(
+        max_connections=app.ASGI_MAX_UPSTREAM_CONNECTIONS,
+        max_keepalive_connections=app.ASGI_MAX_UPSTREAM_CONNECTIONS,
+    )
+    timeout = httpx.Timeout(app.UPSTREAM_READ_TIMEOUT, connect=app.UPSTREAM_CONNECT_TIMEOUT)
+    return httpx.AsyncClient(
+        mounts={
+            "https://": httpx.AsyncHTTPTransport(
+                proxy=app.EXTERNAL_PROXY, limits=limits, retries=app.UPSTREAM_RETRIES
+            ),
+            "http://": httpx.AsyncHTTPTransport(
+                limits=limits, retries=app.UPSTREAM_RETRIES
+            ),
+        },
+        timeout=timeout,
+        follow_redirects=True,
+    )
+
+
+class StreamingApp:
+    """ASGI application relaying generic /stream requests as coroutines sharing one pooled upstream client
+
+    Feeds, the web UI and YouTube streams (served from the download cache) are delegated to the Flask app.
+    """
+
+    def __init__(self, flask_app, upstream_client_factory=create_upstream_client):
+        self.flask_app = WsgiToAsgi(flask_app)
+        self.upstream_client_factory = upstream_client_factory
+        self.upstream_client = None
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+
+        if scope["type"] == "http" and scope["path"].startswith(STREAM_PREFIX):
+            stream_url = None
+            try:
+                # The async client doesn't pin checked addresses, so signed URLs are still checked in proxy_media
+                stream_url, _ = decode_stream_url(scope["path"][len(STREAM_PREFIX) :])
+            except ValueError:
+                pass  # Let Flask answer malformed URLs
+            # The episode cache reads and writes files synchronously, so cached episodes are served by Flask
+            if stream_url and not is_youtube_url(stream_url) and not episode_cache.enabled:
+                return await self.proxy_media(scope, receive, send, stream_url)
+
+        return await self.flask_app(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                self.upstream_client = self.upstream_client_factory()
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                if self.upstream_client:
+                    await self.upstream_client.aclose()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def proxy_media(self, scope, receive, send, stream_url):
+        """Streams file located at given URL, relaying chunks only as fast as the client accepts them"""
+        request_headers = [
+            (name.decode("latin-1").title(), value.decode("latin-1"))
+            for name, value in scope["headers"]
+        ]
+        user_agent = dict(request_headers).get("User-Agent")
+        logging.info(f"[{user_agent}] Streaming: {stream_url}")
+
+        if self.upstream_client is None:  # Server without lifespan support
+            self.upstream_client = self.upstream_client_factory()
+
+        try:
+            await asyncio.to_thread(check_hostname, stream_url)
+            upstream_response = await self.request_stream(
+                stream_url, filter_headers(request_headers)
+            )
+        except Exception as e:
+            logging.error(f"An unexpected error occurred: {e}")
+            return await send_text(send, 500, "An internal server error occurred")
+
+        client_disconnected = None
+        relay_labels = None
+        scheduled_stream = None
+        try:
+            if upstream_response.is_error:
+                logging.error(
+                    f"An unexpected error occurred: upstream returned {upstream_response.status_code} for {stream_url}"
+                )
+                return await send_text(send, 500, "An internal server error occurred")
+
+            upstream_chunks = upstream_response.aiter_raw()  # Relay bytes as sent, without decoding
+            peeked_chunks = []
+            if app.ENABLE_STREAMING_SAFETY_CHECK and upstream_response.status_code in (200, 206):
+                try:
+                    check_stream_size(upstream_response.headers.get("Content-Length"))
+                    if needs_mime_check(stream_url):
+                        mime_type = stream_mime_verdicts.get(stream_url)
+                        metrics.count_cache("mime", mime_type is not None)
+                        if mime_type is None:
+                            if range_start(
+                                upstream_response.status_code,
+                                upstream_response.headers.get("Content-Range"),
+                            ):
+                                head = await self.fetch_stream_head(stream_url, request_headers)
+                            else:
+                                peeked_chunks = await peek_chunks(upstream_chunks, MIME_SNIFF_BYTES)
+                                head = b"".join(peeked_chunks)
+                            mime_type = stream_mime_verdicts.sniff(stream_url, head)
+                        check_stream_mime(mime_type)
+                except ValueError as e:
+                    logging.error(f"Safety check failed for {stream_url}: {e}")
+                    return await send_text(send, 403, "Invalid stream file")
+
+            client_disconnected = asyncio.create_task(wait_for_disconnect(receive))
+            await send(
+                {
+                    "type": "http.response.start",
+                    "status": upstream_response.status_code,
+                    "headers": [
+                        (name.lower(), value)
+                        for name, value in upstream_response.headers.raw
+                        if name.lower().decode("latin-1") not in HOP_BY_HOP_HEADERS
+                    ],
+                }
+            )
+            relay_labels = (("source", "upstream"),)
+            metrics.add_gauge("active_streams", relay_labels)
+            if bandwidth_scheduler.enabled:
+                scheduled_stream = bandwidth_scheduler.open(
+                    scope["client"][0] if scope.get("client") else None,
+                    upstream_response.url.host,
+                    stream_priority(
+                        dict(request_headers).get("Range"),
+                        content_range_length(upstream_response.headers.get("Content-Range")),
+                    ),
+                )
+            for chunk in peeked_chunks:
+                await throttle(scheduled_stream, chunk)
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                metrics.inc("relayed_bytes_total", relay_labels, len(chunk))
+            async for chunk in upstream_chunks:
+                if client_disconnected.done():
+                    logging.info(f"Client disconnected from {stream_url}")
+                    return
+                await throttle(scheduled_stream, chunk)
+                # Awaiting send applies the server's flow control, so slow clients slow the upstream read
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                metrics.inc("relayed_bytes_total", relay_labels, len(chunk))
+            await send({"type": "http.response.body", "body": b""})
+        except OSError as e:  # Client disconnected mid-send
+            logging.info(f"Stream closed for {stream_url}: {e}")
+        finally:
+            await upstream_response.aclose()
+            if client_disconnected:
+                client_disconnected.cancel()
+            if relay_labels:
+                metrics.add_gauge("active_streams", relay_labels, -1)
+            if scheduled_stream:
+                scheduled_stream.close()
+
+    async def request_upstream(self, url, headers):
+        upstream_request = self.upstream_client.build_request("GET", url, headers=headers)
+        return await self.upstream_client.send(upstream_request, stream=True)
+
+    async def request_stream(self, stream_url, headers):
+        """Request a stream from the end of its cached redirect chain, following the chain again if that URL fails"""
+        final_url = stream_redirects.get(stream_url)
+        metrics.count_cache("redirect", final_url is not None)
+        if final_url:
+            upstream_response = await self.request_upstream(final_url, headers)
+            if not upstream_response.is_error:
+                return upstream_response
+            logging.info(
+                f"Cached redirect for {stream_url} failed ({upstream_response.status_code}), following again"
+            )
+            await upstream_response.aclose()
+            stream_redirects.invalidate(stream_url)
+
+        upstream_response = await self.request_upstream(stream_url, headers)
+        if not upstream_response.is_error and upstream_response.history:
+            stream_redirects.set(stream_url, str(upstream_response.url))
+        return upstream_response
+
+    async def fetch_stream_head(self, stream_url, request_headers):
+        """Fetch the first bytes of a file, to sniff it when the client requested a later range"""
+        headers = filter_headers(request_headers)
+        headers["Range"] = f"bytes=0-{MIME_SNIFF_BYTES - 1}"
+        async with self.upstream_client.stream(
+            "GET", stream_redirects.get(stream_url) or stream_url, headers=headers
+        ) as head_response:
+            head_response.raise_for_status()
+            return b"".join(await peek_chunks(head_response.aiter_raw(), MIME_SNIFF_BYTES))
+
+
+async def peek_chunks(chunks, size):
+    """Read chunks until size bytes are available, to be sent before the rest of the stream"""
+    peeked = []
+    peeked_bytes = 0
+    async for chunk in chunks:
+        peeked.append(chunk)
+        peeked_bytes += len(chunk)
+        if peeked_bytes >= size:
+            break
+    return peeked
+
+
+async def throttle(scheduled_stream, chunk):
+    """Wait until the bandwidth scheduler allows sending a chunk, if the stream is scheduled"""
+    if scheduled_stream and (wait := scheduled_stream.delay(len(chunk))):
+        await asyncio.sleep(wait)
+
+
+async def wait_for_disconnect(receive):
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+
+async def send_text(send, status, text):
+    await send(
+        {
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"text/html; charset=utf-8")],
+        }
+    )
+    await send({"type": "http.response.body", "body": text.encode()})
+
+
+def create_asgi_app():
+    return StreamingApp(create_app())
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from cachetools import TTLCache
+import app
+from app.feed.compression import compress
+from app.utils.metrics import metrics
+from app.utils.shared_cache import shared_cache
+
+FEED_LOCK_TTL = 60  # Seconds before a feed lock held by a worker that died expires
+FEED_LOCK_WAIT = 10  # Seconds a request waits for another worker fetching the same feed before fetching it too
+
+
+class CachedFeed:
+    """A rewritten feed along with the upstream validators it was built from, and its compressed variants"""
+
+    def __init__(self, content, upstream_etag=None, upstream_last_modified=None):
+        self.content = content
+        self.upstream_etag = upstream_etag
+        self.upstream_last_modified = upstream_last_modified
+        self.etag = hashlib.sha1(content).hexdigest()
+        self.last_modified = datetime.now(timezone.utc).replace(microsecond=0)
+        self.validated_at = time.time()  # Wall clock, as feeds are compared with copies from other workers
+        self._encoded = {}  # Content encoding -> compressed content
+        self._encode_lock = threading.Lock()
+
+    def size(self):
+        return len(self.content) + sum(map(len, self._encoded.values()))
+
+    def encoded(self, encoding):
+        """The feed compressed with a content encoding, and whether it was compressed by this call
+
+        Each variant is compressed once and kept with the feed, so it is replaced along with the feed.
+        """
+        with self._encode_lock:
+            if encoding in self._encoded:
+                return self._encoded[encoding], False
+            with metrics.time("feed_compress"):
+                self._encoded[encoding] = compress(self.content, encoding)
+            return self._encoded[encoding], True
+
+    def is_fresh(self, max_age):
+        """Whether the feed was checked against upstream within the last max_age seconds"""
+        return time.time() - self.validated_at < max_age
+
+    def mark_validated(self):
+        self.validated_at = time.time()
+
+    def conditional_headers(self):
+        """Headers to revalidate this feed with a conditional GET to upstream"""
+        headers = {}
+        if self.upstream_etag:
+            headers["If-None-Match"] = self.upstream_etag
+        if self.upstream_last_modified:
+            headers["If-Modified-Since"] = self.upstream_last_modified
+        return headers
+
+    def dumps(self):
+        """Serialize the feed for the shared cache, without its compressed variants"""
+        header = {
+            "upstream_etag": self.upstream_etag,
+            "upstream_last_modified": self.upstream_last_modified,
+            "last_modified": self.last_modified.isoformat(),
+            "validated_at": self.validated_at,
+        }
+        return json.dumps(header).encode() + b"\n" + self.content
+
+    @classmethod
+    def loads(cls, data):
+        header, _, content = data.partition(b"\n")
+        header = json.loads(header)
+        feed = cls(content, header["upstream_etag"], header["upstream_last_modified"])
+        feed.last_modified = datetime.fromisoformat(header["last_modified"])
+        feed.validated_at = header["validated_at"]
+        return feed
+
+
+def shared_key(key):
+    return f"feed:{key!r}"
+
+
+class FeedCache:
+    """Thread-safe cache of rewritten feeds, bounded by total size and entry age
+
+    With a shared cache backend, feeds are also written to it, and read from it when this worker's copy is missing or
+    older than the freshness interval, so a feed fetched by any worker is reused by all of them.
+    """
+
+    def __init__(self, max_bytes, ttl, freshness):
+        self.ttl = ttl
+        self.freshness = freshness
+        self._lock = threading.Lock()
+        self._feeds = TTLCache(maxsize=max_bytes, ttl=ttl, getsizeof=lambda feed: feed.size())
+
+    def get(self, key):
+        with self._lock:
+            feed = self._feeds.get(key)
+        if shared_cache.shared and (feed is None or not feed.is_fresh(self.freshness)):
+            data = shared_cache.get(shared_key(key))
+            shared_feed = CachedFeed.loads(data) if data is not None else None
+            if shared_feed is not None and (feed is None or shared_feed.validated_at > feed.validated_at):
+                feed = shared_feed
+                self._store(key, feed)
+        return feed
+
+    def set(self, key, feed):
+        self._store(key, feed)
+        if shared_cache.shared:
+            shared_cache.set(shared_key(key), feed.dumps(), self.ttl)
+
+    def lock(self, key):
+        """Lock for fetching a feed, so it is fetched by one worker at a time"""
+        return shared_cache.lock(shared_key(key), FEED_LOCK_TTL)
+
+    def _store(self, key, feed):
+        with self._lock:
+            try:
+                self._feeds[key] = feed
+            except ValueError:  # Single feed is larger than the whole cache
+                self._feeds.pop(key, None)
+
+    def encoded(self, key, feed, encoding):
+        """A feed compressed with a content encoding, counting a newly compressed variant towards the cache size"""
+        content, compressed = feed.encoded(encoding)
+        if compressed:
+            with self._lock:
+                if self._feeds.get(key) is feed:  # Re-stored to update its size, unless replaced by a newer version
+                    try:
+                        self._feeds[key] = feed
+                    except ValueError:
+                        self._feeds.pop(key, None)
+        return content
+
+    def clear(self):
+        with self._lock:
+            self._feeds.clear()
+
+
+feed_cache = FeedCache(app.FEED_CACHE_MAX_BYTES, app.FEED_CACHE_TTL, app.FEED_CACHE_FRESHNESS)
@@ -0,0 +1,60 @@
+import zlib
+
+try:
+    import brotli
+except ImportError:  # Installed with the compression extra
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5  # Qualities above 9 are many times slower for feeds no smaller
+ZSTD_LEVEL = 9
+
+# Preferred first when the client accepts several equally
+ENCODINGS = tuple(
+    encoding
+    for encoding, available in (("br", brotli), ("zstd", zstandard), ("gzip", zlib))
+    if available
+)
+
+
+class BrotliCompressor:
+    def __init__(self):
+        self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+def compressor(encoding):
+    if encoding == "br":
+        return BrotliCompressor()
+    if encoding == "zstd":
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compressobj()
+    return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)  # 31: gzip header and trailer
+
+
+def negotiate_encoding(accept_encodings):
+    """Best content encoding the client accepts, or None to send the feed uncompressed"""
+    return accept_encodings.best_match(ENCODINGS)
+
+
+def compress(content, encoding):
+    content_compressor = compressor(encoding)
+    return content_compressor.compress(content) + content_compressor.flush()
+
+
+def iter_compressed(chunks, encoding):
+    """Compress a stream of chunks, yielding compressed data as it becomes available"""
+    content_compressor = compressor(encoding)
+    for chunk in chunks:
+        if compressed := content_compressor.compress(chunk):
+            yield compressed
+    yield content_compressor.flush()
@@ -0,0 +1,97 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+from lxml import etree
+from app import FEED_CACHE_FRESHNESS
+from app.feed.cache import feed_cache
+from app.feed.refresher import feed_refresher
+from app.feed.routes import refresh_feed, resolve_feed_path
+
+MAX_OPML_BYTES = 1024 * 1024
+MAX_OPML_FEEDS = 1000
+YOUTUBE_HOSTS = ("www.youtube.com", "youtube.com")
+
+
+def proxied_feed_path(xml_url, host):
+    """Path under /feed/ that proxies a feed URL, or None if it is already proxied through this host
+
+    Raises ValueError if the URL can't be proxied.
+    """
+    parsed = urlparse(xml_url.strip())
+    if parsed.scheme not in ("http", "https") or not parsed.hostname:
+        raise ValueError("Not an HTTP feed URL")
+    if parsed.netloc == host and parsed.path.startswith("/feed/"):
+        return None
+    if parsed.hostname in YOUTUBE_HOSTS and parsed.path == "/feeds/videos.xml":
+        channel_id = parse_qs(parsed.query).get("channel_id")
+        if channel_id:
+            return f"youtube/{channel_id[0]}"
+    if parsed.query:
+        raise ValueError("Feed URLs with query strings can't be proxied")
+    return f"{parsed.netloc}{parsed.path}"
+
+
+def warm_feed(flask_app, host, feed_path):
+    """Fetch and rewrite a feed into the cache as if it was requested through the host, raising ValueError if it
+    can't be"""
+    original_feed_url, proxy_feed_url, youtube = resolve_feed_path(feed_path, host)
+    cache_key = (host, original_feed_url)
+    cached_feed = feed_cache.get(cache_key)
+    if cached_feed is None or not cached_feed.is_fresh(FEED_CACHE_FRESHNESS):
+        with flask_app.test_request_context(base_url=f"https://{host}"):
+            refresh_feed(cache_key, original_feed_url, proxy_feed_url, youtube)
+        if feed_cache.get(cache_key) is None:
+            raise ValueError("Feed couldn't be fetched")
+
+    if feed_refresher.enabled:
+        feed_refresher.track(cache_key, original_feed_url, proxy_feed_url, youtube)
+
+
+def rewrite_opml(opml_content, host, flask_app, workers):
+    """Point the feeds of an OPML subscription list at the proxy, fetching them concurrently to warm the cache
+
+    Outlines whose feeds can't be proxied keep their original URL and are given a proxyError attribute. Returns the
+    rewritten OPML and the numbers of feeds proxied and failed. Raises ValueError if the OPML is invalid.
+    """
+    parser = etree.XMLParser(resolve_entities=False, no_network=True)
+    try:
+        root = etree.fromstring(opml_content, parser)
+    except etree.XMLSyntaxError as e:
+        raise ValueError(f"Invalid XML: {e}")
+    if root.tag != "opml":
+        raise ValueError("Not an OPML document")
+
+    outlines = [outline for outline in root.iter("outline") if outline.get("xmlUrl")]
+    if len(outlines) > MAX_OPML_FEEDS:
+        raise ValueError(f"More than {MAX_OPML_FEEDS} feeds")
+
+    feed_paths, errors = {}, {}
+    for outline in outlines:
+        try:
+            feed_paths[outline] = proxied_feed_path(outline.get("xmlUrl"), host)
+        except ValueError as e:
+            errors[outline] = str(e)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        warming = {
+            feed_path: executor.submit(warm_feed, flask_app, host, feed_path)
+            for feed_path in set(feed_paths.values())
+            if feed_path is not None
+        }
+
+    for outline, feed_path in feed_paths.items():
+        if feed_path is None:
+            continue
+        try:
+            warming[feed_path].result()
+        except Exception as e:
+            logging.error(f"Error importing feed {outline.get('xmlUrl')}: {e}")
+            errors[outline] = str(e)
+            continue
+        outline.set("xmlUrl", f"https://{host}/feed/{feed_path}")
+
+    for outline, error in errors.items():
+        outline.set("proxyError", error)
+
+    rewritten = etree.tostring(root, xml_declaration=True, encoding="UTF-8")
+    return rewritten, len(outlines) - len(errors), len(errors)
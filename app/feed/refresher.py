@@ -0,0 +1,111 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+import app
+
+
+class TrackedFeed:
+    """A feed requested by clients, refreshed on an interval adapted to how often it changes upstream"""
+
+    def __init__(self, cache_key, original_feed_url, proxy_feed_url, youtube, item_window=None):
+        self.cache_key = cache_key
+        self.original_feed_url = original_feed_url
+        self.proxy_feed_url = proxy_feed_url
+        self.youtube = youtube
+        self.item_window = item_window
+        self.interval = app.FEED_REFRESH_MIN_INTERVAL
+        self.next_refresh = time.monotonic() + self.interval
+
+    def reschedule(self, changed):
+        """Refresh sooner if the feed changed since the last refresh, otherwise back off"""
+        if changed:
+            self.interval = max(app.FEED_REFRESH_MIN_INTERVAL, self.interval // 2)
+        else:
+            self.interval = min(app.FEED_REFRESH_MAX_INTERVAL, self.interval * 2)
+        self.next_refresh = time.monotonic() + self.interval
+
+
+class FeedRefresher:
+    """Keeps feeds that clients poll warm in the feed cache by refreshing them in the background"""
+
+    def __init__(self, max_feeds, idle_timeout, workers):
+        self.enabled = False
+        self._lock = threading.Lock()
+        # Feeds no longer polled by any client drop out after the idle timeout
+        self._tracked_feeds = TTLCache(maxsize=max_feeds, ttl=idle_timeout)
+        self._untracked_feeds = TTLCache(maxsize=max_feeds, ttl=idle_timeout)  # Too large to keep warm
+        self._workers = workers
+        self._stopped = threading.Event()
+
+    def track(self, cache_key, original_feed_url, proxy_feed_url, youtube, item_window=None):
+        """Record a client request for a feed so it is kept warm"""
+        with self._lock:
+            if cache_key in self._untracked_feeds:
+                return
+            tracked_feed = self._tracked_feeds.get(cache_key) or TrackedFeed(
+                cache_key, original_feed_url, proxy_feed_url, youtube, item_window
+            )
+            self._tracked_feeds[cache_key] = tracked_feed  # Resets idle timeout
+
+    def untrack(self, cache_key):
+        """Stop keeping a feed warm, such as one too large to cache, until the idle timeout after this call"""
+        with self._lock:
+            self._tracked_feeds.pop(cache_key, None)
+            self._untracked_feeds[cache_key] = True
+
+    def due_feeds(self):
+        """Tracked feeds whose refresh interval has elapsed, claimed so they are not refreshed twice"""
+        now = time.monotonic()
+        with self._lock:
+            due = [feed for feed in self._tracked_feeds.values() if feed.next_refresh <= now]
+            for feed in due:
+                feed.next_refresh = float("inf")
+        return due
+
+    def start(self, flask_app, refresh_feed):
+        """Start refreshing tracked feeds in a daemon thread using
+        refresh_feed(cache_key, original_feed_url, proxy_feed_url, youtube, item_window)"""
+        self.enabled = True
+        self._stopped.clear()
+        threading.Thread(
+            target=self._run, args=(flask_app, refresh_feed), daemon=True
+        ).start()
+
+    def stop(self):
+        self.enabled = False
+        self._stopped.set()
+
+    def _run(self, flask_app, refresh_feed):
+        with ThreadPoolExecutor(max_workers=self._workers) as executor:
+            while not self._stopped.is_set():
+                for feed in self.due_feeds():
+                    executor.submit(self._refresh, flask_app, refresh_feed, feed)
+                self._stopped.wait(timeout=1)
+
+    def _refresh(self, flask_app, refresh_feed, feed):
+        host = feed.cache_key[0]
+        changed = False
+        try:
+            # Rewritten URLs are built with url_for, so refresh as if requested through the same host
+            with flask_app.test_request_context(base_url=f"https://{host}"):
+                changed = refresh_feed(
+                    feed.cache_key,
+                    feed.original_feed_url,
+                    feed.proxy_feed_url,
+                    feed.youtube,
+                    feed.item_window,
+                )
+        except Exception as e:
+            logging.error(f"Error refreshing feed {feed.original_feed_url}: {e}")
+
+        feed.reschedule(changed)
+        logging.info(
+            f"Refreshed feed {feed.original_feed_url} (changed: {changed}), next refresh in {feed.interval}s"
+        )
+
+
+feed_refresher = FeedRefresher(
+    app.FEED_REFRESH_MAX_FEEDS, app.FEED_REFRESH_IDLE_TIMEOUT, app.FEED_REFRESH_WORKERS
+)
@@ -1,102 +1,290 @@
+import copy
 import hashlib
+import os
 import requests
-import base64
 import logging
+import threading
+import time
 from datetime import datetime
+from itertools import chain
+from xml.sax.saxutils import escape
 from app.utils import check_hostname, check_file_mime
-from flask import Response, url_for, current_app as app, request
+from flask import Response, url_for, current_app as app, request, stream_with_context
+from cachetools import LRUCache
 from lxml import etree
 
+from app import FEED_CACHE_FRESHNESS, FEED_CACHE_MAX_FEED_BYTES, YOUTUBE_FEED_MAX_CACHED_ITEMS, session
 from app.feed import bp
+from app.feed.cache import FEED_LOCK_WAIT, CachedFeed, feed_cache
+from app.feed.compression import iter_compressed, negotiate_encoding
+from app.feed.refresher import feed_refresher
+from app.feed.window import ItemWindow, parse_date
+from app.stream.extractor import youtube_extractor
+from app.stream.prefetch import youtube_prefetcher
+from app.stream.tokens import stream_tokens
+from app.utils.disk_cache import disk_cache
+from app.utils.metrics import metrics
+from app.utils.shared_cache import shared_cache
 
 XML_NAMESPACES = {
     "itunes": "http://www.itunes.com/dtds/podcast-1.0.dtd",
     "media": "http://search.yahoo.com/mrss/",
     "atom": "http://www.w3.org/2005/Atom",
+    "yt": "http://www.youtube.com/xml/schemas/2015",
 }
+XML_DECLARATION = (
+    b'<?xml version="1.0" encoding="UTF-8"?>\n'  # Apple podcasts requires the XML declaration
+)
+FEED_CHUNK_SIZE = 64 * 1024
+
+# Parsed once and copied for each YouTube feed
+FEED_SKELETON = etree.parse(
+    os.path.join(os.path.dirname(__file__), "feed_skeleton.xml"),
+    parser=etree.XMLParser(remove_blank_text=True),
+)
+find_entries = etree.XPath("atom:entry", namespaces=XML_NAMESPACES)
+entry_video_id = etree.XPath("string(yt:videoId)", namespaces=XML_NAMESPACES)
+entry_updated = etree.XPath("string(atom:updated)", namespaces=XML_NAMESPACES)
+entry_published = etree.XPath("string(atom:published)", namespaces=XML_NAMESPACES)
+entry_title = etree.XPath("string(atom:title)", namespaces=XML_NAMESPACES)
+entry_link = etree.XPath("string(atom:link[@rel='alternate']/@href)", namespaces=XML_NAMESPACES)
+entry_description = etree.XPath("string(media:group/media:description)", namespaces=XML_NAMESPACES)
+entry_thumbnail = etree.XPath("string(media:group/media:thumbnail/@url)", namespaces=XML_NAMESPACES)
+
+# Converted <item>s by host, video and entry version, as signing their stream URLs dominates converting them
+youtube_items = LRUCache(maxsize=YOUTUBE_FEED_MAX_CACHED_ITEMS)
+youtube_items_lock = threading.Lock()
 
 
 def create_proxied_stream_url(original_url):
-    """Create encoded URL to stream file at a given URL through the proxy server"""
-    encoded_url = base64.urlsafe_b64encode(
-        original_url.encode()
-    ).decode()  # Encode string to file_bytes, b64 encode, then decode b64 file_bytes to string
+    """Create compact signed URL to stream file at a given URL through the proxy server"""
     return url_for(
-        "stream.proxy_media", encoded_url=encoded_url, _external=True, _scheme="https"
+        "stream.proxy_media",
+        encoded_url=stream_tokens.encode(original_url),
+        _external=True,
+        _scheme="https",
     )
 
 
-def fetch_rss_feed(feed_url):
-    """Get RSS feed XML"""
+def fetch_rss_feed(feed_url, cached_feed=None):
+    """Get RSS feed response and an iterator over its XML, revalidating with a conditional GET if a cached copy exists"""
+    response = None
     try:
         check_hostname(feed_url)
-        response = requests.get(feed_url)
-        response.raise_for_status()
+        headers = cached_feed.conditional_headers() if cached_feed else {}
+        with metrics.time("feed_fetch"):
+            response = session.get(feed_url, headers=headers, stream=True)
+            response.raise_for_status()
+
+            if response.status_code == 304:
+                return response, iter(())
+
+            feed_chunks = response.iter_content(chunk_size=FEED_CHUNK_SIZE)
+            first_chunk = next(feed_chunks, b"")
 
         rss_mime_types = {"application/xml", "application/rss+xml", "text/xml"}
-        check_file_mime(response.content, rss_mime_types)
+        check_file_mime(first_chunk, rss_mime_types)
 
-        return response.text
+        return response, chain([first_chunk], feed_chunks)
     except requests.RequestException as e:
         logging.error(f"Error fetching feed: {e}")
-        return None
     except ValueError as e:
         logging.error(f"Requested feed was unsafe: {e}")
-        return None
-
-
-def rewrite_rss_enclosure_urls(feed_content, proxy_feed_url):
-    """Rewrite media enclosure URLs and self-referencing elements to proxy through server's address"""
-    try:
-        root = etree.fromstring(
-            feed_content.encode(), parser=etree.XMLParser(strip_cdata=False)
-        )
-
-        channel = root.find("channel")
-
+    if response is not None:
+        response.close()  # Release the streamed connection back to the pool
+    return None, None
+
+
+def serialize_element(element, inherited_nsmap):
+    """Serialize an element and its tail without redeclaring namespaces inherited from its ancestors"""
+    serialized = etree.tostring(element, encoding="UTF-8")
+    start_tag_end = serialized.index(b">")
+    start_tag = serialized[:start_tag_end]
+    for prefix, uri in inherited_nsmap.items():
+        name = f"xmlns:{prefix}" if prefix else "xmlns"
+        declaration = f' {name}="{escape(uri, {chr(34): "&quot;"})}"'
+        start_tag = start_tag.replace(declaration.encode(), b"", 1)
+    return start_tag + serialized[start_tag_end:]
+
+
+def serialize_container_tags(element, inherited_nsmap):
+    """Serialize the start and end tags of an element whose children are streamed separately"""
+    shell = etree.Element(element.tag, attrib=dict(element.attrib), nsmap=element.nsmap)
+    shell.text = ""  # Force separate start and end tags
+    serialized = serialize_element(shell, inherited_nsmap)
+    end_tag_start = serialized.rindex(b"</")
+    return serialized[:end_tag_start], serialized[end_tag_start:]
+
+
+def rewrite_channel_element(element, proxy_feed_url):
+    """Rewrite a direct child of <channel> to proxy through server's address, returning False if it should be dropped"""
+    if element.tag == f"{{{XML_NAMESPACES['atom']}}}link":
         # Rewrite <atom:link rel="self"> to point to proxy
-        atom_self = channel.find('atom:link[@rel="self"]', namespaces=XML_NAMESPACES)
-        if atom_self is not None:
-            atom_self.set("href", proxy_feed_url)
-
+        if element.get("rel") == "self":
+            element.set("href", proxy_feed_url)
+    elif element.tag == f"{{{XML_NAMESPACES['itunes']}}}new-feed-url":
         # Remove <itunes:new-feed-url> to prevent clients from migrating away
-        new_feed_url = channel.find("itunes:new-feed-url", namespaces=XML_NAMESPACES)
-        if new_feed_url is not None:
-            channel.remove(new_feed_url)
-
+        return False
+    elif element.tag == "link":
         # Rewrite feed-level <link> to proxy URL
-        link = channel.find("link")
-        if link is not None:
-            link.text = proxy_feed_url
+        element.text = proxy_feed_url
+    elif element.tag == "item":  # items = episodes
+        enclosure = element.find("enclosure")
+        if enclosure is not None and enclosure.get("url"):
+            enclosure.set("url", create_proxied_stream_url(enclosure.get("url")))
+    return True
+
+
+def iter_rewritten_rss(feed_chunks, proxy_feed_url, item_window=None):
+    """Incrementally rewrite chunks of RSS XML, yielding rewritten XML as elements are completed
+
+    Only <rss> and <channel> are held open while parsing. Their children are rewritten, serialized and discarded as
+    soon as they are complete, so memory use is bounded by the largest <item> rather than the size of the feed.
+    With an item window, items outside it are dropped and parsing stops once the window has ended.
+    """
+    parser = etree.XMLPullParser(
+        events=("start", "end", "comment", "pi"), strip_cdata=False
+    )
+    containers = []  # (element, serialized end tag) for open <rss> and <channel>
+    output = []
+    output_size = 0
+    item_selector = item_window.selector() if item_window else None
+    window_ended = False
+
+    def write(data):
+        nonlocal output_size
+        output.append(data)
+        output_size += len(data)
+
+    def write_pending_text(element):
+        if element.text:  # Text between the start tag and first child
+            write(escape(element.text).encode())
+            element.text = None
+
+    def select_item(element):
+        nonlocal window_ended
+        keep, window_ended = item_selector.select(parse_date(element.findtext("pubDate")))
+        return keep
+
+    def process_events():
+        for event, element in parser.read_events():
+            parent = element.getparent()
+            if event == "start":
+                if parent is None:
+                    if element.tag != "rss":
+                        raise ValueError(f"Feed root element is not <rss>: {element.tag}")
+                elif not (
+                    len(containers) == 1
+                    and parent is containers[0][0]
+                    and element.tag == "channel"
+                ):
+                    continue
+
+                inherited_nsmap = {}
+                if parent is not None:
+                    write_pending_text(parent)
+                    inherited_nsmap = parent.nsmap
+                start_tag, end_tag = serialize_container_tags(element, inherited_nsmap)
+                write(start_tag)
+                containers.append((element, end_tag))
+            elif containers and element is containers[-1][0]:
+                write_pending_text(element)
+                for child in element:  # Only closed <channel> remains, its tail may arrive after its end event
+                    if child.tail:
+                        write(escape(child.tail).encode())
+                write(containers.pop()[1])
+            elif containers and parent is containers[-1][0]:
+                write_pending_text(parent)
+                if (
+                    not isinstance(element.tag, str)  # Comments and processing instructions
+                    or parent.tag != "channel"
+                    or (
+                        (item_selector is None or element.tag != "item" or select_item(element))
+                        and rewrite_channel_element(element, proxy_feed_url)
+                    )
+                ):
+                    write(serialize_element(element, parent.nsmap))
+                parent.remove(element)
+                if window_ended:
+                    return
+
+    rewrite_seconds = 0  # Excludes waiting for upstream and the client
+    for chunk in feed_chunks:
+        start = time.perf_counter()
+        parser.feed(chunk)
+        process_events()
+        rewrite_seconds += time.perf_counter() - start
+        if window_ended:
+            break
+        if output_size >= FEED_CHUNK_SIZE:
+            yield b"".join(output)
+            output.clear()
+            output_size = 0
+
+    start = time.perf_counter()
+    if not window_ended:
+        parser.close()
+        process_events()
+    if window_ended:  # The rest of the feed is skipped, including any elements after the items
+        for _, end_tag in reversed(containers):
+            write(end_tag)
+    metrics.observe(
+        "stage_seconds",
+        (("stage", "feed_rewrite"),),
+        rewrite_seconds + time.perf_counter() - start,
+    )
+    yield b"".join(output)
+
+
+def rewrite_rss_enclosure_urls(feed_content, proxy_feed_url, item_window=None):
+    """Rewrite media enclosure URLs and self-referencing elements to proxy through server's address"""
+    if isinstance(feed_content, str):
+        feed_content = feed_content.encode()
+    # libxml2 rejects feeding more than 10MB at once
+    feed_chunks = (
+        feed_content[start : start + FEED_CHUNK_SIZE]
+        for start in range(0, len(feed_content), FEED_CHUNK_SIZE)
+    )
+    return rewrite_rss_chunks(feed_chunks, proxy_feed_url, item_window)
 
-        for item in root.findall("channel/item"):  # items = episodes
-            enclosure = item.find("enclosure")
-            proxied_url = create_proxied_stream_url(enclosure.get("url"))
-            enclosure.set("url", proxied_url)
 
-        return etree.tostring(root)
+def rewrite_rss_chunks(feed_chunks, proxy_feed_url, item_window=None):
+    """Rewrite a feed given as chunks, returning None if it could not be rewritten"""
+    try:
+        return b"".join(iter_rewritten_rss(feed_chunks, proxy_feed_url, item_window))
     except Exception as e:
         logging.error(f"Error rewriting feed: {e}")
         return None
 
 
-def rewrite_youtube_feed(feed_content):
+def rewrite_youtube_feed(feed_content, item_window=None):
     """Create an RSS feed from a YouTube channel XML feed"""
     try:
+        if isinstance(feed_content, str):
+            feed_content = feed_content.encode()
         youtube_channel_feed = etree.fromstring(
-            feed_content.encode(),
+            feed_content,
             parser=etree.XMLParser(strip_cdata=False, remove_blank_text=True),
         )
 
-        podcast_feed = etree.parse("./app/feed/feed_skeleton.xml")
+        podcast_feed = copy.deepcopy(FEED_SKELETON)
         channel = podcast_feed.find(
             "channel"
         )  # will contain all episode objects in final RSS feed
 
-        for entry in youtube_channel_feed.findall(
-            "atom:entry", namespaces=XML_NAMESPACES
-        ):
-            channel.append(convert_yt_entry_to_rss_item(entry))
+        entries = find_entries(youtube_channel_feed)
+        if item_window:
+            entries = select_entries(entries, item_window)
+        videos = []
+        for entry in entries:
+            video_id, link = entry_video_id(entry), entry_link(entry)
+            channel.append(cached_rss_item(entry, video_id))
+            videos.append((video_id, link))
+
+        # Entries are newest first, keep the newest episodes' audio cached and download it before it is played
+        channel_id = youtube_channel_feed.findtext("yt:channelId", namespaces=XML_NAMESPACES)
+        disk_cache.pin(channel_id, [f"{video_id}.m4a" for video_id, _ in videos])
+        youtube_prefetcher.enqueue(channel_id, videos)
 
         latest_thumbnail = channel.find(
             "item/itunes:image", namespaces=XML_NAMESPACES
@@ -107,12 +295,26 @@ def rewrite_youtube_feed(feed_content):
             youtube_channel_feed, channel, image_url=latest_thumbnail
         )
 
-        return etree.tostring(podcast_feed, pretty_print=True)
+        return etree.tostring(podcast_feed)
     except Exception as e:
         logging.error(f"Error rewriting YouTube channel feed: {e}")
         return None
 
 
+def select_entries(entries, item_window):
+    """YouTube feed entries within an item window"""
+    item_selector = item_window.selector()
+    selected = []
+    for entry in entries:
+        published = parse_date(entry_published(entry), rfc822=False)
+        keep, window_ended = item_selector.select(published)
+        if keep:
+            selected.append(entry)
+        if window_ended:
+            break
+    return selected
+
+
 def convert_yt_channel_to_podcast_channel(youtube_feed, channel, image_url):
     """Convert YouTube XML channel metadata into RSS podcast metadata"""
     link = youtube_feed.find(
@@ -132,83 +334,302 @@ def convert_yt_channel_to_podcast_channel(youtube_feed, channel, image_url):
     return channel
 
 
-def convert_yt_entry_to_rss_item(entry):
-    """Convert a YouTube XML feed <entry> into an RSS <item>"""
-    item = etree.Element("item")  # new item to populate
-
-    title = entry.findtext("atom:title", namespaces=XML_NAMESPACES)
-    link = entry.find("atom:link[@rel='alternate']", namespaces=XML_NAMESPACES).get(
-        "href"
-    )
-    description = entry.findtext(
-        "media:group/media:description", namespaces=XML_NAMESPACES
+def cached_rss_item(entry, video_id):
+    """RSS <item> for a YouTube feed <entry>, converted again only if the entry or the video's metadata changed"""
+    video = youtube_extractor.cached(video_id)
+    key = (
+        request.host,
+        video_id,
+        entry_updated(entry),
+        video.duration if video is not None else None,
+        video.filesize if video is not None else None,
     )
+    with youtube_items_lock:
+        item = youtube_items.get(key)
+    metrics.count_cache("youtube_item", item is not None)
+    if item is None:
+        item = convert_yt_entry_to_rss_item(entry, video_id, video)
+        with youtube_items_lock:
+            youtube_items[key] = item
+    return copy.deepcopy(item)
 
-    pub_date = entry.findtext("atom:published", namespaces=XML_NAMESPACES)
-    pub_date = datetime.fromisoformat(pub_date).strftime("%a, %d %b %Y %H:%M:%S +0000")
 
-    def create_etree_element(element_name, element_text):
-        element = etree.Element(element_name)
-        element.text = element_text
-        return element
+def convert_yt_entry_to_rss_item(entry, video_id, video):
+    """Convert a YouTube XML feed <entry> into an RSS <item>"""
+    item = etree.Element("item")  # new item to populate
+
+    link = entry_link(entry)
+    pub_date = datetime.fromisoformat(entry_published(entry)).strftime("%a, %d %b %Y %H:%M:%S +0000")
 
     for name, text in [
-        ("title", title),
-        ("description", description),
+        ("title", entry_title(entry)),
+        ("description", entry_description(entry)),
         ("pubDate", pub_date),
         ("link", link),
     ]:
-        item.append(create_etree_element(name, text))
+        etree.SubElement(item, name).text = text
 
-    image_url = entry.find(
-        "media:group/media:thumbnail", namespaces=XML_NAMESPACES
-    ).get("url")
-    item.append(etree.Element(f"{{{XML_NAMESPACES['itunes']}}}image", href=image_url))
+    etree.SubElement(item, f"{{{XML_NAMESPACES['itunes']}}}image", href=entry_thumbnail(entry))
 
-    guid = etree.Element("guid", isPermaLink="false")
-    video_id = entry.findtext(
-        "yt:videoId", namespaces={"yt": "http://www.youtube.com/xml/schemas/2015"}
-    )
+    guid = etree.SubElement(item, "guid", isPermaLink="false")
     guid.text = hashlib.sha256(video_id.encode("utf-8")).hexdigest()[:32]
-    item.append(guid)
 
-    proxied_url = create_proxied_stream_url(link)
-    item.append(
-        etree.Element("enclosure", length="0", type="audio/mp4", url=proxied_url)
+    # Sizes are only known for videos already extracted, such as ones streamed or prefetched before
+    if video is not None and video.duration:
+        etree.SubElement(item, f"{{{XML_NAMESPACES['itunes']}}}duration").text = str(int(video.duration))
+
+    length = str(video.filesize) if video is not None and video.filesize else "0"
+    etree.SubElement(
+        item, "enclosure", length=length, type="audio/mp4", url=create_proxied_stream_url(link)
     )
 
     return item
 
 
-@bp.route("/<path:feed_path>")
-def proxy_feed(feed_path):
-    """Create a proxied RSS feed for a podcast or YouTube channel"""
+def feed_response(cached_feed, cache_key):
+    """Serve a cached feed, compressed if the client accepts it, answering revalidation with 304 Not Modified"""
+    encoding = negotiate_encoding(request.accept_encodings)
+    if encoding:
+        response = Response(
+            feed_cache.encoded(cache_key, cached_feed, encoding), mimetype="application/rss+xml"
+        )
+        response.content_encoding = encoding
+        response.set_etag(f"{cached_feed.etag}-{encoding}")  # Each encoding is a different representation
+    else:
+        response = Response(cached_feed.content, mimetype="application/rss+xml")
+        response.set_etag(cached_feed.etag)
+    response.vary.add("Accept-Encoding")
+    response.last_modified = cached_feed.last_modified
+    return response.make_conditional(request)
+
+
+def build_cached_feed(upstream_response, feed_chunks, cache_key, proxy_feed_url, youtube, item_window=None):
+    """Rewrite a complete upstream feed for the cache, returning None if it could not be rewritten or is too large
+    to cache"""
+    if youtube:  # Channel feeds only list the newest 15 videos
+        feed_content = b"".join(feed_chunks)
+        with metrics.time("feed_rewrite"):
+            rewritten_feed = rewrite_youtube_feed(feed_content, item_window)
+    else:  # Stops downloading once an item window has ended
+        try:
+            rewritten_chunks, complete = read_cacheable_chunks(
+                iter_rewritten_rss(feed_chunks, proxy_feed_url, item_window)
+            )
+        except Exception as e:
+            logging.error(f"Error rewriting feed: {e}")
+            return None
+        finally:
+            upstream_response.close()
+        if not complete:
+            untrack_large_feed(cache_key)
+            return None
+        rewritten_feed = b"".join(rewritten_chunks)
+
+    if not rewritten_feed:
+        return None
+
+    return cached_feed_from_chunks([XML_DECLARATION, rewritten_feed], upstream_response)
+
+
+def read_cacheable_chunks(rewritten_chunks):
+    """Read rewritten feed chunks until they end or outgrow the cache, returning the chunks read and whether the
+    feed ended"""
+    read_chunks, read_size = [], 0
+    for chunk in rewritten_chunks:
+        read_chunks.append(chunk)
+        read_size += len(chunk)
+        if read_size > FEED_CACHE_MAX_FEED_BYTES:
+            return read_chunks, False
+    return read_chunks, True
+
+
+def untrack_large_feed(cache_key):
+    """Stop refreshing a feed too large to cache in the background, as it would be held in memory for nothing"""
+    logging.info(f"Feed {cache_key[1]} is larger than {FEED_CACHE_MAX_FEED_BYTES} bytes, not caching it")
+    feed_refresher.untrack(cache_key)
+
+
+def refresh_feed(cache_key, original_feed_url, proxy_feed_url, youtube, item_window=None):
+    """Revalidate and rewrite a feed into the cache outside of a client request, returning whether it changed"""
+    feed_lock = feed_cache.lock(cache_key)
+    if not feed_lock.acquire(timeout=0):
+        return False  # Already being fetched by another worker, which caches it for this one
+    try:
+        cached_feed = feed_cache.get(cache_key)
+        if shared_cache.shared and cached_feed and cached_feed.is_fresh(FEED_CACHE_FRESHNESS):
+            return False  # Refreshed by another worker
+
+        upstream_response, feed_chunks = fetch_rss_feed(original_feed_url, cached_feed)
+        if upstream_response is None:
+            return False
+
+        if upstream_response.status_code == 304 and cached_feed:
+            cached_feed.mark_validated()
+            feed_cache.set(cache_key, cached_feed)  # Renew cache TTL
+            return False
+
+        refreshed_feed = build_cached_feed(
+            upstream_response, feed_chunks, cache_key, proxy_feed_url, youtube, item_window
+        )
+        if refreshed_feed is None:
+            return False
+
+        feed_cache.set(cache_key, refreshed_feed)
+        return cached_feed is None or cached_feed.etag != refreshed_feed.etag
+    finally:
+        feed_lock.release()
+
+
+def stream_and_cache_feed(rewritten_chunks, cache_key, upstream_response):
+    """Relay rewritten feed chunks to the client, caching the complete feed if it is small enough
+
+    Nothing is cached if cache_key is None.
+    """
+    cached_chunks, cached_size = ([] if cache_key else None), 0
+    try:
+        for chunk in rewritten_chunks:
+            yield chunk
+            if cached_chunks is not None:
+                cached_chunks.append(chunk)
+                cached_size += len(chunk)
+                if cached_size > FEED_CACHE_MAX_FEED_BYTES:
+                    cached_chunks = None
+                    untrack_large_feed(cache_key)
+    except Exception as e:  # Headers are already sent, so the response can only be cut short
+        logging.error(f"Error rewriting feed: {e}")
+        return
+    finally:
+        upstream_response.close()
+
+    if cached_chunks is not None:
+        feed_cache.set(cache_key, cached_feed_from_chunks(cached_chunks, upstream_response))
+
+
+def cache_rewritten_feed(rewritten_chunks, cache_key, upstream_response):
+    """Rewrite a feed ahead of the client until it ends or outgrows the cache, caching it if it ends
+
+    Returns the cached feed, or None if the feed is too large to cache, and the chunks rewritten so far.
+    """
+    read_chunks, complete = read_cacheable_chunks(rewritten_chunks)
+    if not complete:
+        untrack_large_feed(cache_key)
+        return None, read_chunks
+    upstream_response.close()
+
+    cached_feed = cached_feed_from_chunks(read_chunks, upstream_response)
+    feed_cache.set(cache_key, cached_feed)
+    return cached_feed, read_chunks
+
+
+def cached_feed_from_chunks(rewritten_chunks, upstream_response):
+    return CachedFeed(
+        b"".join(rewritten_chunks),
+        upstream_etag=upstream_response.headers.get("ETag"),
+        upstream_last_modified=upstream_response.headers.get("Last-Modified"),
+    )
+
+
+def resolve_feed_path(feed_path, host):
+    """Upstream URL and proxied URL of a /feed/ path, and whether it is a YouTube channel"""
     youtube = feed_path.startswith("youtube/")
     if youtube:
         feed_path = (
             f"www.youtube.com/feeds/videos.xml?channel_id={feed_path.split('/')[1]}"
         )
+    return f"https://{feed_path}", f"https://{host}/feed/{feed_path}", youtube
 
-    original_feed_url = f"https://{feed_path}"
 
-    logging.info(f"[{request.user_agent}] Creating feed: {original_feed_url}")
-
-    feed_content = fetch_rss_feed(original_feed_url)
-    if not feed_content:
-        return "Failed to fetch feed", 500
+@bp.route("/<path:feed_path>")
+def proxy_feed(feed_path):
+    """Create a proxied RSS feed for a podcast or YouTube channel"""
+    original_feed_url, proxy_feed_url, youtube = resolve_feed_path(feed_path, request.host)
 
-    proxy_feed_url = f"https://{request.host}/feed/{feed_path}"
+    try:
+        item_window = ItemWindow.from_args(request.args)
+    except ValueError as e:
+        return f"Invalid item window: {e}", 400
 
-    if youtube:
-        rewritten_feed = rewrite_youtube_feed(feed_content)
-    else:
-        rewritten_feed = rewrite_rss_enclosure_urls(feed_content, proxy_feed_url)
+    logging.info(f"[{request.user_agent}] Creating feed: {original_feed_url}")
 
-    if not rewritten_feed:
-        return "Failed to rewrite feed", 500
+    # Rewritten feeds embed the proxy's own address, so cache per host
+    cache_key = (request.host, original_feed_url)
+    if item_window:
+        cache_key += (item_window.key(),)
+        proxy_feed_url += ("&" if "?" in proxy_feed_url else "?") + item_window.query()
+    cached_feed = feed_cache.get(cache_key)
+
+    if feed_refresher.enabled:
+        feed_refresher.track(cache_key, original_feed_url, proxy_feed_url, youtube, item_window)
+        if cached_feed:  # Kept up to date in the background
+            metrics.count_cache("feed", True)
+            return feed_response(cached_feed, cache_key)
+
+    if cached_feed and cached_feed.is_fresh(FEED_CACHE_FRESHNESS):
+        metrics.count_cache("feed", True)
+        return feed_response(cached_feed, cache_key)
+
+    # With a shared cache, a feed is fetched by one worker at a time, the others waiting to reuse its copy
+    feed_lock = None
+    if shared_cache.shared:
+        feed_lock = feed_cache.lock(cache_key)
+        if feed_lock.acquire(timeout=FEED_LOCK_WAIT):
+            cached_feed = feed_cache.get(cache_key)
+            if cached_feed and cached_feed.is_fresh(FEED_CACHE_FRESHNESS):
+                feed_lock.release()
+                metrics.count_cache("feed", True)
+                return feed_response(cached_feed, cache_key)
 
-    return Response(
-        b'<?xml version="1.0" encoding="UTF-8"?>\n'
-        + rewritten_feed,  # Apple podcasts requires the XML declaration
-        mimetype="application/rss+xml",
-    )
+    try:
+        upstream_response, feed_chunks = fetch_rss_feed(original_feed_url, cached_feed)
+        if upstream_response is None:
+            return "Failed to fetch feed", 500
+
+        metrics.count_cache("feed", bool(cached_feed) and upstream_response.status_code == 304)
+
+        if upstream_response.status_code == 304 and cached_feed:
+            logging.info(f"Feed not modified upstream: {original_feed_url}")
+            cached_feed.mark_validated()
+            feed_cache.set(cache_key, cached_feed)  # Renew cache TTL
+            return feed_response(cached_feed, cache_key)
+
+        if youtube:
+            cached_feed = build_cached_feed(
+                upstream_response, feed_chunks, cache_key, proxy_feed_url, youtube, item_window
+            )
+            if cached_feed is None:
+                return "Failed to rewrite feed", 500
+
+            feed_cache.set(cache_key, cached_feed)
+            return feed_response(cached_feed, cache_key)
+
+        rewritten_chunks = iter_rewritten_rss(feed_chunks, proxy_feed_url, item_window)
+        try:
+            # Fail before sending headers if the feed is not RSS
+            rewritten_chunks = chain([XML_DECLARATION, next(rewritten_chunks)], rewritten_chunks)
+            if feed_lock is not None:
+                # Rewritten ahead of the client, so other workers waiting for the lock don't wait for a slow client
+                cached_feed, read_chunks = cache_rewritten_feed(rewritten_chunks, cache_key, upstream_response)
+        except Exception as e:
+            logging.error(f"Error rewriting feed: {e}")
+            upstream_response.close()
+            return "Failed to rewrite feed", 500
+
+        if feed_lock is not None:
+            feed_lock.release()
+            if cached_feed is not None:
+                return feed_response(cached_feed, cache_key)
+            rewritten_chunks = chain(read_chunks, rewritten_chunks)
+            cache_key = None  # Too large to cache
+
+        response_chunks = stream_and_cache_feed(rewritten_chunks, cache_key, upstream_response)
+        encoding = negotiate_encoding(request.accept_encodings)
+        if encoding:
+            response_chunks = iter_compressed(response_chunks, encoding)
+        response = Response(stream_with_context(response_chunks), mimetype="application/rss+xml")
+        response.vary.add("Accept-Encoding")
+        if encoding:
+            response.content_encoding = encoding
+        return response
+    finally:
+        if feed_lock is not None:
+            feed_lock.release()
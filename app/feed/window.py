@@ -0,0 +1,86 @@
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+
+def parse_date(text, rfc822=True):
+    """Parse an RSS (RFC 822) or ISO 8601 date as UTC if it has no timezone, returning None if it is invalid"""
+    if not text:
+        return None
+    try:
+        date = parsedate_to_datetime(text.strip()) if rfc822 else datetime.fromisoformat(text.strip())
+    except (TypeError, ValueError, IndexError):
+        return None
+    return date if date.tzinfo else date.replace(tzinfo=timezone.utc)
+
+
+class ItemWindow:
+    """Which episodes of a feed to serve: the first max_items, and only those published since a date
+
+    Feeds list their newest episodes first, so the window ends at the last item kept and the rest of the feed
+    doesn't need to be parsed. Dates are checked against the order items are listed in, and items from feeds
+    listing oldest first are filtered without stopping early.
+    """
+
+    def __init__(self, max_items=None, since=None):
+        self.max_items = max_items
+        self.since = since
+
+    @classmethod
+    def from_args(cls, args):
+        """Window requested with ?items=N and/or ?since=YYYY-MM-DD, None for the whole feed
+
+        Raises ValueError if either is invalid.
+        """
+        max_items, since = args.get("items"), args.get("since")
+        if max_items is None and since is None:
+            return None
+        if max_items is not None:
+            if not max_items.isdigit() or int(max_items) < 1:
+                raise ValueError(f"Invalid number of items: {max_items}")
+            max_items = int(max_items)
+        if since is not None:
+            since_text, since = since, parse_date(since, rfc822=False)
+            if since is None:
+                raise ValueError(f"Invalid date: {since_text}")
+        return cls(max_items, since)
+
+    def key(self):
+        return self.max_items, self.since.isoformat() if self.since else None
+
+    def query(self):
+        """Query parameters requesting this window, for links back to the windowed feed"""
+        params = []
+        if self.max_items is not None:
+            params.append(f"items={self.max_items}")
+        if self.since is not None:
+            since = self.since.astimezone(timezone.utc)
+            params.append(f"since={since.strftime('%Y-%m-%dT%H:%M:%SZ')}")
+        return "&".join(params)
+
+    def selector(self):
+        return ItemSelector(self)
+
+
+class ItemSelector:
+    """Decides, item by item in feed order, whether each item is in a window and whether the window has ended"""
+
+    def __init__(self, window):
+        self.window = window
+        self.kept = 0
+        self.previous_date = None
+
+    def select(self, published):
+        """Return whether an item published at the given datetime (or None if unknown) is kept, and whether the
+        items after it can be skipped"""
+        window = self.window
+        newest_first = (
+            published is not None and self.previous_date is not None and published <= self.previous_date
+        )
+        if published is not None:
+            self.previous_date = published
+
+        if window.since is not None and published is not None and published < window.since:
+            return False, newest_first
+
+        self.kept += 1
+        return True, window.max_items is not None and self.kept >= window.max_items
@@ -1,9 +1,68 @@
-from flask import send_from_directory, request
+from flask import send_from_directory, request, jsonify, g, Response, current_app
 import logging
+import time
+from app import OPML_IMPORT_WORKERS
+from app.feed.opml import MAX_OPML_BYTES, rewrite_opml
 from app.main import bp
+from app.utils.disk_cache import disk_cache
+from app.utils.metrics import metrics
+
+
+@bp.before_app_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
+
+
+@bp.after_app_request
+def record_request_time(response):
+    """Time until the response headers are ready, excluding streamed bodies"""
+    if "request_start" in g:
+        metrics.observe(
+            "request_seconds",
+            (("endpoint", request.endpoint or "unknown"),),
+            time.perf_counter() - g.request_start,
+        )
+    return response
 
 
 @bp.route("/")
 def index():
     logging.info(f"[{request.user_agent}] Requested: /")
     return send_from_directory("static", "index.html")
+
+
+@bp.route("/stats")
+def stats():
+    return jsonify({"disk_cache": disk_cache.stats()})
+
+
+@bp.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+@bp.route("/opml", methods=["POST"])
+def import_opml():
+    """Rewrite an uploaded OPML subscription list to use proxied feeds, warming the feed cache with them"""
+    upload = request.files.get("opml")
+    opml_content = (upload.stream if upload else request.stream).read(MAX_OPML_BYTES + 1)
+    if len(opml_content) > MAX_OPML_BYTES:
+        return "OPML file too large", 413
+
+    logging.info(f"[{request.user_agent}] Importing OPML")
+    try:
+        rewritten, proxied, failed = rewrite_opml(
+            opml_content, request.host, current_app._get_current_object(), OPML_IMPORT_WORKERS
+        )
+    except ValueError as e:
+        return f"Invalid OPML: {e}", 400
+
+    return Response(
+        rewritten,
+        mimetype="text/x-opml",
+        headers={
+            "Content-Disposition": 'attachment; filename="podcast_proxy.opml"',
+            "X-Feeds-Proxied": str(proxied),
+            "X-Feeds-Failed": str(failed),
+        },
+    )
@@ -9,6 +9,8 @@ document.addEventListener("DOMContentLoaded", () => {
     const copyBtn = document.getElementById("copy-btn");
     const resultOutput = document.getElementById("converted-feed-url");
     const notification = document.getElementById("notification");
+    const opmlFileInput = document.getElementById("opml-file");
+    const importBtn = document.getElementById("import-btn");
 
     resultOutput.textContent = "Your generated URL will appear here...";
     resultOutput.style.opacity = "0.5";
@@ -16,6 +18,7 @@ document.addEventListener("DOMContentLoaded", () => {
     feedTypeSelect.addEventListener("change", toggleInputFields);
     generateBtn.addEventListener("click", generateFeedUrl);
     copyBtn.addEventListener("click", copyToClipboard);
+    importBtn.addEventListener("click", importOpml);
 
     function toggleInputFields() {
         if (feedTypeSelect.value === "podcast") {
@@ -76,6 +79,48 @@ document.addEventListener("DOMContentLoaded", () => {
         }
     }
 
+    async function importOpml() {
+        const file = opmlFileInput.files[0];
+        if (!file) {
+            showNotification("Please choose an OPML file.", true);
+            return;
+        }
+
+        const formData = new FormData();
+        formData.append("opml", file);
+        importBtn.disabled = true;
+        importBtn.textContent = "Converting...";
+
+        try {
+            const response = await fetch("/opml", { method: "POST", body: formData });
+            if (!response.ok) {
+                showNotification(await response.text(), true);
+                return;
+            }
+
+            const link = document.createElement("a");
+            link.href = URL.createObjectURL(await response.blob());
+            link.download = "podcast_proxy.opml";
+            link.click();
+            URL.revokeObjectURL(link.href);
+
+            const proxied = response.headers.get("X-Feeds-Proxied");
+            const failed = Number(response.headers.get("X-Feeds-Failed"));
+            showNotification(
+                failed
+                    ? `Proxied ${proxied} feeds, ${failed} could not be proxied.`
+                    : `Proxied ${proxied} feeds.`,
+                failed > 0
+            );
+        } catch (err) {
+            showNotification("Failed to convert OPML.", true);
+            console.error("Error converting OPML: ", err);
+        } finally {
+            importBtn.disabled = false;
+            importBtn.textContent = "Convert OPML";
+        }
+    }
+
     function showNotification(message, isError = false) {
         notification.textContent = message;
 
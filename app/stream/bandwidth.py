@@ -0,0 +1,155 @@
+import threading
+import time
+from cachetools import LRUCache
+from werkzeug.http import parse_content_range_header, parse_range_header
+import app
+from app.utils.metrics import metrics
+
+BURST_SECONDS = 2  # Bytes a limit lets through at once, in seconds of its rate, so players fill their buffer quickly
+SLICE_BYTES = 64 * 1024  # Most bytes sent per reservation, so one stream can't borrow far ahead of the others
+MAX_TRACKED_BUCKETS = 10000  # Per client and per upstream buckets, least recently used are forgotten
+
+
+def stream_priority(range_header, total_length=None):
+    """Players request byte ranges to start and seek episodes, while downloaders fetch whole files, without a range
+    or with one covering the file (often bytes=0-)"""
+    byte_range = parse_range_header(range_header)
+    if byte_range is None:
+        return "bulk"
+    start, stop = byte_range.ranges[0]
+    if start == 0 and (stop is None or (total_length is not None and stop >= total_length)):
+        return "bulk"
+    return "live"
+
+
+def content_range_length(content_range_header):
+    """Total length of a file from the Content-Range header of a response, or None if it isn't given"""
+    content_range = parse_content_range_header(content_range_header)
+    return content_range.length if content_range else None
+
+
+class TokenBucket:
+    """Allows sending rate bytes per second, in bursts of up to burst bytes
+
+    Bytes can be reserved before there are tokens for them, putting the bucket into debt, so concurrent streams
+    sharing a bucket wait their turn in the order they reserved.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self, byte_count, now):
+        """Take tokens for byte_count bytes, returning how many seconds to wait before sending them"""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate) - byte_count
+        self.updated = now
+        return max(0.0, -self.tokens / self.rate)
+
+
+class ScheduledStream:
+    """A stream relayed through the scheduler, reserving bandwidth for each chunk before sending it"""
+
+    def __init__(self, scheduler, client, host, priority):
+        self.scheduler = scheduler
+        self.client = client
+        self.host = host
+        self.priority = priority
+
+    def delay(self, byte_count):
+        """Seconds to wait before sending byte_count bytes of this stream"""
+        return self.scheduler.reserve(self, byte_count)
+
+    def close(self):
+        self.scheduler.close(self)
+
+
+class BandwidthScheduler:
+    """Shares the upstream link between streams with token buckets for all streams, each client and each upstream host
+
+    While live streams are playing, bulk downloads together get at most bulk_share of the global rate, so listeners
+    don't buffer while someone downloads a back catalogue. Rates are in bytes per second, 0 for no limit.
+    """
+
+    def __init__(self, max_rate, client_rate, upstream_rate, bulk_share):
+        self.max_rate = max_rate
+        self.client_rate = client_rate
+        self.upstream_rate = upstream_rate
+        self.bulk_share = bulk_share
+        self._lock = threading.Lock()
+        self._global = self._bucket(max_rate)
+        self._bulk = self._bucket(max_rate * bulk_share)
+        self._clients = LRUCache(maxsize=MAX_TRACKED_BUCKETS)
+        self._upstreams = LRUCache(maxsize=MAX_TRACKED_BUCKETS)
+        self._streams = {"live": 0, "bulk": 0}
+
+    @property
+    def enabled(self):
+        return bool(self.max_rate or self.client_rate or self.upstream_rate)
+
+    def open(self, client, host, priority):
+        with self._lock:
+            self._streams[priority] += 1
+        metrics.add_gauge("scheduled_streams", (("priority", priority),))
+        return ScheduledStream(self, client, host, priority)
+
+    def close(self, stream):
+        with self._lock:
+            self._streams[stream.priority] -= 1
+        metrics.add_gauge("scheduled_streams", (("priority", stream.priority),), -1)
+
+    def throttle(self, chunks, client, host, priority):
+        """Relay a stream's chunks no faster than its limits allow
+
+        The stream is only counted once relaying starts, so responses whose body is never sent aren't counted.
+        """
+        stream = self.open(client, host, priority)
+        try:
+            for chunk in chunks:
+                for start in range(0, len(chunk), SLICE_BYTES):
+                    piece = chunk[start : start + SLICE_BYTES]
+                    if wait := stream.delay(len(piece)):
+                        time.sleep(wait)
+                    yield piece
+        finally:
+            stream.close()
+
+    def reserve(self, stream, byte_count):
+        now = time.monotonic()
+        with self._lock:
+            buckets = [
+                ("global", self._global),
+                ("client", self._keyed_bucket(self._clients, stream.client, self.client_rate)),
+                ("upstream", self._keyed_bucket(self._upstreams, stream.host, self.upstream_rate)),
+            ]
+            if stream.priority == "bulk" and self._streams["live"]:
+                buckets.append(("bulk", self._bulk))
+            waits = [(bucket.reserve(byte_count, now), limit) for limit, bucket in buckets if bucket]
+
+        metrics.inc("scheduled_bytes_total", (("priority", stream.priority),), byte_count)
+        wait, limit = max(waits, default=(0.0, None))
+        if wait:
+            metrics.inc("throttled_seconds_total", (("limit", limit), ("priority", stream.priority)), wait)
+        return wait
+
+    def _keyed_bucket(self, buckets, key, rate):
+        if not rate:
+            return None
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = self._bucket(rate)
+        return bucket
+
+    @staticmethod
+    def _bucket(rate):
+        return TokenBucket(rate, rate * BURST_SECONDS) if rate else None
+
+
+# The host's total limit is split evenly between its server workers
+bandwidth_scheduler = BandwidthScheduler(
+    app.STREAM_MAX_BANDWIDTH / max(app.WEB_CONCURRENCY, 1),
+    app.STREAM_CLIENT_BANDWIDTH,
+    app.STREAM_UPSTREAM_BANDWIDTH,
+    app.STREAM_BULK_SHARE,
+)
@@ -0,0 +1,274 @@
+import bisect
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import time
+from email.utils import parsedate_to_datetime
+from werkzeug.datastructures import ResponseCacheControl
+from werkzeug.http import parse_cache_control_header, parse_content_range_header
+import app
+from app.utils.disk_cache import METADATA_SUFFIX, disk_cache
+
+READ_CHUNK_SIZE = 256 * 1024
+SAVE_INTERVAL_BYTES = 4 * 1024 * 1024  # Record downloaded segments at least this often while writing
+# Seconds after which a data file still without metadata is taken to be left by a worker that stopped creating it
+ABANDONED_AFTER = 60
+
+
+class EpisodeCacheEntry:
+    """Sparse cache file of one episode and the byte ranges of it downloaded so far"""
+
+    def __init__(self, name, total_length, headers, expires_at, inode, segments=None):
+        self.name = name
+        self.total_length = total_length
+        self.headers = headers  # Content-Type, ETag and Last-Modified of the upstream file
+        self.expires_at = expires_at
+        self.inode = inode  # Identifies the data file the segments were written to
+        self.segments = segments or []  # Sorted, non-overlapping [start, end) ranges
+
+    def cached_until(self, position):
+        """End of the downloaded segment containing position, or None if it hasn't been downloaded"""
+        index = bisect.bisect_right(self.segments, [position, float("inf")]) - 1
+        if index >= 0 and self.segments[index][1] > position:
+            return self.segments[index][1]
+        return None
+
+    def next_segment_start(self, position):
+        index = bisect.bisect_right(self.segments, [position, float("inf")])
+        return self.segments[index][0] if index < len(self.segments) else None
+
+    def add_segment(self, start, end):
+        if start >= end:
+            return
+        merged = []
+        for segment_start, segment_end in self.segments:
+            if segment_end < start or segment_start > end:
+                merged.append([segment_start, segment_end])
+            else:
+                start, end = min(start, segment_start), max(end, segment_end)
+        merged.append([start, end])
+        self.segments = sorted(merged)
+
+    def if_range(self):
+        """Validator making upstream send the whole file instead of a range if it has changed"""
+        etag = self.headers.get("ETag")
+        if etag and not etag.startswith("W/"):
+            return etag
+        return self.headers.get("Last-Modified")
+
+    def to_json(self):
+        return {
+            "total_length": self.total_length,
+            "headers": self.headers,
+            "expires_at": self.expires_at,
+            "inode": self.inode,
+            "segments": self.segments,
+        }
+
+
+def cache_expiry(upstream_headers, default_ttl):
+    """Expiry time of an upstream response from its caching headers, or None if it must not be cached"""
+    cache_control = parse_cache_control_header(
+        upstream_headers.get("Cache-Control"), cls=ResponseCacheControl
+    )
+    if cache_control.no_store or cache_control.private or cache_control.no_cache:
+        return None
+    if cache_control.max_age is not None:
+        return time.time() + cache_control.max_age
+    if upstream_headers.get("Expires"):
+        try:
+            return parsedate_to_datetime(upstream_headers["Expires"]).timestamp()
+        except (TypeError, ValueError):
+            return None  # Invalid dates mean already expired
+    return time.time() + default_ttl
+
+
+class EpisodeCache:
+    """Write-through cache of podcast episodes streamed from upstream, so replays and seeks are served locally
+
+    Episodes are kept as sparse files in the disk cache directory, sharing its byte budget and eviction. Only the
+    ranges clients requested are downloaded, and missing ranges are filled in by later requests.
+    """
+
+    def __init__(self, default_ttl, max_episode_bytes):
+        self.enabled = False
+        self.default_ttl = default_ttl
+        self.max_episode_bytes = max_episode_bytes
+
+    def name(self, stream_url):
+        return f"episode-{hashlib.sha1(stream_url.encode()).hexdigest()}.audio"
+
+    def get(self, stream_url):
+        """Cache entry of an episode, or None if it isn't cached or has expired"""
+        name = self.name(stream_url)
+        entry = self._valid_entry(name)
+        if entry is None or not disk_cache.lookup(name):
+            return None
+        if entry.expires_at < time.time():
+            logging.info(f"Cached episode {stream_url} expired")
+            disk_cache.remove(name)
+            return None
+        return entry
+
+    def create(self, stream_url, upstream_response):
+        """Create an empty cache entry sized for an upstream response, or return None if it can't be cached"""
+        headers = upstream_response.headers
+        if upstream_response.status_code == 206:
+            content_range = parse_content_range_header(headers.get("Content-Range"))
+            total_length = content_range.length if content_range else None
+        elif upstream_response.status_code == 200 and headers.get("Accept-Ranges") == "bytes":
+            total_length = int(headers.get("Content-Length") or 0) or None
+        else:
+            return None  # Gaps can only be filled from upstreams supporting ranges
+
+        expires_at = cache_expiry(headers, self.default_ttl)
+        if (
+            not total_length
+            or total_length > self.max_episode_bytes
+            or expires_at is None
+            or headers.get("Content-Encoding", "identity") != "identity"
+        ):
+            return None
+
+        name = self.name(stream_url)
+        entry_headers = {
+            header: headers[header]
+            for header in ("Content-Type", "ETag", "Last-Modified")
+            if header in headers
+        }
+        existing = self._valid_entry(name)
+        if existing is not None:  # Created by another worker since this one looked
+            if existing.total_length == total_length and existing.headers == entry_headers:
+                return existing
+            return None
+
+        path = disk_cache.path(name)
+        temp_path = f"{path}.{os.getpid()}.download.tmp"
+        try:
+            with open(temp_path, "wb") as data_file:
+                data_file.truncate(total_length)  # Sparse until ranges are written
+                inode = os.fstat(data_file.fileno()).st_ino
+            try:
+                os.link(temp_path, path)  # Never replaces an episode another worker is serving or filling
+            except FileExistsError:
+                if not self._abandoned(name):
+                    return None
+                os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        entry = EpisodeCacheEntry(name, total_length, entry_headers, expires_at, inode)
+        self._save(entry)
+        disk_cache.add(name)
+        logging.info(f"Caching episode {stream_url} ({total_length} bytes)")
+        return entry
+
+    def open(self, entry):
+        """Open the data file of an entry, raising FileNotFoundError if it was evicted or replaced"""
+        fd = os.open(disk_cache.path(entry.name), os.O_RDWR)
+        if os.fstat(fd).st_ino != entry.inode:
+            os.close(fd)
+            raise FileNotFoundError(f"Cached episode {entry.name} was replaced")
+        return fd
+
+    def read(self, entry, start, stop):
+        fd = self.open(entry)
+        try:
+            position = start
+            while position < stop:
+                data = os.pread(fd, min(READ_CHUNK_SIZE, stop - position), position)
+                if not data:
+                    break
+                position += len(data)
+                disk_cache.record_served(len(data))
+                yield data
+        finally:
+            os.close(fd)
+
+    def write(self, entry, start, chunks):
+        """Relay chunks while writing them to the entry's data file from start"""
+        fd = self.open(entry)
+        position = saved_position = start
+        try:
+            for chunk in chunks:
+                if position + len(chunk) > entry.total_length:
+                    raise ValueError(f"Upstream sent more than {entry.total_length} bytes")
+                os.pwrite(fd, chunk, position)
+                position += len(chunk)
+                if position - saved_position >= SAVE_INTERVAL_BYTES:
+                    entry.add_segment(saved_position, position)
+                    self._save(entry)
+                    saved_position = position
+                yield chunk
+        finally:
+            os.close(fd)
+            if position > saved_position:  # Includes clients disconnecting part way
+                entry.add_segment(saved_position, position)
+                self._save(entry)
+
+    def remove(self, entry):
+        disk_cache.remove(entry.name)
+
+    def _valid_entry(self, name):
+        """Entry of an episode whose metadata describes the data file on disk, or None"""
+        entry = self._read_entry(name)
+        if entry is None:
+            return None
+        try:
+            stat = os.stat(disk_cache.path(name))
+        except FileNotFoundError:
+            return None
+        if stat.st_ino != entry.inode or stat.st_size != entry.total_length:
+            return None
+        return entry
+
+    def _abandoned(self, name):
+        """Whether an existing data file without valid metadata is old enough to replace"""
+        if self._valid_entry(name) is not None:
+            return False
+        try:
+            return os.path.getmtime(disk_cache.path(name)) < time.time() - ABANDONED_AFTER
+        except FileNotFoundError:
+            return True
+
+    def _read_entry(self, name):
+        try:
+            with open(disk_cache.path(name + METADATA_SUFFIX)) as metadata_file:
+                metadata = json.load(metadata_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        return EpisodeCacheEntry(
+            name,
+            metadata["total_length"],
+            metadata["headers"],
+            metadata["expires_at"],
+            metadata["inode"],
+            metadata["segments"],
+        )
+
+    def _save(self, entry):
+        """Merge the entry's segments with those other workers recorded for the same data file, and write them"""
+        try:
+            data_file = open(disk_cache.path(entry.name), "rb")
+        except FileNotFoundError:
+            return  # Evicted
+        with data_file:
+            fcntl.flock(data_file, fcntl.LOCK_EX)
+            if os.fstat(data_file.fileno()).st_ino != entry.inode:
+                return  # Replaced by a newer download
+            on_disk = self._read_entry(entry.name)
+            if on_disk is not None and on_disk.inode == entry.inode:
+                for start, end in on_disk.segments:
+                    entry.add_segment(start, end)
+
+            metadata_path = disk_cache.path(entry.name + METADATA_SUFFIX)
+            temp_path = disk_cache.path(f"{entry.name}.{os.getpid()}.tmp{METADATA_SUFFIX}")
+            with open(temp_path, "w") as metadata_file:
+                json.dump(entry.to_json(), metadata_file, separators=(",", ":"))
+            os.replace(temp_path, metadata_path)
+
+
+episode_cache = EpisodeCache(app.EPISODE_CACHE_TTL, app.EPISODE_CACHE_MAX_EPISODE_BYTES)
@@ -0,0 +1,137 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from urllib.parse import parse_qs, urlparse
+from cachetools import TLRUCache
+import yt_dlp
+import app
+from app.utils.metrics import metrics
+
+AUDIO_FORMAT = "bestaudio[ext=m4a]"
+EXPIRY_MARGIN = 10 * 60  # Seconds before signed URLs expire that metadata is dropped, so downloads can finish
+# Large parts of extracted metadata not needed to download audio
+UNUSED_INFO_KEYS = ("thumbnails", "subtitles", "automatic_captions", "heatmap", "storyboards")
+
+
+class VideoInfo:
+    """Metadata of a YouTube video extracted by yt-dlp, including signed URLs of its audio formats"""
+
+    def __init__(self, video_id, info, expires_at):
+        self.video_id = video_id
+        self.info = info
+        self.expires_at = expires_at
+
+    @property
+    def duration(self):
+        return self.info.get("duration")
+
+    @property
+    def filesize(self):
+        """Size of the selected audio format in bytes, or None if YouTube didn't report it"""
+        return self.info.get("filesize") or self.info.get("filesize_approx")
+
+
+def signed_url_expiry(info):
+    """Earliest expiry time of the signed audio URLs in extracted metadata, or None if they don't say"""
+    expiry_times = [
+        int(expire[0])
+        for audio_format in [info, *info.get("formats", [])]
+        if audio_format.get("url")
+        for expire in [parse_qs(urlparse(audio_format["url"]).query).get("expire")]
+        if expire and expire[0].isdigit()
+    ]
+    return min(expiry_times, default=None)
+
+
+class YouTubeExtractor:
+    """Extracts YouTube video metadata with long-lived YoutubeDL instances, caching it until its URLs expire
+
+    YoutubeDL instances keep the player code and signature functions they fetched, so reusing them makes later
+    extractions faster. Instances aren't thread-safe, so each is used by one thread at a time, and concurrent
+    requests for the same video share one extraction.
+    """
+
+    def __init__(self, instances, default_ttl, max_videos):
+        self.default_ttl = default_ttl
+        self._lock = threading.Lock()
+        self._idle = queue.LifoQueue()
+        self._available = threading.Semaphore(instances)
+        self._extractions = {}  # video_id -> Future of in-flight extraction
+        self._videos = TLRUCache(
+            maxsize=max_videos, ttu=lambda video_id, video, now: video.expires_at, timer=time.time
+        )
+
+    def cached(self, video_id):
+        """Metadata of a video if it has already been extracted and is still valid, without extracting it"""
+        with self._lock:
+            return self._videos.get(video_id)
+
+    def extract(self, video_id, stream_url):
+        """Metadata of a video, extracting it if it isn't cached"""
+        with self._lock:
+            video = self._videos.get(video_id)
+            extraction = self._extractions.get(video_id)
+            extracting = video is None and extraction is None
+            if extracting:
+                extraction = self._extractions[video_id] = Future()
+        metrics.count_cache("youtube_metadata", video is not None)
+        if video is not None:
+            return video
+        if not extracting:
+            return extraction.result()
+
+        try:
+            video = self._extract(video_id, stream_url)
+            with self._lock:
+                self._videos[video_id] = video
+            extraction.set_result(video)
+            return video
+        except Exception as e:
+            extraction.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._extractions.pop(video_id, None)
+
+    def invalidate(self, video_id):
+        """Forget a video's metadata, such as after its URLs stopped working"""
+        with self._lock:
+            self._videos.pop(video_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._videos.clear()
+
+    def _extract(self, video_id, stream_url):
+        with self._available:
+            try:
+                ydl = self._idle.get_nowait()
+            except queue.Empty:
+                ydl = yt_dlp.YoutubeDL({"format": AUDIO_FORMAT, "quiet": True})
+            try:
+                with metrics.time("youtube_extract"):
+                    info = ydl.sanitize_info(ydl.extract_info(stream_url, download=False))
+            finally:
+                self._idle.put(ydl)
+
+        for key in UNUSED_INFO_KEYS:
+            info.pop(key, None)
+        info["formats"] = [
+            audio_format
+            for audio_format in info.get("formats", [])
+            if audio_format.get("vcodec") == "none"
+        ]
+        expires_at = signed_url_expiry(info)
+        if expires_at is None:
+            expires_at = time.time() + self.default_ttl
+        else:
+            expires_at -= EXPIRY_MARGIN
+        logging.info(f"Extracted {stream_url}, valid for {expires_at - time.time():.0f}s")
+        return VideoInfo(video_id, info, expires_at)
+
+
+youtube_extractor = YouTubeExtractor(
+    app.YOUTUBE_EXTRACTORS, app.YOUTUBE_METADATA_TTL, app.YOUTUBE_METADATA_MAX_VIDEOS
+)
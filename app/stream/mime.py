@@ -0,0 +1,49 @@
+import threading
+from itertools import chain
+from cachetools import TTLCache
+from app.utils import detect_file_mime
+
+MIME_SNIFF_BYTES = 1024  # Enough for magic numbers and libmagic
+MIME_VERDICT_TTL = 60 * 60
+MIME_VERDICT_MAX_URLS = 10000
+
+
+def peek_head(chunks, size):
+    """Read chunks until size bytes are available, returning those bytes and the stream with the read chunks put back
+
+    The head is usually within the first chunk, which joining a single chunk returns as is rather than copying.
+    """
+    peeked = []
+    peeked_bytes = 0
+    for chunk in chunks:
+        peeked.append(chunk)
+        peeked_bytes += len(chunk)
+        if peeked_bytes >= size:
+            break
+    return b"".join(peeked), chain(peeked, chunks)
+
+
+class MimeVerdictCache:
+    """Detected MIME types of upstream streams, so each file is sniffed once rather than on every (range) request"""
+
+    def __init__(self, max_urls, ttl):
+        self._lock = threading.Lock()
+        self._mime_types = TTLCache(maxsize=max_urls, ttl=ttl)
+
+    def get(self, stream_url):
+        with self._lock:
+            return self._mime_types.get(stream_url)
+
+    def sniff(self, stream_url, head):
+        """Detect and remember the MIME type of a stream from its first bytes"""
+        mime_type = detect_file_mime(head)
+        with self._lock:
+            self._mime_types[stream_url] = mime_type
+        return mime_type
+
+    def clear(self):
+        with self._lock:
+            self._mime_types.clear()
+
+
+stream_mime_verdicts = MimeVerdictCache(MIME_VERDICT_MAX_URLS, MIME_VERDICT_TTL)
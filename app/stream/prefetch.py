@@ -0,0 +1,89 @@
+import logging
+import os
+import threading
+from collections import Counter, deque
+import app
+from app.stream.youtube import youtube_downloader
+from app.utils.disk_cache import disk_cache
+
+
+class YouTubePrefetcher:
+    """Downloads the newest videos of channel feeds in the background so they are cached before they are played"""
+
+    def __init__(self, count, workers, per_channel, max_queued):
+        self.enabled = False
+        self.count = count
+        self.workers = workers
+        self.per_channel = per_channel
+        self.max_queued = max_queued
+        self._condition = threading.Condition()
+        self._pending = deque()  # (channel_id, video_id, stream_url)
+        self._queued_video_ids = set()  # Pending or downloading
+        self._active = Counter()  # channel_id -> downloads in progress
+
+    def start(self):
+        self.enabled = True
+        for _ in range(self.workers):
+            threading.Thread(target=self._work, daemon=True).start()
+
+    def enqueue(self, channel_id, videos):
+        """Queue the newest videos of a channel, given as (video_id, stream_url) pairs newest first"""
+        if not self.enabled:
+            return
+
+        with self._condition:
+            for video_id, stream_url in list(videos)[: self.count]:
+                if video_id in self._queued_video_ids or os.path.exists(
+                    disk_cache.path(f"{video_id}.m4a")
+                ):
+                    continue
+                if len(self._pending) >= self.max_queued:
+                    logging.warning(f"Prefetch queue full, not prefetching {stream_url}")
+                    break
+                self._pending.append((channel_id, video_id, stream_url))
+                self._queued_video_ids.add(video_id)
+            self._condition.notify_all()
+
+    def next_job(self):
+        """Wait for the oldest queued video whose channel is below its concurrency limit"""
+        with self._condition:
+            while True:
+                for job in self._pending:
+                    if self._active[job[0]] < self.per_channel:
+                        self._pending.remove(job)
+                        self._active[job[0]] += 1
+                        return job
+                self._condition.wait()
+
+    def finish_job(self, job):
+        channel_id, video_id, _ = job
+        with self._condition:
+            self._active[channel_id] -= 1
+            if not self._active[channel_id]:
+                del self._active[channel_id]
+            self._queued_video_ids.discard(video_id)
+            self._condition.notify_all()
+
+    def _work(self):
+        while True:
+            job = self.next_job()
+            channel_id, video_id, stream_url = job
+            try:
+                download = youtube_downloader.download(
+                    video_id, stream_url, disk_cache.path(f"{video_id}.m4a")
+                )
+                if download is not None:
+                    logging.info(f"Prefetching {stream_url} for channel {channel_id}")
+                    download.wait_until_finished()
+            except Exception as e:
+                logging.error(f"Error prefetching {stream_url}: {e}")
+            finally:
+                self.finish_job(job)
+
+
+youtube_prefetcher = YouTubePrefetcher(
+    app.YOUTUBE_PREFETCH_COUNT,
+    app.YOUTUBE_PREFETCH_WORKERS,
+    app.YOUTUBE_PREFETCH_PER_CHANNEL,
+    app.YOUTUBE_PREFETCH_MAX_QUEUED,
+)
@@ -0,0 +1,35 @@
+import threading
+from cachetools import TTLCache
+import app
+
+
+class RedirectCache:
+    """Final URLs reached by following an enclosure's tracking redirects, so seeks skip the redirect chain"""
+
+    def __init__(self, max_urls, ttl):
+        self._lock = threading.Lock()
+        self._final_urls = TTLCache(maxsize=max_urls, ttl=ttl)
+
+    def get(self, stream_url):
+        with self._lock:
+            return self._final_urls.get(stream_url)
+
+    def set(self, stream_url, final_url):
+        with self._lock:
+            if final_url == stream_url:
+                self._final_urls.pop(stream_url, None)
+            else:
+                self._final_urls[stream_url] = final_url
+
+    def invalidate(self, stream_url):
+        with self._lock:
+            self._final_urls.pop(stream_url, None)
+
+    def clear(self):
+        with self._lock:
+            self._final_urls.clear()
+
+
+stream_redirects = RedirectCache(
+    app.STREAM_REDIRECT_CACHE_MAX_URLS, app.STREAM_REDIRECT_CACHE_TTL
+)
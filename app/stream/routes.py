@@ -1,95 +1,368 @@
-import base64
 import logging
-import os
-import yt_dlp
-from itertools import tee
-from flask import Response, request, send_file, current_app
+from flask import Response, request, send_file
 from urllib.parse import urlparse, parse_qs
+from werkzeug.http import parse_content_range_header, quote_etag
 import app
-from app.utils import check_hostname, filter_headers, check_file_mime
+from app.utils import check_hostname, filter_headers
 from app.stream import bp
+from app.stream.bandwidth import bandwidth_scheduler, content_range_length, stream_priority
+from app.stream.episode_cache import episode_cache
+from app.stream.mime import MIME_SNIFF_BYTES, peek_head, stream_mime_verdicts
+from app.stream.redirects import stream_redirects
+from app.stream.tokens import stream_tokens
+from app.stream.youtube import youtube_downloader
+from app.utils.disk_cache import disk_cache
+from app.utils.metrics import metrics
+
+MAX_STREAM_BYTES = 300000000  # 300MB limit
+STREAM_MIME_TYPES = {
+    "audio/mpeg",
+    "audio/x-mpeg",
+    "audio/mp3",
+    "audio/mp4",
+    "audio/aac",
+    "audio/wav",
+    "audio/ogg",
+}
+
+
+def decode_stream_url(encoded_url):
+    """Decode a stream URL created by create_proxied_stream_url, returning the URL and whether it is signed"""
+    return stream_tokens.decode(encoded_url)
+
+
+def is_youtube_url(stream_url):
+    return urlparse(stream_url).netloc == "www.youtube.com"
 
 
 def youtube_stream(stream_url):
-    """Handle YouTube video streaming by downloading and caching audio"""
+    """Handle YouTube video streaming by downloading and caching audio, serving it while it downloads"""
     parsed_url = urlparse(stream_url)
     video_id = parse_qs(parsed_url.query)["v"][0]
-    cache_dir = os.path.abspath(os.path.join(current_app.root_path, "..", "cache"))
-    if not os.path.exists(cache_dir):
-        os.makedirs(cache_dir)
-
-    cache_path = os.path.join(cache_dir, f"{video_id}.m4a")
-
-    if not os.path.exists(cache_path):
-        logging.info(f"Cache miss for {stream_url}. Downloading to {cache_path}")
-        ydl_opts = {
-            "format": "bestaudio[ext=m4a]",
-            "outtmpl": cache_path,
-            "quiet": True,
-        }
-        with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-            ydl.download([stream_url])
-        logging.info(f"Downloaded {stream_url} to cache.")
-    else:
+    cache_name = f"{video_id}.m4a"
+    cache_path = disk_cache.path(cache_name)
+
+    download = None
+    if not disk_cache.lookup(cache_name):
+        download = youtube_downloader.download(video_id, stream_url, cache_path)
+    metrics.count_cache("youtube", download is None)
+
+    if download is None:
         logging.info(f"Cache hit for {stream_url}. Serving from {cache_path}")
+        response = send_file(cache_path, mimetype="audio/mp4")
+        disk_cache.record_served(response.content_length or 0)
+        metrics.inc("relayed_bytes_total", (("source", "youtube_cache"),), response.content_length or 0)
+        return response
+
+    logging.info(f"Cache miss for {stream_url}. Serving download in progress")
+    return progressive_download_response(download)
+
 
-    return send_file(cache_path, mimetype="audio/mp4")
+def progressive_download_response(download):
+    """Serve a YouTube download while it is still in progress, supporting single byte range requests"""
+    in_progress_file = download.open_in_progress()
+    if in_progress_file is None:
+        if not download.wait_until_finished():
+            return "Failed to download video", 500
+        return send_file(download.cache_path, mimetype="audio/mp4")
 
+    total_bytes = download.total_bytes
+    headers = {"Accept-Ranges": "bytes", "ETag": quote_etag(download.etag)}
+    start, stop, status = 0, total_bytes, 200
 
-def perform_safety_check(upstream_response, stream_url):
-    """Perform safety checks on an upstream response"""
-    # Check file size limit
-    max_size_bytes = 300000000  # 300MB limit
-    content_length = upstream_response.headers.get("Content-Length")
-    if content_length and int(content_length) > max_size_bytes:
+    # Ranges validated against another file, such as the published one, get the whole download
+    if_range = request.if_range
+    range_matches = not (if_range.etag or if_range.date) or if_range.etag == download.etag
+
+    if request.range and total_bytes and range_matches:
+        byte_range = request.range.range_for_length(total_bytes)
+        if byte_range is None:
+            in_progress_file.close()
+            return Response(
+                status=416, headers={"Content-Range": f"bytes */{total_bytes}"}
+            )
+        start, stop = byte_range
+        status = 206
+        headers["Content-Range"] = request.range.to_content_range_header(total_bytes)
+
+    if stop is not None:
+        headers["Content-Length"] = str(stop - start)
+
+    return Response(
+        metrics.track_stream(download.iter_bytes(in_progress_file, start, stop), "youtube_download"),
+        status=status,
+        headers=headers,
+        mimetype="audio/mp4",
+        direct_passthrough=True,
+    )
+
+
+def check_stream_size(content_length):
+    """Check an upstream response's Content-Length against the size limit"""
+    if content_length and int(content_length) > MAX_STREAM_BYTES:
         raise ValueError(
-            f"File size {int(content_length) / 1000000:.2f}MB exceeds {max_size_bytes / 1000000}MB limit."
+            f"File size {int(content_length) / 1000000:.2f}MB exceeds {MAX_STREAM_BYTES / 1000000}MB limit."
         )
 
-    # Check file content safety
-    stream_mime_types = {
-        "audio/mpeg",
-        "audio/x-mpeg",
-        "audio/mp3",
-        "audio/mp4",
-        "audio/wav",
-        "audio/ogg",
-    }
 
-    # megaphone.fm mp3 streams are detected as application/octet-stream, so have to assume they are safe
-    if not (
+def needs_mime_check(stream_url):
+    """megaphone.fm mp3 streams are detected as application/octet-stream, so have to assume they are safe"""
+    return not (
         urlparse(stream_url).netloc == "traffic.megaphone.fm"
         and stream_url.endswith(".mp3")
-    ):
-        check_response = tee(
-            upstream_response.iter_content(chunk_size=8192)
-        )  # Duplicate the upstream response iterator
-        check_file_mime(next(check_response), stream_mime_types)
+    )
 
 
-def generic_stream(stream_url):
+def check_stream_mime(mime_type):
+    if mime_type not in STREAM_MIME_TYPES:
+        raise ValueError(f"Detected MIME type is not allowed: {mime_type}")
+
+
+def range_start(status_code, content_range):
+    """Offset of the first byte in an upstream response, non-zero for partial responses to seeking clients"""
+    if status_code != 206:
+        return 0
+    parsed_range = parse_content_range_header(content_range)
+    return parsed_range.start if parsed_range else 0
+
+
+def fetch_stream_head(stream_url):
+    """Fetch the first bytes of a file, to sniff it when the client requested a later range"""
     headers = filter_headers(request.headers.items())
-    upstream_response = app.session.get(
-        stream_url,
+    headers["Range"] = f"bytes=0-{MIME_SNIFF_BYTES - 1}"
+    upstream_response = request_upstream(
+        stream_redirects.get(stream_url) or stream_url, headers
+    )
+    upstream_response.raise_for_status()
+    head, _ = peek_head(
+        iter_upstream_chunks(upstream_response, MIME_SNIFF_BYTES, MIME_SNIFF_BYTES),
+        MIME_SNIFF_BYTES,
+    )
+    upstream_response.close()
+    return head
+
+
+def perform_safety_check(upstream_response, stream_url, chunks):
+    """Perform safety checks on an upstream response, returning its chunks with any bytes read for sniffing put back"""
+    check_stream_size(upstream_response.headers.get("Content-Length"))
+
+    # Check file content safety
+    if needs_mime_check(stream_url):
+        mime_type = stream_mime_verdicts.get(stream_url)
+        metrics.count_cache("mime", mime_type is not None)
+        if mime_type is None:
+            if range_start(
+                upstream_response.status_code,
+                upstream_response.headers.get("Content-Range"),
+            ):
+                head = fetch_stream_head(stream_url)
+            else:
+                head, chunks = peek_head(chunks, MIME_SNIFF_BYTES)
+            mime_type = stream_mime_verdicts.sniff(stream_url, head)
+        check_stream_mime(mime_type)
+    return chunks
+
+
+def iter_upstream_chunks(upstream_response, min_chunk_size, max_chunk_size):
+    """Relay the undecoded upstream body, growing the read size while the upstream keeps filling it
+
+    read1 returns whatever is already buffered instead of waiting for a full chunk, so the first bytes are not delayed
+    and slow upstreams produce small chunks, while fast upstreams are relayed in few large chunks with little
+    per-chunk overhead.
+    """
+    chunk_size = min_chunk_size
+    try:
+        while chunk := upstream_response.raw.read1(chunk_size, decode_content=False):
+            yield chunk
+            if len(chunk) == chunk_size:
+                chunk_size = min(chunk_size * 2, max_chunk_size)
+    finally:
+        upstream_response.close()
+
+
+def connects_through_proxy(url):
+    """Whether requests for a URL are sent through EXTERNAL_PROXY, which resolves their host without the session's
+    address checks"""
+    return bool(app.EXTERNAL_PROXY) and urlparse(url).scheme == "https"
+
+
+def request_upstream(url, headers):
+    return app.session.get(
+        url,
         proxies={"https": app.EXTERNAL_PROXY},
         headers=headers,
         allow_redirects=True,
         stream=True,
     )
+
+
+def request_stream(stream_url, headers):
+    """Request a stream from the end of its cached redirect chain, following the chain again if that URL fails"""
+    final_url = stream_redirects.get(stream_url)
+    metrics.count_cache("redirect", final_url is not None)
+    if final_url:
+        upstream_response = request_upstream(final_url, headers)
+        if upstream_response.ok:
+            return upstream_response
+        logging.info(f"Cached redirect for {stream_url} failed ({upstream_response.status_code}), following again")
+        upstream_response.close()
+        stream_redirects.invalidate(stream_url)
+
+    upstream_response = request_upstream(stream_url, headers)
+    if upstream_response.ok and upstream_response.history:
+        stream_redirects.set(stream_url, upstream_response.url)
+    return upstream_response
+
+
+def cached_episode_response(stream_url, entry, headers):
+    """Serve a cached episode, supporting single byte range requests"""
+    total_length = entry.total_length
+    response_headers = {**entry.headers, "Accept-Ranges": "bytes"}
+    start, stop, status = 0, total_length, 200
+
+    if request.range:
+        byte_range = request.range.range_for_length(total_length)
+        if byte_range is None:
+            return Response(
+                status=416, headers={"Content-Range": f"bytes */{total_length}"}
+            )
+        start, stop = byte_range
+        status = 206
+        response_headers["Content-Range"] = request.range.to_content_range_header(
+            total_length
+        )
+    response_headers["Content-Length"] = str(stop - start)
+
+    logging.info(f"Serving {stream_url} from episode cache")
+    # Missing ranges are filled from upstream under the same bandwidth limits as uncached streams
+    client, priority = request.remote_addr, stream_priority(request.headers.get("Range"), total_length)
+    return Response(
+        metrics.track_stream(
+            iter_cached_episode(stream_url, entry, start, stop, headers, client, priority), "episode_cache"
+        ),
+        status=status,
+        headers=response_headers,
+        direct_passthrough=True,
+    )
+
+
+def iter_cached_episode(stream_url, entry, start, stop, headers, client, priority):
+    """Read bytes start to stop (exclusive) of a cached episode, downloading and caching the ranges it is missing"""
+    position = start
+    while position < stop:
+        cached_until = entry.cached_until(position)
+        if cached_until:
+            end = min(cached_until, stop)
+            chunks = episode_cache.read(entry, position, end)
+        else:
+            end = min(entry.next_segment_start(position) or stop, stop)
+            upstream_response = request_episode_range(stream_url, entry, position, end, headers)
+            chunks = episode_cache.write(
+                entry,
+                position,
+                throttle_upstream(
+                    iter_upstream_chunks(
+                        upstream_response, app.STREAM_MIN_CHUNK_SIZE, app.STREAM_MAX_CHUNK_SIZE
+                    ),
+                    upstream_response,
+                    client,
+                    priority,
+                ),
+            )
+
+        for chunk in chunks:
+            position += len(chunk)
+            yield chunk
+        if position < end:
+            raise ValueError(f"Episode {stream_url} ended at byte {position} of {end}")
+
+
+def throttle_upstream(chunks, upstream_response, client, priority):
+    """Relay chunks from upstream no faster than the bandwidth limits allow, if any are set"""
+    if not bandwidth_scheduler.enabled:
+        return chunks
+    return bandwidth_scheduler.throttle(chunks, client, urlparse(upstream_response.url).hostname, priority)
+
+
+def request_episode_range(stream_url, entry, start, stop, headers):
+    """Request a range of an episode missing from its cache entry, dropping the entry if the file changed upstream"""
+    range_headers = {
+        header: value
+        for header, value in headers.items()
+        if header not in ("Range", "Accept-Encoding")
+    }
+    range_headers["Range"] = f"bytes={start}-{stop - 1}"
+    range_headers["Accept-Encoding"] = "identity"
+    if entry.if_range():
+        range_headers["If-Range"] = entry.if_range()
+
+    upstream_response = request_stream(stream_url, range_headers)
+    content_range = parse_content_range_header(upstream_response.headers.get("Content-Range"))
+    if (
+        upstream_response.status_code != 206
+        or content_range is None
+        or content_range.start != start
+        or content_range.length != entry.total_length
+    ):
+        upstream_response.close()
+        if upstream_response.status_code == 200:
+            episode_cache.remove(entry)  # Changed since it was cached
+        raise ValueError(
+            f"Upstream returned {upstream_response.status_code} for cached episode range of {stream_url}"
+        )
+    return upstream_response
+
+
+def generic_stream(stream_url):
+    headers = filter_headers(request.headers.items())
+    if episode_cache.enabled:
+        entry = episode_cache.get(stream_url)
+        metrics.count_cache("episode", entry is not None)
+        if entry is not None:
+            return cached_episode_response(stream_url, entry, headers)
+
+    with metrics.time("stream_upstream"):
+        upstream_response = request_stream(stream_url, headers)
     upstream_response.raise_for_status()
+    chunks = iter_upstream_chunks(
+        upstream_response, app.STREAM_MIN_CHUNK_SIZE, app.STREAM_MAX_CHUNK_SIZE
+    )
 
     if app.ENABLE_STREAMING_SAFETY_CHECK and upstream_response.status_code in (
         200,
         206,
     ):  # Only perform checks on successful responses
         try:
-            perform_safety_check(upstream_response, stream_url)
+            chunks = perform_safety_check(upstream_response, stream_url, chunks)
         except ValueError as e:
             logging.error(f"Safety check failed for {stream_url}: {e}")
+            upstream_response.close()
             return "Invalid stream file", 403
 
+    if episode_cache.enabled:
+        entry = episode_cache.create(stream_url, upstream_response)
+        if entry is not None:
+            chunks = episode_cache.write(
+                entry,
+                range_start(
+                    upstream_response.status_code,
+                    upstream_response.headers.get("Content-Range"),
+                ),
+                chunks,
+            )
+
+    chunks = throttle_upstream(
+        chunks,
+        upstream_response,
+        request.remote_addr,
+        stream_priority(
+            request.headers.get("Range"),
+            content_range_length(upstream_response.headers.get("Content-Range")),
+        ),
+    )
+
     return Response(
-        upstream_response.iter_content(chunk_size=8192),
+        metrics.track_stream(chunks, "upstream"),
         status=upstream_response.status_code,
         headers=dict(upstream_response.headers),
     )
@@ -97,15 +370,18 @@ def generic_stream(stream_url):
 
 @bp.route("/<path:encoded_url>")
 def proxy_media(encoded_url):
-    """Streams file located at given base64-encoded URL"""
+    """Streams file located at URL given as a stream token or legacy base64-encoded URL"""
     try:
-        stream_url = base64.urlsafe_b64decode(encoded_url.encode()).decode()
+        stream_url, signed = decode_stream_url(encoded_url)
         logging.info(f"[{request.user_agent}] Streaming: {stream_url}")
 
-        if urlparse(stream_url).netloc == "www.youtube.com":
+        if is_youtube_url(stream_url):
             return youtube_stream(stream_url)
 
-        check_hostname(stream_url)
+        # Signed URLs are well formed and don't name private addresses, and the session only connects directly to
+        # public addresses, but the external proxy resolves hosts itself so they must be checked first
+        if not signed or connects_through_proxy(stream_url):
+            check_hostname(stream_url)
         return generic_stream(stream_url)
     except Exception as e:
         logging.error(f"An unexpected error occurred: {e}")
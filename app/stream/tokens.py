@@ -0,0 +1,106 @@
+import base64
+import fcntl
+import hashlib
+import hmac
+import os
+import secrets
+import zlib
+import app
+from app.utils import check_url
+
+DEFLATE_FORMAT = b"\x01"  # Legacy tokens are base64 URLs, so start with "h"
+# Deflate dictionary of common enclosure URL parts. Tokens in feeds clients already downloaded are decompressed
+# with it, so it must never change: add a new format instead
+URL_DICTIONARY = (
+    b"?updated=&utm_source=.mp3.m4a/episodes/audio/redirect.mp3/"
+    b"https://traffic.megaphone.fm/https://dts.podtrac.com/redirect.mp3/https://chrt.fm/track/"
+    b"https://pdst.fm/e/https://op3.dev/e/https://www.podtrac.com/pts/redirect.mp3/"
+    b"https://cdn.simplecast.com/audio/https://anchor.fm/s/https://d3ctxlq1ktw2nl.cloudfront.net/staging/"
+    b"https://media.transistor.fm/https://mcdn.podbean.com/mf/web/https://www.buzzsprout.com/"
+    b"https://feeds.soundcloud.com/stream/https://sphinx.acast.com/https://pscrb.fm/rss/p/"
+    b"https://www.youtube.com/watch?v="
+)
+SIGNATURE_BYTES = 12
+SECRET_FILENAME = "stream_url_secret"
+MAX_URL_BYTES = 16 * 1024
+
+
+def b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
+
+
+def b64decode(text):
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+
+class StreamTokens:
+    """Compact tokens carrying a deflated upstream URL, signed if the URL passed validation when it was minted
+
+    Minting doesn't resolve the URL's host, so a signature only vouches that the URL is well formed and doesn't name
+    a private address.
+
+    Tokens are stateless: any server worker can decode them, and only skipping validation depends on the secret.
+    Unless one is configured, the secret is created once in the cache directory and shared by all workers.
+    """
+
+    def __init__(self, secret):
+        self.configured_secret = secret
+        self.secret = secret.encode() if secret else None  # Tokens are left unsigned until opened
+
+    def open(self, directory):
+        """Use the secret stored in a cache directory, creating it if no worker has yet"""
+        if self.configured_secret:
+            return
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, SECRET_FILENAME)
+        with open(f"{path}.lock", "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(path) as secret_file:
+                    secret = secret_file.read().strip()
+            except FileNotFoundError:
+                secret = ""
+            if not secret:
+                secret = secrets.token_hex(32)
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                fd = os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "w") as secret_file:
+                    secret_file.write(secret)
+                os.replace(temp_path, path)
+        self.secret = secret.encode()
+
+    def sign(self, payload):
+        return b64encode(
+            hmac.new(self.secret, payload.encode(), hashlib.sha256).digest()[:SIGNATURE_BYTES]
+        )
+
+    def encode(self, stream_url):
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=URL_DICTIONARY)
+        payload = b64encode(
+            DEFLATE_FORMAT + compressor.compress(stream_url.encode()) + compressor.flush()
+        )
+        try:
+            check_url(stream_url)
+        except ValueError:
+            return payload  # Unsigned, so it is fully checked when streamed
+        if self.secret is None:
+            return payload
+        return f"{payload}.{self.sign(payload)}"
+
+    def decode(self, token):
+        """Decode a token, or a legacy base64 URL, returning the URL and whether it has a valid signature"""
+        payload, _, signature = token.partition(".")
+        data = b64decode(payload)
+        if not data.startswith(DEFLATE_FORMAT):
+            return data.decode(), False
+
+        try:
+            decompressor = zlib.decompressobj(-15, zdict=URL_DICTIONARY)
+            stream_url = decompressor.decompress(data[1:], MAX_URL_BYTES).decode()
+        except zlib.error as e:
+            raise ValueError(f"Invalid stream token: {e}") from e
+        signed = bool(signature) and self.secret is not None and hmac.compare_digest(signature, self.sign(payload))
+        return stream_url, signed
+
+
+stream_tokens = StreamTokens(app.STREAM_URL_SECRET)
@@ -0,0 +1,223 @@
+import copy
+import logging
+import os
+import secrets
+import threading
+import time
+import yt_dlp
+import app
+from app.stream.extractor import AUDIO_FORMAT, youtube_extractor
+from app.utils.disk_cache import disk_cache
+from app.utils.metrics import metrics
+from app.utils.shared_cache import shared_cache
+
+DOWNLOAD_STALL_TIMEOUT = 60  # Seconds without progress before readers give up on a download
+DOWNLOAD_LOCK_TTL = 30 * 60  # Seconds before the lock of a download that never finished expires
+READ_CHUNK_SIZE = 64 * 1024
+
+
+class VideoDownload:
+    """Audio download of a single YouTube video, readable while it is still being written"""
+
+    def __init__(self, video_id, stream_url, cache_path):
+        self.video_id = video_id
+        self.stream_url = stream_url
+        self.cache_path = cache_path
+        # Unique per process so server workers never write to each other's files
+        self.temp_path = os.path.join(
+            os.path.dirname(cache_path), f"{video_id}.{os.getpid()}.download.m4a"
+        )
+        self.downloaded_bytes = 0
+        self.total_bytes = None
+        self.data_complete = False  # All bytes written, but post-processing may still replace the file
+        self.finished = False
+        self.remote = False  # Being downloaded by another worker, so there is no file to read until it is shared
+        self.error = None
+        # The published file may be remuxed, so bytes read while downloading get a validator of their own
+        self.etag = f"{video_id}-download-{secrets.token_hex(8)}"
+        self._condition = threading.Condition()
+
+    def progress_hook(self, progress):
+        """yt-dlp progress hook recording how much of the file can be read"""
+        with self._condition:
+            if progress["status"] == "downloading":
+                self.downloaded_bytes = progress.get("downloaded_bytes") or 0
+                self.total_bytes = progress.get("total_bytes") or self.total_bytes
+            elif progress["status"] == "finished":
+                self.data_complete = True
+            self._condition.notify_all()
+
+    def wait_for_remote(self):
+        """Record that another worker is downloading the video, so readers wait for the file it shares"""
+        with self._condition:
+            self.remote = True
+            self._condition.notify_all()
+
+    def publish(self):
+        """Atomically move the completed download into the cache"""
+        with self._condition:
+            os.replace(self.temp_path, self.cache_path)
+            self.finished = True
+            self._condition.notify_all()
+
+    def mark_finished(self):
+        """Record that the file was published to the cache by another worker sharing the cache directory"""
+        with self._condition:
+            self.finished = True
+            self._condition.notify_all()
+
+    def fail(self, error):
+        with self._condition:
+            self.error = error
+            self._condition.notify_all()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def wait_until_finished(self):
+        """Wait for the download to be published, returning False if it failed"""
+        with self._condition:
+            self._condition.wait_for(lambda: self.finished or self.error)
+            return self.finished
+
+    def open_in_progress(self):
+        """Open the partially downloaded file, or return None if it is already complete or failed
+
+        Once all data is written, yt-dlp may remux the file in place, so new readers must wait for the published file
+        rather than read bytes that are about to change.
+        """
+        with self._condition:
+            self._condition.wait_for(
+                lambda: self.downloaded_bytes
+                or self.data_complete
+                or self.finished
+                or self.remote
+                or self.error,
+                timeout=DOWNLOAD_STALL_TIMEOUT,
+            )
+            if self.data_complete or self.finished or self.remote or self.error:
+                return None
+            if not self.downloaded_bytes:
+                raise TimeoutError(f"Download of {self.stream_url} did not start")
+            return open(self.temp_path, "rb")
+
+    def _wait_for_bytes(self, position):
+        """Wait until data past position has been written, returning False if no more data will arrive"""
+        with self._condition:
+            progressed = self._condition.wait_for(
+                lambda: self.downloaded_bytes > position
+                or self.data_complete
+                or self.error,
+                timeout=DOWNLOAD_STALL_TIMEOUT,
+            )
+            if self.error or not progressed:
+                return False
+            return self.downloaded_bytes > position or self.data_complete
+
+    def iter_bytes(self, file, start, stop=None):
+        """Read bytes start to stop (exclusive) from an open in-progress file, waiting for bytes not yet written"""
+        try:
+            file.seek(start)
+            position = start
+            while stop is None or position < stop:
+                if not self._wait_for_bytes(position):
+                    break
+                read_size = READ_CHUNK_SIZE
+                if stop is not None:
+                    read_size = min(read_size, stop - position)
+                data = file.read(read_size)
+                if not data:
+                    if self.data_complete:
+                        break
+                    time.sleep(0.1)  # Reported bytes may still be in yt-dlp's write buffer
+                    continue
+                position += len(data)
+                yield data
+        finally:
+            file.close()
+
+
+class YouTubeDownloader:
+    """Coalesces concurrent requests for the same video into a single background download
+
+    Downloads also take a shared cache lock, so with a shared backend each video is downloaded by one worker of the
+    cluster and copied from the shared cache by the others.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._downloads = {}  # video_id -> VideoDownload
+
+    def download(self, video_id, stream_url, cache_path):
+        """Start downloading a video, or join its in-flight download. Returns None if it is already cached"""
+        with self._lock:
+            if video_id in self._downloads:
+                return self._downloads[video_id]
+            if os.path.exists(cache_path):
+                return None
+
+            download = VideoDownload(video_id, stream_url, cache_path)
+            self._downloads[video_id] = download
+
+        threading.Thread(target=self._run, args=(download,), daemon=True).start()
+        return download
+
+    def _run(self, download):
+        download_lock = shared_cache.lock(f"youtube:{download.video_id}", DOWNLOAD_LOCK_TTL)
+        if not download_lock.acquire(timeout=0):
+            logging.info(f"Waiting for another worker downloading {download.stream_url}")
+            download.wait_for_remote()
+            download_lock.acquire(timeout=DOWNLOAD_LOCK_TTL)
+        try:
+            if os.path.exists(download.cache_path):  # Downloaded by a worker sharing the cache directory
+                disk_cache.add(os.path.basename(download.cache_path))
+                download.mark_finished()
+            elif shared_cache.get_file(f"youtube:{download.video_id}", download.temp_path):
+                download.publish()
+                disk_cache.add(os.path.basename(download.cache_path))
+                logging.info(f"Copied {download.stream_url} from shared cache")
+            else:
+                self._download(download)
+        except Exception as e:
+            logging.error(f"Error fetching {download.stream_url} from shared cache: {e}")
+            download.fail(e)
+        finally:
+            download_lock.release()
+            with self._lock:
+                self._downloads.pop(download.video_id, None)
+
+    def _download(self, download):
+        logging.info(f"Downloading {download.stream_url} to {download.cache_path}")
+        ydl_opts = {
+            "format": AUDIO_FORMAT,
+            "outtmpl": download.temp_path,
+            "nopart": True,  # Write straight to the temporary file so it can be read while downloading
+            "continuedl": False,
+            "quiet": True,
+            "progress_hooks": [download.progress_hook],
+        }
+        try:
+            if os.path.exists(download.temp_path):  # Left behind by a previous crash
+                os.remove(download.temp_path)
+            video = youtube_extractor.extract(download.video_id, download.stream_url)
+            with metrics.time("youtube_download"), yt_dlp.YoutubeDL(ydl_opts) as ydl:
+                try:
+                    ydl.process_ie_result(copy.deepcopy(video.info), download=True)
+                except yt_dlp.utils.DownloadError as e:
+                    if download.downloaded_bytes:
+                        raise
+                    # Cached URLs may have been revoked early, extract them again
+                    logging.info(f"Retrying {download.stream_url} with new metadata: {e}")
+                    youtube_extractor.invalidate(download.video_id)
+                    video = youtube_extractor.extract(download.video_id, download.stream_url)
+                    ydl.process_ie_result(copy.deepcopy(video.info), download=True)
+            download.publish()
+            disk_cache.add(os.path.basename(download.cache_path))
+            logging.info(f"Downloaded {download.stream_url} to cache.")
+        except Exception as e:
+            logging.error(f"Error downloading {download.stream_url}: {e}")
+            download.fail(e)
+            return
+        shared_cache.put_file(f"youtube:{download.video_id}", download.cache_path, app.SHARED_CACHE_FILE_TTL)
+
+
+youtube_downloader = YouTubeDownloader()
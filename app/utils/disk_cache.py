@@ -0,0 +1,213 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import app
+
+INDEX_FILENAME = "index.json"
+INDEX_SAVE_INTERVAL = 30  # Seconds between saving access times recorded by cache hits
+METADATA_SUFFIX = ".meta"  # Metadata stored alongside a cached file, removed with it
+
+
+class DiskCache:
+    """Byte-budgeted cache of files in a directory, evicting least recently or least frequently used files
+
+    Sizes and access statistics are kept in a compact index file so the directory is only scanned when the index is
+    missing. Several server workers can share one directory: index writes are merged under a file lock.
+    """
+
+    def __init__(self, max_bytes, policy, pinned_per_group):
+        if policy not in ("lru", "lfu"):
+            raise ValueError(f"Unknown cache eviction policy: {policy}")
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.pinned_per_group = pinned_per_group
+        self.directory = None
+        self._lock = threading.Lock()
+        self._entries = {}  # name -> [size, last access time, hits]
+        self._pins = {}  # group -> names never evicted
+        self._removed = set()  # Evicted since the index was last saved
+        self._last_save = 0
+        self._stats = {"hits": 0, "misses": 0, "bytes_served": 0, "evictions": 0}
+
+    def open(self, directory):
+        """Load the index for a cache directory, scanning the directory if there is no index"""
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self.directory = directory
+            self._removed.clear()
+            index = self._read_index()
+            if index is None:
+                index = {"entries": self._scan_directory(), "pins": {}}
+                logging.info(f"Rebuilt cache index for {directory}")
+            self._entries = index["entries"]
+            self._pins = index["pins"]
+            self._save()
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def lookup(self, name):
+        """Check whether a file is cached, recording the access if it is"""
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None:
+                entry = self._stat_entry(name)  # Possibly added by another worker
+            elif not os.path.exists(self.path(name)):
+                del self._entries[name]  # Evicted by another worker
+                entry = None
+
+            if entry is None:
+                self._stats["misses"] += 1
+                return False
+
+            entry[1] = time.time()
+            entry[2] += 1
+            self._stats["hits"] += 1
+            if time.monotonic() - self._last_save > INDEX_SAVE_INTERVAL:
+                self._save()
+            return True
+
+    def record_served(self, byte_count):
+        with self._lock:
+            self._stats["bytes_served"] += byte_count
+
+    def add(self, name):
+        """Record a file newly written to the cache directory, evicting other files if over budget"""
+        size = os.path.getsize(self.path(name))
+        with self._lock:
+            self._entries[name] = [size, time.time(), 0]
+            self._removed.discard(name)
+            self._evict(keep=name)
+            self._save()
+
+    def remove(self, name):
+        """Remove a cached file that is no longer valid"""
+        with self._lock:
+            self._entries.pop(name, None)
+            self._removed.add(name)
+            self._remove_files(name)
+            self._save()
+
+    def pin(self, group, names):
+        """Protect the first pinned_per_group names of a group (e.g. newest episodes of a channel) from eviction"""
+        if not self.pinned_per_group:
+            return
+        names = list(names)[: self.pinned_per_group]
+        with self._lock:
+            if self._pins.get(group) != names:
+                self._pins[group] = names
+                self._save()
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats["hits"] + self._stats["misses"]
+            return {
+                **self._stats,
+                "hit_ratio": self._stats["hits"] / lookups if lookups else 0.0,
+                "files": len(self._entries),
+                "size_bytes": sum(entry[0] for entry in self._entries.values()),
+                "max_bytes": self.max_bytes,
+            }
+
+    def _evict(self, keep):
+        total_size = sum(entry[0] for entry in self._entries.values())
+        if total_size <= self.max_bytes:
+            return
+
+        protected = {keep, *(name for names in self._pins.values() for name in names)}
+        if self.policy == "lfu":
+            order = lambda name: (self._entries[name][2], self._entries[name][1])
+        else:
+            order = lambda name: self._entries[name][1]
+        candidates = sorted(
+            (name for name in self._entries if name not in protected), key=order
+        )
+
+        for name in candidates:
+            if total_size <= self.max_bytes:
+                break
+            size = self._entries.pop(name)[0]
+            self._removed.add(name)
+            self._remove_files(name)
+            total_size -= size
+            self._stats["evictions"] += 1
+            logging.info(f"Evicted {name} ({size} bytes) from cache")
+
+        if total_size > self.max_bytes:
+            logging.warning(
+                f"Cache is over budget ({total_size} > {self.max_bytes} bytes) with only pinned or new files left"
+            )
+
+    def _stat_entry(self, name):
+        """Start tracking a file found in the cache directory but not in this worker's index"""
+        try:
+            size = os.path.getsize(self.path(name))
+        except FileNotFoundError:
+            return None
+        entry = self._entries[name] = [size, time.time(), 0]
+        return entry
+
+    def _remove_files(self, name):
+        for path in (self.path(name), self.path(name + METADATA_SUFFIX)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _scan_directory(self):
+        entries = {}
+        for dir_entry in os.scandir(self.directory):
+            if (
+                dir_entry.is_file()
+                and not dir_entry.name.startswith(INDEX_FILENAME)
+                and ".download." not in dir_entry.name  # In-progress downloads
+                and not dir_entry.name.endswith(METADATA_SUFFIX)
+            ):
+                stat = dir_entry.stat()
+                entries[dir_entry.name] = [stat.st_size, stat.st_atime, 0]
+        return entries
+
+    def _read_index(self):
+        try:
+            with open(self.path(INDEX_FILENAME)) as index_file:
+                return json.load(index_file)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _save(self):
+        """Merge this worker's entries with the index on disk and write it atomically"""
+        with open(self.path(f"{INDEX_FILENAME}.lock"), "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            on_disk = self._read_index() or {"entries": {}, "pins": {}}
+            # Entries only one side knows about may have been evicted by another worker since
+            for name in [name for name in self._entries if name not in on_disk["entries"]]:
+                if not os.path.exists(self.path(name)):
+                    del self._entries[name]
+            for name, (size, last_access, hits) in on_disk["entries"].items():
+                if name in self._removed:
+                    continue
+                if name not in self._entries and not os.path.exists(self.path(name)):
+                    continue
+                entry = self._entries.setdefault(name, [size, last_access, hits])
+                entry[1] = max(entry[1], last_access)
+                entry[2] = max(entry[2], hits)
+            self._pins = {**on_disk["pins"], **self._pins}
+            self._removed.clear()
+
+            temp_path = self.path(f"{INDEX_FILENAME}.{os.getpid()}.tmp")
+            with open(temp_path, "w") as index_file:
+                json.dump(
+                    {"entries": self._entries, "pins": self._pins},
+                    index_file,
+                    separators=(",", ":"),
+                )
+            os.replace(temp_path, self.path(INDEX_FILENAME))
+        self._last_save = time.monotonic()
+
+
+disk_cache = DiskCache(
+    app.DISK_CACHE_MAX_BYTES, app.DISK_CACHE_EVICTION_POLICY, app.DISK_CACHE_PINNED_PER_CHANNEL
+)
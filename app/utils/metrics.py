@@ -0,0 +1,197 @@
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+PREFIX = "podcast_proxy"
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+MAX_UPSTREAM_HOSTS = 500  # Further hosts are counted as "other" to bound the number of series
+METRIC_DESCRIPTIONS = {
+    "stage_seconds": ("histogram", "Time spent in each stage of serving feeds and streams"),
+    "request_seconds": ("histogram", "Time until response headers are sent, per endpoint"),
+    "relayed_bytes_total": ("counter", "Bytes sent to clients by stream source"),
+    "active_streams": ("gauge", "Streams currently being sent to clients by source"),
+    "cache_requests_total": ("counter", "Cache lookups by cache and result"),
+    "upstream_responses_total": ("counter", "Upstream responses by host and status code"),
+    "scheduled_bytes_total": ("counter", "Bytes relayed from upstream through the bandwidth scheduler by priority"),
+    "scheduled_streams": ("gauge", "Streams currently relayed through the bandwidth scheduler by priority"),
+    "throttled_seconds_total": ("counter", "Time streams were delayed by the bandwidth scheduler, by limit and priority"),
+}
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in labels
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def format_value(value):
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Metrics:
+    """Counters, gauges and histograms exported in the Prometheus text format
+
+    Each server worker periodically writes a snapshot of its metrics to a shared directory, and /metrics adds up the
+    snapshots of all live workers so scrapes don't depend on which worker answers.
+    """
+
+    def __init__(self, buckets, max_hosts):
+        self.buckets = buckets
+        self.max_hosts = max_hosts
+        self.directory = None
+        self.interval = None
+        self._exporter = None
+        self._lock = threading.Lock()
+        self._counters = defaultdict(float)  # (name, labels) -> value
+        self._gauges = defaultdict(float)
+        self._histograms = {}  # (name, labels) -> [count per bucket..., sum, count]
+        self._hosts = set()
+
+    def inc(self, name, labels=(), value=1):
+        with self._lock:
+            self._counters[(name, labels)] += value
+
+    def add_gauge(self, name, labels=(), value=1):
+        with self._lock:
+            self._gauges[(name, labels)] += value
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            histogram = self._histograms.setdefault(
+                (name, labels), [0] * (len(self.buckets) + 2)
+            )
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    histogram[index] += 1
+            histogram[-2] += value
+            histogram[-1] += 1
+
+    @contextmanager
+    def time(self, stage):
+        """Time a stage of serving a request, such as resolving a host or rewriting a feed"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", (("stage", stage),), time.perf_counter() - start)
+
+    def count_cache(self, cache, hit):
+        self.inc("cache_requests_total", (("cache", cache), ("result", "hit" if hit else "miss")))
+
+    def record_upstream_response(self, response, *args, **kwargs):
+        """requests response hook counting upstream status codes per host and timing upstream responses"""
+        host = urlparse(response.url).hostname or ""
+        with self._lock:
+            if host not in self._hosts and len(self._hosts) < self.max_hosts:
+                self._hosts.add(host)
+            if host not in self._hosts:
+                host = "other"
+        self.inc("upstream_responses_total", (("host", host), ("status", str(response.status_code))))
+        self.observe("stage_seconds", (("stage", "upstream_response"),), response.elapsed.total_seconds())
+
+    def track_stream(self, chunks, source):
+        """Relay a stream's chunks while counting them as an active stream and relayed bytes"""
+        labels = (("source", source),)
+        self.add_gauge("active_streams", labels)
+        try:
+            for chunk in chunks:
+                self.inc("relayed_bytes_total", labels, len(chunk))
+                yield chunk
+        finally:
+            self.add_gauge("active_streams", labels, -1)
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                "counters": [[name, labels, value] for (name, labels), value in self._counters.items()],
+                "gauges": [[name, labels, value] for (name, labels), value in self._gauges.items()],
+                "histograms": [
+                    [name, labels, list(values)] for (name, labels), values in self._histograms.items()
+                ],
+            }
+
+    def start(self, directory, interval):
+        """Share this worker's metrics with other workers through snapshots written to a directory"""
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.interval = interval
+        if self._exporter is None:
+            self._exporter = threading.Thread(target=self._export, daemon=True)
+            self._exporter.start()
+
+    def render(self):
+        """All workers' metrics in the Prometheus text exposition format"""
+        counters, gauges, histograms = defaultdict(float), defaultdict(float), {}
+        for snapshot in [self.snapshot(), *self._other_worker_snapshots()]:
+            for name, labels, value in snapshot["counters"]:
+                counters[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, value in snapshot["gauges"]:
+                gauges[(name, tuple(map(tuple, labels)))] += value
+            for name, labels, values in snapshot["histograms"]:
+                merged = histograms.setdefault(
+                    (name, tuple(map(tuple, labels))), [0] * len(values)
+                )
+                for index, value in enumerate(values):
+                    merged[index] += value
+
+        lines = []
+        for name, (metric_type, description) in METRIC_DESCRIPTIONS.items():
+            full_name = f"{PREFIX}_{name}"
+            lines.append(f"# HELP {full_name} {description}")
+            lines.append(f"# TYPE {full_name} {metric_type}")
+            for (series_name, labels), value in sorted({**counters, **gauges}.items()):
+                if series_name == name:
+                    lines.append(f"{full_name}{format_labels(labels)} {format_value(value)}")
+            for (series_name, labels), values in sorted(histograms.items()):
+                if series_name == name:
+                    for bound, count in zip((*self.buckets, "+Inf"), values[:-2] + [values[-1]]):
+                        lines.append(
+                            f"{full_name}_bucket{format_labels((*labels, ('le', bound)))} {format_value(count)}"
+                        )
+                    lines.append(f"{full_name}_sum{format_labels(labels)} {format_value(values[-2])}")
+                    lines.append(f"{full_name}_count{format_labels(labels)} {format_value(values[-1])}")
+        return "\n".join(lines) + "\n"
+
+    def _snapshot_path(self, pid):
+        return os.path.join(self.directory, f"{pid}.json")
+
+    def _other_worker_snapshots(self):
+        if self.directory is None:
+            return []
+        snapshots = []
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            if path == self._snapshot_path(os.getpid()):
+                continue
+            try:
+                if time.time() - os.path.getmtime(path) > 3 * self.interval:
+                    os.remove(path)  # Worker exited
+                    continue
+                with open(path) as snapshot_file:
+                    snapshots.append(json.load(snapshot_file))
+            except (FileNotFoundError, ValueError):
+                continue
+        return snapshots
+
+    def _export(self):
+        while True:
+            try:
+                temp_path = f"{self._snapshot_path(os.getpid())}.tmp"
+                with open(temp_path, "w") as snapshot_file:
+                    json.dump(self.snapshot(), snapshot_file, separators=(",", ":"))
+                os.replace(temp_path, self._snapshot_path(os.getpid()))
+            except OSError as e:
+                logging.error(f"Error sharing metrics: {e}")
+            time.sleep(self.interval)
+
+
+metrics = Metrics(BUCKETS, MAX_UPSTREAM_HOSTS)
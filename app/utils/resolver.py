@@ -0,0 +1,75 @@
+import ipaddress
+import socket
+import threading
+from cachetools import TTLCache
+import app
+from app.utils.metrics import metrics
+
+
+def is_private_address(address):
+    ip = ipaddress.ip_address(address)
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    return (
+        ip.is_private
+        or ip.is_loopback
+        or ip.is_reserved
+        or ip.is_link_local
+        or ip.is_multicast
+        or ip.is_unspecified
+    )
+
+
+class HostResolver:
+    """Caches the IPv4 and IPv6 addresses of upstream hosts, and failed lookups for a shorter time
+
+    The system resolver doesn't report record TTLs, so entries are kept for a fixed TTL short enough to follow
+    upstream DNS changes.
+    """
+
+    def __init__(self, ttl, negative_ttl, max_hosts):
+        self._lock = threading.Lock()
+        self._addresses = TTLCache(maxsize=max_hosts, ttl=ttl)
+        self._failures = TTLCache(maxsize=max_hosts, ttl=negative_ttl)
+
+    def resolve(self, host):
+        """All addresses of a host, raising socket.gaierror if it doesn't resolve"""
+        with self._lock:
+            addresses = self._addresses.get(host)
+            failure = self._failures.get(host)
+        metrics.count_cache("dns", addresses is not None or failure is not None)
+        if addresses is not None:
+            return addresses
+        if failure is not None:
+            raise failure
+
+        try:
+            with metrics.time("dns"):
+                address_info = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)
+        except socket.gaierror as e:
+            with self._lock:
+                self._failures[host] = e
+            raise
+
+        addresses = list(dict.fromkeys(info[4][0] for info in address_info))
+        with self._lock:
+            self._addresses[host] = addresses
+        return addresses
+
+    def resolve_public(self, host):
+        """All addresses of a host, raising ValueError if any of them is private"""
+        addresses = self.resolve(host)
+        for address in addresses:
+            if is_private_address(address):
+                raise ValueError(f"Attempted to use bad host: {host} {address}")
+        return addresses
+
+    def clear(self):
+        with self._lock:
+            self._addresses.clear()
+            self._failures.clear()
+
+
+host_resolver = HostResolver(
+    app.DNS_CACHE_TTL, app.DNS_NEGATIVE_CACHE_TTL, app.DNS_CACHE_MAX_HOSTS
+)
@@ -0,0 +1,334 @@
+import fcntl
+import hashlib
+import logging
+import os
+import secrets
+import shutil
+import threading
+import time
+
+try:
+    import redis
+except ImportError:  # Installed with the redis extra
+    redis = None
+
+LOCK_POLL_INTERVAL = 0.1
+SWEEP_INTERVAL = 10 * 60  # Seconds between removing expired entries from a shared directory
+# Deletes a lock only if it is still held with the token it was acquired with, rather than taken over after expiring
+RELEASE_SCRIPT = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+
+def key_name(key):
+    """File and key-value store safe name of a cache key"""
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+def lock_deadline(timeout):
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def wait_for_lock(try_acquire, deadline):
+    """Poll try_acquire until it returns a token, returning None once the deadline passes"""
+    while True:
+        token = try_acquire()
+        if token is not None:
+            return token
+        if deadline is not None and time.monotonic() >= deadline:
+            return None
+        time.sleep(LOCK_POLL_INTERVAL)
+
+
+class MemoryBackend:
+    """Nothing is shared: values and files live only in each worker's own caches, and locks only coordinate the
+    threads of one worker"""
+
+    shared = False
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._held = {}  # key -> (expiry time, token), so a lock whose holder never released it still expires
+
+    def get(self, key):
+        return None
+
+    def set(self, key, value, ttl):
+        pass
+
+    def get_file(self, key, path):
+        return False
+
+    def put_file(self, key, path, ttl):
+        pass
+
+    def acquire(self, key, ttl, timeout):
+        deadline = lock_deadline(timeout)
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                expires_at, _ = self._held.get(key, (0, None))
+                if expires_at <= now:
+                    token = object()
+                    self._held[key] = (now + ttl, token)
+                    return token
+                wait_until = expires_at if deadline is None else min(expires_at, deadline)
+                if wait_until <= now:
+                    return None
+                self._condition.wait(wait_until - now)
+
+    def release(self, key, token):
+        with self._condition:
+            if self._held.get(key, (0, None))[1] is token:
+                del self._held[key]
+            self._condition.notify_all()
+
+
+class FileBackend:
+    """Values, files and locks in a directory shared by the server workers of a host, or by several hosts on a network
+    filesystem supporting flock
+
+    Expiry times are stored as the modification times of entries, and locks are released by the kernel if their
+    holder dies. Files are only copied if the directory is on a different filesystem from cache_dir: otherwise the
+    workers sharing it also share the cache directory, where finished files already are.
+    """
+
+    shared = True
+
+    def __init__(self, directory, cache_dir=None):
+        self.directory = directory
+        for kind in ("values", "files", "locks"):
+            os.makedirs(os.path.join(directory, kind), exist_ok=True)
+        self.copies_files = cache_dir is None or os.stat(directory).st_dev != os.stat(cache_dir).st_dev
+        self._last_sweep = 0
+
+    def get(self, key):
+        path = self._path("values", key)
+        try:
+            if os.path.getmtime(path) < time.time():
+                return None
+            with open(path, "rb") as value_file:
+                return value_file.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, key, value, ttl):
+        def write(temp_path):
+            with open(temp_path, "wb") as value_file:
+                value_file.write(value)
+
+        self._publish(self._path("values", key), ttl, write)
+
+    def get_file(self, key, path):
+        if not self.copies_files:
+            return False
+        shared_path = self._path("files", key)
+        try:
+            if os.path.getmtime(shared_path) < time.time():
+                return False
+            shutil.copyfile(shared_path, path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def put_file(self, key, path, ttl):
+        if not self.copies_files:
+            return
+        self._publish(self._path("files", key), ttl, lambda temp_path: shutil.copyfile(path, temp_path))
+
+    def acquire(self, key, ttl, timeout):
+        lock_file = open(self._path("locks", key), "w")
+
+        def try_acquire():
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return lock_file
+            except BlockingIOError:
+                return None
+
+        token = wait_for_lock(try_acquire, lock_deadline(timeout))
+        if token is None:
+            lock_file.close()
+        return token
+
+    def release(self, key, token):
+        fcntl.flock(token, fcntl.LOCK_UN)
+        token.close()
+
+    def _path(self, kind, key):
+        return os.path.join(self.directory, kind, key_name(key))
+
+    def _publish(self, path, ttl, write):
+        """Write an entry to a temporary file and atomically move it into place, expiring after ttl seconds"""
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            write(temp_path)
+            expires_at = time.time() + ttl
+            os.utime(temp_path, (expires_at, expires_at))
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        self._sweep()
+
+    def _sweep(self):
+        now = time.time()
+        if now - self._last_sweep < SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for kind in ("values", "files"):
+            for dir_entry in os.scandir(os.path.join(self.directory, kind)):
+                try:
+                    if not dir_entry.name.endswith(".tmp") and dir_entry.stat().st_mtime < now:
+                        os.remove(dir_entry.path)
+                except FileNotFoundError:  # Removed by another worker
+                    pass
+
+
+class NetworkBackend:
+    """Values, files and locks in a Redis-compatible key-value store shared by every node
+
+    Only GET, SET (with NX and PX), and EVAL of the lock release script are used. Files are stored as single values,
+    so only those up to max_file_bytes are shared.
+    """
+
+    shared = True
+
+    def __init__(self, client, max_file_bytes, prefix="podcast_proxy:"):
+        self.client = client
+        self.max_file_bytes = max_file_bytes
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self._name("value", key))
+
+    def set(self, key, value, ttl):
+        self.client.set(self._name("value", key), value, px=int(ttl * 1000))
+
+    def get_file(self, key, path):
+        data = self.client.get(self._name("file", key))
+        if data is None:
+            return False
+        with open(path, "wb") as file:
+            file.write(data)
+        return True
+
+    def put_file(self, key, path, ttl):
+        if os.path.getsize(path) > self.max_file_bytes:
+            return
+        with open(path, "rb") as file:
+            self.client.set(self._name("file", key), file.read(), px=int(ttl * 1000))
+
+    def acquire(self, key, ttl, timeout):
+        name, token = self._name("lock", key), secrets.token_hex(16)
+        return wait_for_lock(
+            lambda: token if self.client.set(name, token, nx=True, px=int(ttl * 1000)) else None,
+            lock_deadline(timeout),
+        )
+
+    def release(self, key, token):
+        self.client.eval(RELEASE_SCRIPT, 1, self._name("lock", key), token)
+
+    def _name(self, kind, key):
+        return f"{self.prefix}{kind}:{key_name(key)}"
+
+
+def create_backend(kind, directory, url, max_file_bytes, cache_dir=None):
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "file":
+        return FileBackend(directory, cache_dir)
+    if kind == "redis":
+        if redis is None:
+            raise ValueError("The redis shared cache backend needs the redis extra installed")
+        return NetworkBackend(redis.Redis.from_url(url), max_file_bytes)
+    raise ValueError(f"Unknown shared cache backend: {kind}")
+
+
+class SharedLock:
+    """Lock held by one thread of the whole cluster, expiring after ttl seconds in case its holder never releases it"""
+
+    def __init__(self, cache, key, ttl):
+        self._cache = cache
+        self.key = key
+        self.ttl = ttl
+        self._backend = None
+        self._token = None
+
+    def acquire(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for the lock, returning whether it was acquired
+
+        If the backend fails the lock counts as acquired, so work is only duplicated rather than blocked.
+        """
+        self._backend = self._cache.backend
+        try:
+            self._token = self._backend.acquire(self.key, self.ttl, timeout)
+        except Exception as e:
+            logging.error(f"Error acquiring shared lock {self.key}: {e}")
+            self._backend = None
+            return True
+        return self._token is not None
+
+    def release(self):
+        if self._token is None:
+            return
+        token, self._token = self._token, None
+        try:
+            self._backend.release(self.key, token)
+        except Exception as e:
+            logging.error(f"Error releasing shared lock {self.key}: {e}")
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SharedCache:
+    """Cache shared by server workers and nodes, so feeds and videos are produced once per cluster
+
+    Backend errors are logged and treated as misses, so an unreachable backend only loses the sharing.
+    """
+
+    def __init__(self):
+        self.backend = MemoryBackend()
+
+    def open(self, backend):
+        self.backend = backend
+
+    @property
+    def shared(self):
+        return self.backend.shared
+
+    def get(self, key):
+        try:
+            return self.backend.get(key)
+        except Exception as e:
+            logging.error(f"Error reading {key} from shared cache: {e}")
+            return None
+
+    def set(self, key, value, ttl):
+        try:
+            self.backend.set(key, value, ttl)
+        except Exception as e:
+            logging.error(f"Error writing {key} to shared cache: {e}")
+
+    def get_file(self, key, path):
+        """Copy a shared file to a local path, returning whether it was shared"""
+        try:
+            return self.backend.get_file(key, path)
+        except Exception as e:
+            logging.error(f"Error reading {key} from shared cache: {e}")
+            return False
+
+    def put_file(self, key, path, ttl):
+        try:
+            self.backend.put_file(key, path, ttl)
+        except Exception as e:
+            logging.error(f"Error writing {key} to shared cache: {e}")
+
+    def lock(self, key, ttl):
+        return SharedLock(self, key, ttl)
+
+
+shared_cache = SharedCache()
@@ -0,0 +1,199 @@
+import socket
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from urllib3.exceptions import NameResolutionError
+from urllib3.poolmanager import PoolManager, ProxyManager
+from urllib3.util import Retry
+
+# Keep idle pooled connections (and CONNECT tunnels through EXTERNAL_PROXY) alive, and notice dead ones
+KEEPALIVE_SOCKET_OPTIONS = HTTPConnection.default_socket_options + [
+    (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+]
+
+
+def parse_host_pool_sizes(value):
+    """Parse per-host pool sizes given as "host=size,host=size" """
+    host_pool_sizes = {}
+    for item in filter(None, (item.strip() for item in value.split(","))):
+        host, _, size = item.partition("=")
+        host_pool_sizes[host.strip().lower()] = int(size)
+    return host_pool_sizes
+
+
+class PinnedAddressMixin:
+    """Connects to the addresses the resolver validated, so DNS can't change between checking a host and using it"""
+
+    def __init__(self, *args, resolver, **kwargs):
+        self.resolver = resolver
+        super().__init__(*args, **kwargs)
+
+    def _new_conn(self):
+        try:
+            # Raises ValueError for private addresses, which isn't retried like connection errors
+            addresses = self.resolver.resolve_public(self._dns_host)
+        except socket.gaierror as e:
+            raise NameResolutionError(self.host, self, e) from e
+
+        host = self._dns_host
+        try:
+            for address in addresses[:-1]:
+                self._dns_host = address
+                try:
+                    return super()._new_conn()
+                except OSError:  # Try the host's next address
+                    pass
+            self._dns_host = addresses[-1]
+            return super()._new_conn()
+        finally:
+            self._dns_host = host
+
+
+class PinnedHTTPConnection(PinnedAddressMixin, HTTPConnection):
+    pass
+
+
+class PinnedHTTPSConnection(PinnedAddressMixin, HTTPSConnection):
+    pass
+
+
+class PinnedHTTPConnectionPool(HTTPConnectionPool):
+    ConnectionCls = PinnedHTTPConnection
+
+
+class PinnedHTTPSConnectionPool(HTTPSConnectionPool):
+    ConnectionCls = PinnedHTTPSConnection
+
+
+class HostPoolSizesMixin:
+    """Sizes each host's connection pool from host_pool_sizes, matching subdomains of configured hosts"""
+
+    host_pool_sizes = {}
+    resolver = None
+
+    def _new_pool(self, scheme, host, port, request_context=None):
+        request_context = dict(request_context or self.connection_pool_kw)
+        pool_size = self.pool_size_for(host)
+        if pool_size:
+            request_context["maxsize"] = pool_size
+        if self.resolver is not None:
+            request_context["resolver"] = self.resolver
+        return super()._new_pool(scheme, host, port, request_context)
+
+    def pool_size_for(self, host):
+        host = host.lower()
+        for configured_host, pool_size in self.host_pool_sizes.items():
+            if host == configured_host or host.endswith(f".{configured_host}"):
+                return pool_size
+        return None
+
+
+class UpstreamPoolManager(HostPoolSizesMixin, PoolManager):
+    def use_resolver(self, resolver):
+        """Connect directly to upstream hosts only through addresses validated by resolver"""
+        self.resolver = resolver
+        self.pool_classes_by_scheme = {
+            "http": PinnedHTTPConnectionPool,
+            "https": PinnedHTTPSConnectionPool,
+        }
+
+
+class UpstreamProxyManager(HostPoolSizesMixin, ProxyManager):
+    """HTTPS requests through the proxy are pooled per destination host, so CONNECT tunnels are reused like connections
+
+    The proxy resolves upstream hosts itself, so their addresses are not pinned.
+    """
+
+
+class CappedRetry(Retry):
+    """Honour Retry-After on 429/503 responses, but never wait longer than the backoff maximum"""
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None:
+            return None
+        return min(retry_after, self.backoff_max)
+
+
+class UpstreamAdapter(HTTPAdapter):
+    """Transport adapter with per-host pool sizes, TCP keep-alive and default timeouts for upstream requests"""
+
+    def __init__(self, pool_hosts, pool_size, host_pool_sizes, retries, backoff, timeout, resolver=None):
+        self.host_pool_sizes = host_pool_sizes
+        self.timeout = timeout
+        self.resolver = resolver
+        super().__init__(
+            pool_connections=pool_hosts,
+            pool_maxsize=pool_size,
+            max_retries=CappedRetry(
+                total=retries,
+                backoff_factor=backoff,
+                status_forcelist=(429, 502, 503, 504),
+                allowed_methods={"GET", "HEAD"},
+                raise_on_status=False,  # Hand the last response to raise_for_status
+            ),
+        )
+
+    def init_poolmanager(self, connections, maxsize, block=False, **pool_kwargs):
+        self._pool_connections = connections
+        self._pool_maxsize = maxsize
+        self._pool_block = block
+        self.poolmanager = UpstreamPoolManager(
+            num_pools=connections,
+            maxsize=maxsize,
+            block=block,
+            socket_options=KEEPALIVE_SOCKET_OPTIONS,
+            **pool_kwargs,
+        )
+        self.poolmanager.host_pool_sizes = self.host_pool_sizes
+        if self.resolver is not None:
+            self.poolmanager.use_resolver(self.resolver)
+
+    def proxy_manager_for(self, proxy, **proxy_kwargs):
+        if proxy not in self.proxy_manager and not proxy.lower().startswith("socks"):
+            proxy_headers = self.proxy_headers(proxy)
+            manager = UpstreamProxyManager(
+                proxy,
+                proxy_headers=proxy_headers,
+                num_pools=self._pool_connections,
+                maxsize=self._pool_maxsize,
+                block=self._pool_block,
+                socket_options=KEEPALIVE_SOCKET_OPTIONS,
+                **proxy_kwargs,
+            )
+            manager.host_pool_sizes = self.host_pool_sizes
+            self.proxy_manager[proxy] = manager
+        return super().proxy_manager_for(proxy, **proxy_kwargs)
+
+    def send(self, request, timeout=None, **kwargs):
+        return super().send(request, timeout=timeout or self.timeout, **kwargs)
+
+
+def create_session(
+    pool_hosts,
+    pool_size,
+    host_pool_sizes,
+    retries,
+    backoff,
+    connect_timeout,
+    read_timeout,
+    resolver=None,
+):
+    """Session shared by feed and stream requests, so connections to busy hosts stay warm between requests
+
+    Given a HostResolver, direct connections are only made to its cached public addresses of the upstream host.
+    """
+    session = requests.Session()
+    adapter = UpstreamAdapter(
+        pool_hosts,
+        pool_size,
+        host_pool_sizes,
+        retries,
+        backoff,
+        (connect_timeout, read_timeout),
+        resolver,
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
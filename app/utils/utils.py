@@ -1,24 +1,31 @@
 import magic
 import validators
-import ipaddress
-import socket
 from urllib.parse import urlparse
+from .metrics import metrics
+from .resolver import host_resolver, is_private_address
 
 
-def check_hostname(url):
-    """Checks if URL is safe to stream from"""
+def check_url(url):
+    """Checks a URL is well formed and doesn't name a private IP address, without resolving its host"""
     if not validators.url(url):
         raise ValueError(f"URL could not be validated: {url}")
 
-    parsed_url = urlparse(url)
+    hostname = urlparse(url).hostname
+    try:
+        private = is_private_address(hostname)
+    except ValueError:
+        return  # A host name rather than an address
+    if private:
+        raise ValueError(f"Attempted to use bad host: {hostname}")
 
-    def is_private_ip(host):
-        ip = ipaddress.ip_address(host)
-        return ip.is_private or ip.is_loopback or ip.is_reserved or ip.is_link_local
 
-    ip = socket.gethostbyname(parsed_url.hostname)
-    if is_private_ip(ip):
-        raise ValueError(f"Attempted to use bad host: {parsed_url.hostname} {ip}")
+def check_hostname(url):
+    """Checks if URL is safe to stream from"""
+    with metrics.time("check_hostname"):
+        check_url(url)
+
+        # Every address is checked, as the connection may use any of them
+        host_resolver.resolve_public(urlparse(url).hostname)
 
 
 def filter_headers(headers):
@@ -34,9 +41,67 @@ def filter_headers(headers):
     return {header: value for header, value in headers if header in allowed_headers}
 
 
+MP4_AUDIO_BRANDS = {b"M4A ", b"M4B ", b"M4P "}
+# Types libmagic gives files it doesn't recognise, such as MPEG audio streams starting part way through a frame
+GENERIC_MIME_TYPES = {"application/octet-stream"}
+# libmagic names for audio types, by the name streams are checked against
+LIBMAGIC_AUDIO_TYPES = {
+    "audio/x-hx-aac-adts": "audio/aac",
+    "audio/x-m4a": "audio/mp4",
+    "audio/x-wav": "audio/wav",
+}
+
+
+def detect_audio_mime(file_bytes):
+    """Recognises common audio formats from their magic numbers, returning None for anything else"""
+    if file_bytes[:3] == b"ID3":
+        return "audio/mpeg"
+    if file_bytes[:4] == b"OggS":
+        return "audio/ogg"
+    if file_bytes[:4] == b"RIFF" and file_bytes[8:12] == b"WAVE":
+        return "audio/wav"
+    if file_bytes[4:8] == b"ftyp" and file_bytes[8:12] in MP4_AUDIO_BRANDS:
+        return "audio/mp4"
+    return None
+
+
+def detect_frame_mime(file_bytes):
+    """Recognises bytes starting with a valid MPEG audio or ADTS (AAC) frame header, returning None otherwise
+
+    Frame sync is only 11 bits, so the rest of the header is checked too: a UTF-16 byte order mark also starts with
+    them.
+    """
+    if len(file_bytes) < 4 or file_bytes[0] != 0xFF or file_bytes[1] & 0xE0 != 0xE0:
+        return None
+    version, layer = (file_bytes[1] >> 3) & 0x03, (file_bytes[1] >> 1) & 0x03
+    if layer == 0:  # ADTS, with a 12 bit sync and a sampling frequency index up to 12
+        if file_bytes[1] & 0xF0 != 0xF0 or (file_bytes[2] >> 2) & 0x0F > 12:
+            return None
+        return "audio/aac"
+    bitrate_index, sample_rate_index = file_bytes[2] >> 4, (file_bytes[2] >> 2) & 0x03
+    if version == 1 or bitrate_index in (0, 15) or sample_rate_index == 3:  # Reserved or free format
+        return None
+    return "audio/mpeg"
+
+
+def detect_file_mime(file_bytes):
+    """Detects the MIME type of given bytes, only falling back to libmagic for unrecognised formats
+
+    Bare MPEG frames are only trusted when libmagic can't tell what the bytes are.
+    """
+    detected_mime = detect_audio_mime(file_bytes)
+    if detected_mime:
+        return detected_mime
+    detected_mime = magic.from_buffer(bytes(file_bytes[:1024]), mime=True)
+    if detected_mime in GENERIC_MIME_TYPES:
+        return detect_frame_mime(file_bytes) or detected_mime
+    return LIBMAGIC_AUDIO_TYPES.get(detected_mime, detected_mime)
+
+
 def check_file_mime(file_bytes, allowed_mime_types):
-    """Checks given bytes are of an approved MIME type"""
-    detected_mime = magic.from_buffer(file_bytes[:1024], mime=True)
+    """Checks given bytes are of an approved MIME type, returning the detected type"""
+    detected_mime = detect_file_mime(file_bytes)
 
     if detected_mime not in allowed_mime_types:
         raise ValueError(f"Detected MIME type is not allowed: {detected_mime}")
+    return detected_mime
@@ -0,0 +1,61 @@
+"""Run the whole benchmark suite and write the results as JSON, tagged with the commit they were measured at
+
+    python -m benchmarks [--quick] [--output results.json]
+
+Compare two result files with python -m benchmarks.compare before.json after.json.
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from benchmarks import bench_feeds, bench_relay, bench_streams
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--quick", action="store_true", help="smaller inputs, for checking the suite runs")
+    parser.add_argument("--output", help="file to write results to instead of stdout")
+    args = parser.parse_args()
+
+    environment = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    if args.quick:
+        benchmarks = [
+            bench_feeds.run(item_counts=(10, 1000), repeats=2),
+            bench_relay.run(megabytes=64),
+            bench_streams.run(concurrency_levels=(1, 8), stream_megabytes=4),
+        ]
+    else:
+        benchmarks = [bench_feeds.run(), bench_relay.run(), bench_streams.run()]
+
+    output = json.dumps({"environment": environment, "benchmarks": benchmarks}, indent=2)
+    if args.output:
+        with open(args.output, "w") as output_file:
+            output_file.write(output + "\n")
+    else:
+        sys.stdout.write(output + "\n")
+    for benchmark in benchmarks:
+        if benchmark["benchmark"] == "streams":
+            bench_streams.check_completed(benchmark)
+
+
+if __name__ == "__main__":
+    main()
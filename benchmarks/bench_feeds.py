@@ -0,0 +1,144 @@
+"""Feed rewrite latency and peak memory for synthetic feeds of 10, 1,000 and 10,000 items
+
+Each case runs in a fresh interpreter so peak RSS isn't inflated by earlier cases. Cases:
+
+- rss: rewrite_rss_enclosure_urls on a whole podcast feed, as when caching it
+- rss_stream: iter_rewritten_rss over 64 KiB chunks without keeping the output, as when streaming it to a client
+- rss_window: rewrite_rss_enclosure_urls keeping only the newest 50 items, as for ?items=50
+- youtube: rewrite_youtube_feed on a channel's Atom feed, repeats reusing the converted items as a refresh does
+
+Run from the repository root:
+
+    python -m benchmarks.bench_feeds [--items 10 1000 10000] [--repeats 5]
+"""
+
+import argparse
+import gc
+import json
+import multiprocessing
+import resource
+import statistics
+import tempfile
+import time
+from benchmarks.feeds import podcast_feed, youtube_feed
+
+CASES = ("rss", "rss_stream", "rss_window", "youtube")
+WINDOW_ITEMS = 50
+PROXY_FEED_URL = "https://proxy.example.com/feed/feeds.example.com/synthetic"
+
+
+def reset_peak_rss():
+    """Reset the kernel's peak RSS of this process, returning False where that isn't supported"""
+    try:
+        with open("/proc/self/clear_refs", "w") as clear_refs:
+            clear_refs.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def peak_rss_bytes():
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def current_rss_bytes():
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return peak_rss_bytes()
+
+
+def measure_case(case, items, repeats):
+    """Time one case in this process, which should be fresh, returning a result dict"""
+    import app
+    from app.feed.routes import iter_rewritten_rss, rewrite_rss_enclosure_urls, rewrite_youtube_feed
+    from app.feed.window import ItemWindow
+
+    app.CACHE_DIR = tempfile.mkdtemp(prefix="podcast-proxy-bench-")
+    flask_app = app.create_app()
+
+    if case == "youtube":
+        feed_content = youtube_feed(items)
+
+        def rewrite():
+            return len(rewrite_youtube_feed(feed_content))
+
+    elif case == "rss":
+        feed_content = podcast_feed(items)
+
+        def rewrite():
+            return len(rewrite_rss_enclosure_urls(feed_content, PROXY_FEED_URL))
+
+    elif case == "rss_window":
+        feed_content = podcast_feed(items)
+        item_window = ItemWindow(max_items=WINDOW_ITEMS)
+
+        def rewrite():
+            return len(rewrite_rss_enclosure_urls(feed_content, PROXY_FEED_URL, item_window))
+
+    else:
+        feed_content = podcast_feed(items)
+
+        def rewrite():
+            chunks = (feed_content[i : i + 65536] for i in range(0, len(feed_content), 65536))
+            return sum(len(chunk) for chunk in iter_rewritten_rss(chunks, PROXY_FEED_URL))
+
+    with flask_app.test_request_context(base_url="https://proxy.example.com"):
+        gc.collect()
+        baseline_rss = current_rss_bytes()
+        exact_peak = reset_peak_rss()
+        start = time.perf_counter()
+        output_bytes = rewrite()
+        first_seconds = time.perf_counter() - start
+        peak_increase = peak_rss_bytes() - baseline_rss
+
+        durations = [first_seconds]
+        for _ in range(repeats - 1):
+            start = time.perf_counter()
+            rewrite()
+            durations.append(time.perf_counter() - start)
+
+    median_seconds = statistics.median(durations)
+    return {
+        "case": case,
+        "items": items,
+        "input_bytes": len(feed_content),
+        "output_bytes": output_bytes,
+        "repeats": len(durations),
+        "min_ms": round(min(durations) * 1000, 3),
+        "median_ms": round(median_seconds * 1000, 3),
+        "items_per_second": round(items / median_seconds),
+        "peak_rss_increase_mb": round(peak_increase / 1e6, 2),
+        "peak_rss_exact": exact_peak,  # False: measured against the process's earlier peak, so may be overstated
+    }
+
+
+def run(item_counts=(10, 1000, 10000), repeats=5, cases=CASES):
+    results = []
+    spawn = multiprocessing.get_context("spawn")
+    for case in cases:
+        for items in item_counts:
+            with spawn.Pool(1) as pool:
+                results.append(pool.apply(measure_case, (case, items, repeats)))
+    return {"benchmark": "feeds", "results": results}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, nargs="+", default=[10, 1000, 10000])
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--cases", nargs="+", choices=CASES, default=list(CASES))
+    args = parser.parse_args()
+    print(json.dumps(run(args.items, args.repeats, args.cases), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Micro-benchmark of the episode relay loop: CPU seconds per GB relayed from a local origin
+
+Compares the previous 8 KiB iter_content relay with iter_upstream_chunks. The origin runs in a separate process so
+only the relay's CPU time is measured. Run from the repository root:
+
+    python -m benchmarks.bench_relay [--megabytes 512]
+"""
+
+import argparse
+import json
+import time
+import requests
+from app.stream.routes import iter_upstream_chunks
+from benchmarks.origin import start_origin
+
+
+def measure(name, url, relay):
+    upstream_response = requests.get(url, stream=True)
+    cpu_start, wall_start = time.process_time(), time.perf_counter()
+    relayed_bytes = chunks = 0
+    for chunk in relay(upstream_response):
+        relayed_bytes += len(chunk)
+        chunks += 1
+    cpu, wall = time.process_time() - cpu_start, time.perf_counter() - wall_start
+    return {
+        "relay": name,
+        "bytes": relayed_bytes,
+        "chunks": chunks,
+        "cpu_seconds_per_gb": round(cpu / (relayed_bytes / 1e9), 3),
+        "megabytes_per_second": round(relayed_bytes / wall / 1e6, 1),
+    }
+
+
+def run(megabytes=512, max_chunk_size=1024 * 1024):
+    origin, url = start_origin(megabytes * 1024 * 1024)
+    try:
+        results = [
+            measure("iter_content_8k", url, lambda response: response.iter_content(8192)),
+            measure(
+                "iter_upstream_chunks",
+                url,
+                lambda response: iter_upstream_chunks(response, 64 * 1024, max_chunk_size),
+            ),
+        ]
+    finally:
+        origin.terminate()
+
+    baseline, relay = results
+    return {
+        "benchmark": "relay",
+        "results": results,
+        "cpu_per_gb_speedup": round(
+            baseline["cpu_seconds_per_gb"] / relay["cpu_seconds_per_gb"], 2
+        ),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--megabytes", type=int, default=512)
+    parser.add_argument("--max-chunk-size", type=int, default=1024 * 1024)
+    args = parser.parse_args()
+    print(json.dumps(run(args.megabytes, args.max_chunk_size), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""Concurrent stream capacity: many clients streaming episode ranges through the proxy from a local origin
+
+The proxy runs as a real server in its own process, the Flask app under werkzeug's threaded server or the ASGI app
+under uvicorn, so its CPU time can be measured apart from the clients. Loopback addresses are refused by the
+safety checks, so the server process skips the host check and connects without address pinning; everything else
+is the production stream path. Run from the repository root:
+
+    python -m benchmarks.bench_streams [--server flask|asgi] [--concurrency 1 8 32 64] [--stream-megabytes 16]
+
+A concurrency level is within capacity when every stream completed and the 95th percentile time to first byte is
+at most --max-ttfb seconds. If no stream completes at some level, the levels are listed as broken and the run exits
+with an error.
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from benchmarks.origin import free_port, start_origin, wait_for_port
+
+EPISODE_BYTES = 256 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def serve_proxy(port, server, safety_check):
+    import app
+
+    app.CACHE_DIR = tempfile.mkdtemp(prefix="podcast-proxy-bench-")
+    app.ENABLE_STREAMING_SAFETY_CHECK = safety_check
+    app.session = app.create_session(
+        app.UPSTREAM_POOL_HOSTS,
+        app.UPSTREAM_POOL_SIZE,
+        app.parse_host_pool_sizes(app.UPSTREAM_HOST_POOL_SIZES),
+        app.UPSTREAM_RETRIES,
+        app.UPSTREAM_RETRY_BACKOFF,
+        app.UPSTREAM_CONNECT_TIMEOUT,
+        app.UPSTREAM_READ_TIMEOUT,
+    )
+
+    import app.stream.routes
+
+    app.stream.routes.check_hostname = lambda url: None
+    flask_app = app.create_app()
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if server == "asgi":
+        import uvicorn
+        import app.asgi
+
+        app.asgi.check_hostname = lambda url: None
+        uvicorn.run(app.asgi.StreamingApp(flask_app), host="127.0.0.1", port=port, log_level="warning")
+    else:
+        from werkzeug.serving import make_server
+
+        logging.getLogger("werkzeug").setLevel(logging.WARNING)
+        make_server("127.0.0.1", port, flask_app, threaded=True).serve_forever()
+
+
+def process_cpu_seconds(pid):
+    """User and system CPU time of a process, or None where /proc isn't available"""
+    try:
+        with open(f"/proc/{pid}/stat") as stat:
+            fields = stat.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def stream_once(url, start, length):
+    """Stream one range through the proxy, returning (time to first byte, seconds, bytes) or None if it failed"""
+    request_start = time.perf_counter()
+    try:
+        with requests.get(
+            url, headers={"Range": f"bytes={start}-{start + length - 1}"}, stream=True, timeout=60
+        ) as response:
+            if response.status_code != 206:
+                return None
+            received = 0
+            first_byte = None
+            while chunk := response.raw.read(READ_SIZE):
+                if first_byte is None:
+                    first_byte = time.perf_counter() - request_start
+                received += len(chunk)
+    except requests.RequestException:
+        return None
+    if received != length:
+        return None
+    return first_byte, time.perf_counter() - request_start, received
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))]
+
+
+def measure_level(url, server_pid, concurrency, stream_bytes, max_ttfb):
+    starts = [
+        (index * 7919 * 1024 * 1024) % (EPISODE_BYTES - stream_bytes) for index in range(concurrency)
+    ]
+    cpu_start, wall_start = process_cpu_seconds(server_pid), time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        streams = list(executor.map(lambda start: stream_once(url, start, stream_bytes), starts))
+    wall = time.perf_counter() - wall_start
+    cpu_end = process_cpu_seconds(server_pid)
+
+    completed = [stream for stream in streams if stream is not None]
+    relayed_bytes = sum(received for _, _, received in completed)
+    ttfbs = [first_byte for first_byte, _, _ in completed]
+    result = {
+        "concurrency": concurrency,
+        "completed": len(completed),
+        "failed": concurrency - len(completed),
+        "megabytes_per_second": round(relayed_bytes / wall / 1e6, 1),
+        "min_stream_megabytes_per_second": round(
+            min((received / seconds for _, seconds, received in completed), default=0) / 1e6, 2
+        ),
+        "ttfb_p50_ms": round(statistics.median(ttfbs) * 1000, 1) if ttfbs else None,
+        "ttfb_p95_ms": round(percentile(ttfbs, 0.95) * 1000, 1) if ttfbs else None,
+        "server_cpu_seconds_per_gb": (
+            round((cpu_end - cpu_start) / (relayed_bytes / 1e9), 3)
+            if cpu_start is not None and relayed_bytes
+            else None
+        ),
+    }
+    result["within_capacity"] = not result["failed"] and percentile(ttfbs, 0.95) <= max_ttfb
+    return result
+
+
+def run(server="flask", concurrency_levels=(1, 8, 32, 64), stream_megabytes=16, max_ttfb=1.0, safety_check=True):
+    origin, origin_url = start_origin(EPISODE_BYTES)
+    port = free_port()
+    proxy = multiprocessing.get_context("spawn").Process(
+        target=serve_proxy, args=(port, server, safety_check), daemon=True
+    )
+    proxy.start()
+    try:
+        wait_for_port(port, timeout=30)
+        from app.stream.tokens import stream_tokens
+
+        url = f"http://127.0.0.1:{port}/stream/{stream_tokens.encode(origin_url)}"
+        stream_once(url, 0, READ_SIZE)  # Warm up connections and caches
+        results = [
+            measure_level(url, proxy.pid, concurrency, stream_megabytes * 1024 * 1024, max_ttfb)
+            for concurrency in concurrency_levels
+        ]
+    finally:
+        proxy.terminate()
+        origin.terminate()
+
+    within_capacity = [result["concurrency"] for result in results if result["within_capacity"]]
+    # Levels where no stream got through measure a broken proxy, not its capacity
+    broken_levels = [result["concurrency"] for result in results if not result["completed"]]
+    return {
+        "benchmark": "streams",
+        "server": server,
+        "safety_check": safety_check,
+        "stream_megabytes": stream_megabytes,
+        "results": results,
+        "capacity": max(within_capacity, default=0),
+        "broken_levels": broken_levels,
+    }
+
+
+def check_completed(result):
+    """Exit with an error if every stream failed at any concurrency level of a run"""
+    if result["broken_levels"]:
+        sys.exit(f"Every stream failed at concurrency {result['broken_levels']}, the results are not valid")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--server", choices=("flask", "asgi"), default="flask")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--stream-megabytes", type=int, default=16)
+    parser.add_argument("--max-ttfb", type=float, default=1.0)
+    parser.add_argument("--no-safety-check", dest="safety_check", action="store_false")
+    args = parser.parse_args()
+    result = run(args.server, args.concurrency, args.stream_megabytes, args.max_ttfb, args.safety_check)
+    print(json.dumps(result, indent=2))
+    check_completed(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""Compare two benchmark result files, printing the relative change of each measurement as JSON
+
+    python -m benchmarks.compare before.json after.json
+
+Results are matched by benchmark and the fields identifying a case (case and items, relay, concurrency). Changes
+are after / before, so for times and CPU costs below 1 is better, and for throughputs above 1 is better.
+"""
+
+import argparse
+import json
+
+CASE_FIELDS = ("case", "items", "relay", "concurrency")
+MEASUREMENTS = (
+    "median_ms",
+    "peak_rss_increase_mb",
+    "cpu_seconds_per_gb",
+    "megabytes_per_second",
+    "ttfb_p95_ms",
+    "server_cpu_seconds_per_gb",
+)
+
+
+def indexed_results(results_file):
+    with open(results_file) as results:
+        benchmarks = json.load(results)["benchmarks"]
+    return {
+        (benchmark["benchmark"], *(result.get(field) for field in CASE_FIELDS)): result
+        for benchmark in benchmarks
+        for result in benchmark["results"]
+    }
+
+
+def compare(before_file, after_file):
+    before, after = indexed_results(before_file), indexed_results(after_file)
+    changes = []
+    for key, after_result in after.items():
+        before_result = before.get(key)
+        if before_result is None:
+            continue
+        case = {field: value for field, value in zip(("benchmark", *CASE_FIELDS), key) if value is not None}
+        for measurement in MEASUREMENTS:
+            old, new = before_result.get(measurement), after_result.get(measurement)
+            if old and new is not None:
+                changes.append(
+                    {**case, "measurement": measurement, "before": old, "after": new, "change": round(new / old, 3)}
+                )
+    return changes
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("before")
+    parser.add_argument("after")
+    args = parser.parse_args()
+    print(json.dumps(compare(args.before, args.after), indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Synthetic podcast RSS and YouTube Atom feeds shaped like real ones, for benchmarking feed rewriting"""
+
+from datetime import datetime, timedelta, timezone
+from xml.sax.saxutils import escape
+
+DESCRIPTION = escape(
+    "In this episode we talk about <b>benchmarks</b>, caching & streaming. "
+    "Show notes, sponsors and links to everything mentioned are on our website. " * 4
+)
+
+
+def podcast_feed(items):
+    """RSS feed of a podcast with items episodes, newest first, with tracking-prefixed enclosures"""
+    published = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    entries = []
+    for number in range(items, 0, -1):
+        pub_date = (published + timedelta(days=number)).strftime("%a, %d %b %Y %H:%M:%S +0000")
+        entries.append(
+            f"""    <item>
+      <title>Episode {number}: Synthetic episode title</title>
+      <description><![CDATA[<p>{DESCRIPTION}</p>]]></description>
+      <pubDate>{pub_date}</pubDate>
+      <guid isPermaLink="false">synthetic-episode-{number}</guid>
+      <link>https://podcast.example.com/episodes/{number}</link>
+      <itunes:duration>3600</itunes:duration>
+      <itunes:episode>{number}</itunes:episode>
+      <enclosure url="https://dts.podtrac.com/redirect.mp3/traffic.megaphone.fm/SYN{number:08d}.mp3?updated=1700000000" length="57600000" type="audio/mpeg"/>
+    </item>
+"""
+        )
+    return (
+        """<?xml version="1.0" encoding="UTF-8"?>
+<rss version="2.0" xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd" xmlns:atom="http://www.w3.org/2005/Atom">
+  <channel>
+    <title>Synthetic Podcast</title>
+    <link>https://podcast.example.com</link>
+    <atom:link href="https://feeds.example.com/synthetic" rel="self" type="application/rss+xml"/>
+    <itunes:new-feed-url>https://feeds.example.com/moved</itunes:new-feed-url>
+    <description>A podcast generated for benchmarks</description>
+    <itunes:author>Benchmark Author</itunes:author>
+"""
+        + "".join(entries)
+        + """  </channel>
+</rss>
+"""
+    ).encode()
+
+
+def youtube_feed(entries):
+    """Atom feed of a YouTube channel with entries videos, newest first"""
+    channel_id = "UCsyntheticchannel000000"
+    published = datetime(2025, 1, 1, tzinfo=timezone.utc)
+    videos = []
+    for number in range(entries, 0, -1):
+        video_id = f"vid{number:08d}"
+        timestamp = (published + timedelta(hours=number)).isoformat()
+        videos.append(
+            f"""  <entry>
+    <id>yt:video:{video_id}</id>
+    <yt:videoId>{video_id}</yt:videoId>
+    <yt:channelId>{channel_id}</yt:channelId>
+    <title>Synthetic video {number}</title>
+    <link rel="alternate" href="https://www.youtube.com/watch?v={video_id}"/>
+    <author>
+      <name>Benchmark Author</name>
+      <uri>https://www.youtube.com/channel/{channel_id}</uri>
+    </author>
+    <published>{timestamp}</published>
+    <updated>{timestamp}</updated>
+    <media:group>
+      <media:title>Synthetic video {number}</media:title>
+      <media:content url="https://www.youtube.com/v/{video_id}?version=3" type="application/x-shockwave-flash" width="640" height="390"/>
+      <media:thumbnail url="https://i4.ytimg.com/vi/{video_id}/hqdefault.jpg" width="480" height="360"/>
+      <media:description>{DESCRIPTION}</media:description>
+    </media:group>
+  </entry>
+"""
+        )
+    return (
+        f"""<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns:yt="http://www.youtube.com/xml/schemas/2015" xmlns:media="http://search.yahoo.com/mrss/" xmlns="http://www.w3.org/2005/Atom">
+  <link rel="self" href="http://www.youtube.com/feeds/videos.xml?channel_id={channel_id}"/>
+  <id>yt:channel:{channel_id}</id>
+  <yt:channelId>{channel_id}</yt:channelId>
+  <title>Synthetic Channel</title>
+  <link rel="alternate" href="https://www.youtube.com/channel/{channel_id}"/>
+  <author>
+    <name>Benchmark Author</name>
+    <uri>https://www.youtube.com/channel/{channel_id}</uri>
+  </author>
+  <published>2025-01-01T00:00:00+00:00</published>
+"""
+        + "".join(videos)
+        + "</feed>\n"
+    ).encode()
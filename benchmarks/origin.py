@@ -0,0 +1,77 @@
+"""Local stand-in for a podcast host, serving a large synthetic episode with Range support
+
+The origin runs in a separate process so its CPU time isn't counted against the code being measured.
+"""
+
+import multiprocessing
+import socket
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from werkzeug.http import parse_range_header
+
+# 128 kbps 44.1 kHz MPEG-1 Layer III frames of silence, so the safety check accepts the episode as audio/mpeg
+MPEG_FRAME = b"\xff\xfb\x90\x64".ljust(417, b"\x00")
+ORIGIN_BLOCK = MPEG_FRAME * (1024 * 1024 // len(MPEG_FRAME))
+
+
+def free_port():
+    with socket.socket() as probe:
+        probe.bind(("127.0.0.1", 0))
+        return probe.getsockname()[1]
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise TimeoutError(f"Nothing listening on port {port}")
+
+
+def serve_origin(port, size):
+    class OriginHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            start, stop = 0, size
+            byte_range = parse_range_header(self.headers.get("Range"))
+            if byte_range and byte_range.range_for_length(size):
+                start, stop = byte_range.range_for_length(size)
+                self.send_response(206)
+                self.send_header("Content-Range", byte_range.to_content_range_header(size))
+            else:
+                self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("Content-Length", str(stop - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.end_headers()
+
+            remaining = stop - start
+            offset = start % len(ORIGIN_BLOCK)
+            try:
+                while remaining:
+                    block = ORIGIN_BLOCK[offset : offset + remaining]
+                    self.wfile.write(block)
+                    remaining -= len(block)
+                    offset = 0
+            except (BrokenPipeError, ConnectionResetError):
+                pass
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), OriginHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def start_origin(size):
+    """Start an origin serving size bytes at any path, returning its process and the episode URL"""
+    port = free_port()
+    origin = multiprocessing.Process(target=serve_origin, args=(port, size), daemon=True)
+    origin.start()
+    wait_for_port(port)
+    return origin, f"http://127.0.0.1:{port}/episode.mp3"
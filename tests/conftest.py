@@ -7,10 +7,14 @@ import pytest
 sys.path.insert(0, str(Path(__file__).parent.parent))
 
 from app import create_app
+from app.feed.cache import feed_cache
+from app.feed.routes import youtube_items
+from app.utils.shared_cache import FileBackend, MemoryBackend, shared_cache
 
 
 @pytest.fixture()
-def app():
+def app(monkeypatch, tmp_path):
+    monkeypatch.setattr("app.CACHE_DIR", str(tmp_path / "cache"))
     app = create_app()
     app.config.update(
         {
@@ -23,3 +27,21 @@ def app():
 @pytest.fixture
 def client(app):
     return app.test_client()
+
+
+@pytest.fixture(autouse=True)
+def clear_feed_cache():
+    feed_cache.clear()
+    youtube_items.clear()
+    yield
+    feed_cache.clear()
+    youtube_items.clear()
+
+
+@pytest.fixture
+def shared_backend(tmp_path):
+    """Shared cache in a directory, as used by server workers on one host"""
+    backend = FileBackend(str(tmp_path / "shared"))
+    shared_cache.open(backend)
+    yield backend
+    shared_cache.open(MemoryBackend())
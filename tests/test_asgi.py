@@ -0,0 +1,114 @@
+import asyncio
+import base64
+from unittest.mock import patch
+import pytest
+
+httpx = pytest.importorskip("httpx")
+pytest.importorskip("asgiref")
+
+from app.asgi import StreamingApp
+
+AUDIO = b"ID3" + bytes(range(256)) * 100
+upstream_paths = []
+
+
+def upstream_handler(request):
+    upstream_paths.append(request.url.path)
+    if request.url.path == "/missing.mp3":
+        return httpx.Response(404)
+    if request.url.path == "/track/audio.mp3":
+        return httpx.Response(302, headers={"Location": "https://cdn.example.com/audio.mp3"})
+    return httpx.Response(
+        200,
+        headers={"Content-Type": "audio/mpeg", "Connection": "keep-alive"},
+        stream=httpx.ByteStream(AUDIO),
+    )
+
+
+def call_asgi(asgi_app, path):
+    messages = []
+    requests = [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if requests:
+            return requests.pop()
+        await asyncio.Event().wait()  # Client stays connected
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "scheme": "http",
+        "server": ("localhost", 80),
+        "root_path": "",
+        "method": "GET",
+        "path": path,
+        "query_string": b"",
+        "headers": [(b"user-agent", b"test"), (b"cookie", b"secret")],
+    }
+    asyncio.run(asgi_app(scope, receive, send))
+    return messages
+
+
+def stream_path(url):
+    return f"/stream/{base64.urlsafe_b64encode(url.encode()).decode()}"
+
+
+@pytest.fixture
+def asgi_app(app):
+    return StreamingApp(
+        app,
+        upstream_client_factory=lambda: httpx.AsyncClient(
+            transport=httpx.MockTransport(upstream_handler), follow_redirects=True
+        ),
+    )
+
+
+def test_asgi_relays_generic_stream(asgi_app):
+    with patch("app.asgi.check_hostname"):
+        messages = call_asgi(asgi_app, stream_path("https://example.com/audio.mp3"))
+
+    start = messages[0]
+    headers = dict(start["headers"])
+    assert start["status"] == 200
+    assert headers[b"content-type"] == b"audio/mpeg"
+    assert b"connection" not in {name.lower() for name in headers}
+    assert b"".join(message.get("body", b"") for message in messages[1:]) == AUDIO
+    assert messages[-1].get("more_body", False) is False
+
+
+def test_asgi_safety_check_keeps_sniffed_bytes(asgi_app, monkeypatch):
+    monkeypatch.setattr("app.ENABLE_STREAMING_SAFETY_CHECK", True)
+    with patch("app.asgi.check_hostname"):
+        messages = call_asgi(asgi_app, stream_path("https://example.com/checked.mp3"))
+
+    assert messages[0]["status"] == 200
+    assert b"".join(message.get("body", b"") for message in messages[1:]) == AUDIO
+
+
+def test_asgi_caches_redirect_chain(asgi_app):
+    upstream_paths.clear()
+    with patch("app.asgi.check_hostname"):
+        for _ in range(2):
+            messages = call_asgi(asgi_app, stream_path("https://example.com/track/audio.mp3"))
+            assert messages[0]["status"] == 200
+
+    assert upstream_paths == ["/track/audio.mp3", "/audio.mp3", "/audio.mp3"]
+
+
+def test_asgi_upstream_error(asgi_app):
+    with patch("app.asgi.check_hostname"):
+        messages = call_asgi(asgi_app, stream_path("https://example.com/missing.mp3"))
+    assert messages[0]["status"] == 500
+
+
+def test_asgi_rejects_bad_host(asgi_app):
+    messages = call_asgi(asgi_app, stream_path("http://localhost/audio.mp3"))
+    assert messages[0]["status"] == 500
+
+
+def test_asgi_delegates_feeds_to_flask(asgi_app):
+    messages = call_asgi(asgi_app, "/")
+    assert messages[0]["status"] == 200
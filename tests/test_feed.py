@@ -1,27 +1,57 @@
-from unittest.mock import patch
+import io
+import gzip
+from unittest.mock import patch, Mock
+import pytest
+import requests
 from pathlib import Path
 from lxml import etree
-from app.feed.routes import rewrite_rss_enclosure_urls, rewrite_youtube_feed, XML_NAMESPACES
+from app.feed.routes import fetch_rss_feed, rewrite_rss_enclosure_urls, rewrite_youtube_feed, iter_rewritten_rss, refresh_feed, XML_NAMESPACES
+from app.feed.cache import CachedFeed, feed_cache
+from app.feed.refresher import FeedRefresher, TrackedFeed, feed_refresher
+from app.feed.window import ItemWindow
+from app.utils.shared_cache import FileBackend
 
 resources = Path(__file__).parent / "resources"
 
+def upstream_response(content, status_code=200, headers=None):
+    return Mock(status_code=status_code, headers=headers or {}), iter([content])
+
+def test_fetch_rss_feed_closes_rejected_responses():
+    html = Mock(status_code=200, headers={})
+    html.iter_content.return_value = iter([b'<!DOCTYPE html><html><body>Not a feed</body></html>'])
+    missing = Mock(status_code=404, headers={})
+    missing.raise_for_status.side_effect = requests.HTTPError("404 Not Found")
+
+    for response in (html, missing):
+        with patch('app.feed.routes.check_hostname'), patch('app.feed.routes.session.get', return_value=response):
+            assert fetch_rss_feed("https://example.com/feed.xml") == (None, None)
+        response.close.assert_called_once()
+
+def rewritten_feed(*args):
+    yield b'<xml>rewritten feed</xml>'
+
+def failed_rewrite(*args):
+    raise ValueError("not RSS")
+    yield
+
 def test_proxy_feed_success(client):
     with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
-        with patch('app.feed.routes.rewrite_rss_enclosure_urls') as mock_rewrite:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
 
-            mock_fetch.return_value = 'some feed content'
-            mock_rewrite.return_value = b'<xml>rewritten feed</xml>'
+            mock_fetch.return_value = upstream_response(b'some feed content')
+            mock_rewrite.side_effect = rewritten_feed
 
             response = client.get('/feed/example.com/rss')
 
             assert response.status_code == 200
             assert response.data == b'<?xml version="1.0" encoding="UTF-8"?>\n<xml>rewritten feed</xml>'
-            mock_fetch.assert_called_once_with('https://example.com/rss')
-            mock_rewrite.assert_called_once_with('some feed content', 'https://localhost/feed/example.com/rss')
+            mock_fetch.assert_called_once_with('https://example.com/rss', None)
+            assert list(mock_rewrite.call_args.args[0]) == [b'some feed content']
+            assert mock_rewrite.call_args.args[1] == 'https://localhost/feed/example.com/rss'
 
 def test_proxy_feed_fetch_failure(client):
     with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
-        mock_fetch.return_value = None
+        mock_fetch.return_value = None, None
 
         response = client.get('/feed/example.com/rss')
 
@@ -30,16 +60,251 @@ def test_proxy_feed_fetch_failure(client):
 
 def test_proxy_feed_rewrite_failure(client):
     with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
-        with patch('app.feed.routes.rewrite_rss_enclosure_urls') as mock_rewrite:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
 
-            mock_fetch.return_value = 'some feed content'
-            mock_rewrite.return_value = None
+            mock_fetch.return_value = upstream_response(b'some feed content')
+            mock_rewrite.side_effect = failed_rewrite
 
             response = client.get('/feed/example.com/rss')
 
             assert response.status_code == 500
             assert response.data == b'Failed to rewrite feed'
 
+def test_proxy_feed_served_from_cache(client):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
+            mock_fetch.return_value = upstream_response(b'some feed content')
+            mock_rewrite.side_effect = rewritten_feed
+
+            first = client.get('/feed/example.com/rss').data  # Feed is cached once fully streamed
+            second = client.get('/feed/example.com/rss')
+
+            assert second.status_code == 200
+            assert second.data == first
+            mock_fetch.assert_called_once()
+            mock_rewrite.assert_called_once()
+
+def test_proxy_feed_not_cached_when_too_large(client):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
+            with patch('app.feed.routes.FEED_CACHE_MAX_FEED_BYTES', 10):
+                mock_fetch.side_effect = lambda *args: upstream_response(b'some feed content')
+                mock_rewrite.side_effect = rewritten_feed
+
+                with patch.object(feed_refresher, 'untrack') as mock_untrack:
+                    client.get('/feed/example.com/rss').data
+                    client.get('/feed/example.com/rss').data
+
+                    assert mock_fetch.call_count == 2
+                    mock_untrack.assert_called_with(('localhost', 'https://example.com/rss'))
+
+def test_proxy_feed_client_revalidation(client):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
+            mock_fetch.return_value = upstream_response(b'some feed content')
+            mock_rewrite.side_effect = rewritten_feed
+
+            client.get('/feed/example.com/rss').data
+            etag = client.get('/feed/example.com/rss').headers['ETag']
+            response = client.get('/feed/example.com/rss', headers={'If-None-Match': etag})
+
+            assert response.status_code == 304
+            assert response.data == b''
+
+def test_proxy_feed_upstream_revalidation(client):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
+            with patch('app.feed.routes.FEED_CACHE_FRESHNESS', 0):
+                mock_fetch.return_value = upstream_response(b'some feed content', headers={'ETag': '"v1"'})
+                mock_rewrite.side_effect = rewritten_feed
+                client.get('/feed/example.com/rss').data
+
+                mock_fetch.return_value = upstream_response(b'', status_code=304)
+                response = client.get('/feed/example.com/rss')
+
+                assert response.status_code == 200
+                assert response.data == b'<?xml version="1.0" encoding="UTF-8"?>\n<xml>rewritten feed</xml>'
+                assert mock_fetch.call_args.args[1].conditional_headers() == {'If-None-Match': '"v1"'}
+                mock_rewrite.assert_called_once()
+
+def test_proxy_feed_shared_between_workers(client, shared_backend):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
+            mock_fetch.return_value = upstream_response(b'some feed content', headers={'ETag': '"v1"'})
+            mock_rewrite.side_effect = rewritten_feed
+            first = client.get('/feed/example.com/rss').data
+
+            feed_cache.clear()  # Only this worker's copy, as if another worker is requested
+            second = client.get('/feed/example.com/rss')
+
+            assert second.data == first
+            mock_fetch.assert_called_once()
+
+def test_proxy_feed_only_locked_with_shared_cache(client):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
+            with patch.object(feed_cache, 'lock') as mock_lock:
+                mock_fetch.return_value = upstream_response(b'some feed content')
+                mock_rewrite.side_effect = rewritten_feed
+                client.get('/feed/example.com/rss').data
+
+                mock_lock.assert_not_called()
+
+@pytest.mark.parametrize('max_feed_bytes', [1000, 10])
+def test_proxy_feed_lock_released_before_client_reads(client, shared_backend, max_feed_bytes):
+    lock_key = f"feed:{('localhost', 'https://example.com/rss')!r}"
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
+            with patch('app.feed.routes.FEED_CACHE_MAX_FEED_BYTES', max_feed_bytes):
+                mock_fetch.return_value = upstream_response(b'some feed content')
+                mock_rewrite.side_effect = rewritten_feed
+                response = client.get('/feed/example.com/rss', buffered=False)
+
+                other_worker = FileBackend(shared_backend.directory)
+                token = other_worker.acquire(lock_key, ttl=60, timeout=0)
+                assert token is not None
+                other_worker.release(lock_key, token)
+                assert b''.join(response.response) == b'<?xml version="1.0" encoding="UTF-8"?>\n<xml>rewritten feed</xml>'
+                response.close()
+
+def test_refresh_feed_skipped_while_another_worker_fetches_it(app, shared_backend):
+    cache_key = ('localhost', 'https://example.com/rss')
+    other_worker = FileBackend(shared_backend.directory)
+    token = other_worker.acquire(f"feed:{cache_key!r}", ttl=60, timeout=0)
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with app.test_request_context():
+            assert not refresh_feed(cache_key, 'https://example.com/rss', 'https://localhost/feed/example.com/rss', False)
+        mock_fetch.assert_not_called()
+    other_worker.release(f"feed:{cache_key!r}", token)
+
+def test_proxy_feed_served_warm_when_refresher_enabled(client):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with patch('app.feed.routes.iter_rewritten_rss') as mock_rewrite:
+            with patch('app.feed.routes.FEED_CACHE_FRESHNESS', 0):
+                with patch.object(feed_refresher, 'enabled', True):
+                    with patch.object(feed_refresher, 'track') as mock_track:
+                        mock_fetch.return_value = upstream_response(b'some feed content')
+                        mock_rewrite.side_effect = rewritten_feed
+
+                        client.get('/feed/example.com/rss').data
+                        response = client.get('/feed/example.com/rss')
+
+                        assert response.status_code == 200
+                        mock_fetch.assert_called_once()
+                        mock_track.assert_called_with(
+                            ('localhost', 'https://example.com/rss'),
+                            'https://example.com/rss',
+                            'https://localhost/feed/example.com/rss',
+                            False,
+                            None,
+                        )
+
+def test_proxy_feed_compresses_streamed_feed(client):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        mock_fetch.return_value = upstream_response(SAMPLE_RSS.encode())
+
+        response = client.get('/feed/original.com/rss', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert b'Test Podcast' in gzip.decompress(response.data)
+
+def test_proxy_feed_compresses_cached_feed_once(client):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        with patch('app.feed.cache.compress', side_effect=lambda content, encoding: gzip.compress(content)) as mock_compress:
+            mock_fetch.return_value = upstream_response(SAMPLE_RSS.encode())
+            uncompressed = client.get('/feed/original.com/rss').data
+
+            for _ in range(2):
+                response = client.get('/feed/original.com/rss', headers={'Accept-Encoding': 'gzip'})
+                assert response.headers['Content-Encoding'] == 'gzip'
+                assert gzip.decompress(response.data) == uncompressed
+            mock_compress.assert_called_once()
+
+            etag = response.headers['ETag']
+            assert etag != client.get('/feed/original.com/rss').headers['ETag']
+            revalidated = client.get(
+                '/feed/original.com/rss', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag}
+            )
+            assert revalidated.status_code == 304
+
+def test_cached_feed_counts_compressed_variants_towards_cache_size():
+    feed = CachedFeed(SAMPLE_RSS.encode())
+    feed_cache.set('key', feed)
+    compressed = feed_cache.encoded('key', feed, 'gzip')
+    assert gzip.decompress(compressed) == SAMPLE_RSS.encode()
+    assert feed.size() == len(SAMPLE_RSS.encode()) + len(compressed)
+
+@pytest.mark.parametrize('encoding, module', [('br', 'brotli'), ('zstd', 'zstandard')])
+def test_proxy_feed_optional_encodings(client, encoding, module):
+    decompressor = pytest.importorskip(module)
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        mock_fetch.return_value = upstream_response(SAMPLE_RSS.encode())
+        uncompressed = client.get('/feed/original.com/rss').data
+
+        response = client.get('/feed/original.com/rss', headers={'Accept-Encoding': f'gzip;q=0.5, {encoding}'})
+
+        assert response.headers['Content-Encoding'] == encoding
+        if module == 'zstandard':
+            assert decompressor.ZstdDecompressor().decompressobj().decompress(response.data) == uncompressed
+        else:
+            assert decompressor.decompress(response.data) == uncompressed
+
+
+def test_refresh_feed_detects_changes(app):
+    cache_key = ('localhost', 'https://original.com/rss')
+    with app.test_request_context():
+        with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+            mock_fetch.return_value = upstream_response(SAMPLE_RSS.encode())
+            assert refresh_feed(cache_key, 'https://original.com/rss', 'https://localhost/feed/original.com/rss', False)
+            assert b'Test Podcast' in feed_cache.get(cache_key).content
+
+            mock_fetch.return_value = upstream_response(SAMPLE_RSS.encode())
+            assert not refresh_feed(cache_key, 'https://original.com/rss', 'https://localhost/feed/original.com/rss', False)
+
+            mock_fetch.return_value = upstream_response(b'', status_code=304)
+            assert not refresh_feed(cache_key, 'https://original.com/rss', 'https://localhost/feed/original.com/rss', False)
+            assert feed_cache.get(cache_key) is not None
+
+def test_refresh_feed_drops_feeds_too_large_to_cache(app):
+    cache_key = ('localhost', 'https://original.com/rss')
+    with app.test_request_context():
+        with patch('app.feed.routes.fetch_rss_feed') as mock_fetch, patch('app.feed.routes.FEED_CACHE_MAX_FEED_BYTES', 100):
+            with patch.object(feed_refresher, 'untrack') as mock_untrack:
+                mock_fetch.return_value = upstream_response(SAMPLE_RSS.encode())
+                assert not refresh_feed(cache_key, 'https://original.com/rss', 'https://localhost/feed/original.com/rss', False)
+
+                assert feed_cache.get(cache_key) is None
+                mock_untrack.assert_called_once_with(cache_key)
+
+def test_feed_refresher_ignores_untracked_feeds():
+    refresher = FeedRefresher(max_feeds=10, idle_timeout=60, workers=1)
+    cache_key = ('localhost', 'https://original.com/rss')
+    refresher.track(cache_key, 'https://original.com/rss', None, False)
+    refresher.untrack(cache_key)
+    refresher.track(cache_key, 'https://original.com/rss', None, False)
+
+    with patch('app.feed.refresher.time.monotonic', return_value=float('1e12')):
+        assert refresher.due_feeds() == []
+
+def test_tracked_feed_interval_adapts():
+    with patch('app.FEED_REFRESH_MIN_INTERVAL', 100), patch('app.FEED_REFRESH_MAX_INTERVAL', 400):
+        feed = TrackedFeed(('localhost', 'https://original.com/rss'), 'https://original.com/rss', None, False)
+        for _ in range(5):
+            feed.reschedule(changed=False)
+        assert feed.interval == 400
+        feed.reschedule(changed=True)
+        assert feed.interval == 200
+
+def test_feed_refresher_claims_due_feeds():
+    refresher = FeedRefresher(max_feeds=10, idle_timeout=60, workers=1)
+    refresher.track(('localhost', 'https://original.com/rss'), 'https://original.com/rss', None, False)
+    assert refresher.due_feeds() == []
+
+    with patch('app.feed.refresher.time.monotonic', return_value=float('1e12')):
+        assert len(refresher.due_feeds()) == 1
+        assert refresher.due_feeds() == []  # Already claimed for refresh
+
 SAMPLE_RSS = '''<rss version="2.0" xmlns:atom="http://www.w3.org/2005/Atom"
     xmlns:itunes="http://www.itunes.com/dtds/podcast-1.0.dtd">
   <channel>
@@ -87,6 +352,62 @@ def test_rewrite_rss_still_rewrites_enclosures(app):
         assert '/stream/' in enclosure.get("url")
 
 
+def test_rewrite_rss_handles_feeds_over_10mb(app):
+    padding = ''.join(f'<!-- {i} {"x" * 1000000} -->' for i in range(11))
+    large_rss = SAMPLE_RSS.replace('</channel>', padding + '</channel>')
+    with app.test_request_context():
+        result = rewrite_rss_enclosure_urls(large_rss, 'https://proxy.test/feed/original.com/rss')
+        assert result is not None
+        assert '/stream/' in etree.fromstring(result).find('channel/item/enclosure').get("url")
+
+
+
+def dated_rss(days, trailer='</channel></rss>'):
+    items = ''.join(
+        f'<item><title>Episode {day}</title><pubDate>{day:02d} Jan 2024 00:00:00 +0000</pubDate>'
+        f'<enclosure url="https://cdn.original.com/{day}.mp3" type="audio/mpeg"/></item>'
+        for day in days
+    )
+    return f'<rss version="2.0"><channel><title>Dated</title>{items}{trailer}'
+
+
+def rewritten_titles(result):
+    return [title.text for title in etree.fromstring(result).findall('channel/item/title')]
+
+
+def test_rewrite_rss_item_window_stops_after_newest_items(app):
+    # Parsing stops at the window, so the malformed rest of the feed is never read
+    feed = dated_rss([5, 4, 3], trailer='<item><title>unclosed')
+    with app.test_request_context():
+        result = rewrite_rss_enclosure_urls(feed, 'https://proxy.test/feed/original.com/rss', ItemWindow(max_items=2))
+        assert rewritten_titles(result) == ['Episode 5', 'Episode 4']
+
+
+def test_rewrite_rss_item_window_since_date(app):
+    window = ItemWindow.from_args({'since': '2024-01-03'})
+    with app.test_request_context():
+        newest_first = dated_rss([5, 4, 3, 2], trailer='<item><title>unclosed')
+        result = rewrite_rss_enclosure_urls(newest_first, 'https://proxy.test/feed/original.com/rss', window)
+        assert rewritten_titles(result) == ['Episode 5', 'Episode 4', 'Episode 3']
+
+        oldest_first = dated_rss([1, 2, 3, 4])
+        result = rewrite_rss_enclosure_urls(oldest_first, 'https://proxy.test/feed/original.com/rss', window)
+        assert rewritten_titles(result) == ['Episode 3', 'Episode 4']
+
+
+def test_proxy_feed_item_window(client):
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        mock_fetch.side_effect = lambda *args: upstream_response(dated_rss([3, 2, 1]).encode())
+
+        response = client.get('/feed/original.com/rss?items=1')
+        root = etree.fromstring(response.data)
+        assert [title.text for title in root.findall('channel/item/title')] == ['Episode 3']
+        assert len(etree.fromstring(client.get('/feed/original.com/rss').data).findall('channel/item')) == 3
+
+        assert client.get('/feed/original.com/rss?items=0').status_code == 400
+        assert client.get('/feed/original.com/rss?since=yesterday').status_code == 400
+
+
 def test_rewrite_youtube_feed(app):
     with app.test_request_context():
         with open(resources / "youtube_feed.xml", "r") as f:
@@ -96,4 +417,109 @@ def test_rewrite_youtube_feed(app):
         assert b'<description>Podcast feed for Test Channel</description>' in rewritten_feed
         assert b'<itunes:author>Test Author</itunes:author>' in rewritten_feed
         assert b'<title>Test Video Title</title>' in rewritten_feed
-        assert b'<description>Test video description.</description>' in rewritten_feed
\ No newline at end of file
+        assert b'<description>Test video description.</description>' in rewritten_feed
+
+
+def test_rewrite_youtube_feed_reuses_converted_items(app):
+    youtube_feed_content = (resources / "youtube_feed.xml").read_bytes()
+    with app.test_request_context():
+        with patch('app.feed.routes.create_proxied_stream_url', return_value='https://localhost/stream/token') as mock_url:
+            first = rewrite_youtube_feed(youtube_feed_content)
+            assert rewrite_youtube_feed(youtube_feed_content) == first
+            assert mock_url.call_count == 1
+
+            updated = youtube_feed_content.replace(b'<title>Test Video Title</title>', b'<title>New Title</title>')
+            updated = updated.replace(b'2023-01-01T12:00:00+00:00</updated>', b'2023-01-02T12:00:00+00:00</updated>')
+            assert b'<title>New Title</title>' in rewrite_youtube_feed(updated)
+            assert mock_url.call_count == 2
+
+    with app.test_request_context(base_url='https://other.example.com'):
+        with patch('app.feed.routes.create_proxied_stream_url', return_value='https://other.example.com/stream/token') as mock_url:
+            assert b'https://other.example.com/stream/token' in rewrite_youtube_feed(youtube_feed_content)
+            assert mock_url.call_count == 1
+
+
+def test_rewrite_rss_streamed_in_small_chunks(app):
+    with app.test_request_context():
+        feed_bytes = SAMPLE_RSS.encode()
+        chunks = [feed_bytes[i:i + 16] for i in range(0, len(feed_bytes), 16)]
+        result = b''.join(iter_rewritten_rss(chunks, 'https://proxy.test/feed/original.com/rss'))
+        root = etree.fromstring(result)
+        assert root.findtext('channel/link') == "https://proxy.test/feed/original.com/rss"
+        assert root.find('channel/itunes:new-feed-url', namespaces=XML_NAMESPACES) is None
+        assert '/stream/' in root.find('channel/item/enclosure').get("url")
+
+
+def test_rewrite_rss_does_not_redeclare_namespaces(app):
+    with app.test_request_context():
+        result = rewrite_rss_enclosure_urls(SAMPLE_RSS, 'https://proxy.test/feed/original.com/rss')
+        assert result.count(b'xmlns:atom=') == 1
+
+
+def test_rewrite_rss_rejects_non_rss(app):
+    with app.test_request_context():
+        assert rewrite_rss_enclosure_urls('<html><body/></html>', 'https://proxy.test/feed/x') is None
+
+OPML = b'''<?xml version="1.0" encoding="UTF-8"?>
+<opml version="2.0"><head><title>Subscriptions</title></head><body>
+<outline text="Podcast" type="rss" xmlUrl="https://example.com/rss"/>
+<outline text="Channel" type="rss" xmlUrl="https://www.youtube.com/feeds/videos.xml?channel_id=UC123"/>
+<outline text="Offline" type="rss" xmlUrl="https://offline.example.com/rss"/>
+<outline text="Query" type="rss" xmlUrl="https://example.com/feed?format=rss"/>
+<outline text="Proxied" type="rss" xmlUrl="https://localhost/feed/example.com/other"/>
+</body></opml>'''
+
+def fetch_opml_feed(url, cached_feed):
+    if url.startswith("https://www.youtube.com/"):
+        return upstream_response((resources / "youtube_feed.xml").read_bytes())
+    if url == "https://example.com/rss":
+        return upstream_response(b'<rss><channel><item><title>Episode</title></item></channel></rss>')
+    return None, None
+
+def test_import_opml_rewrites_and_warms_feeds(client):
+    with patch('app.feed.routes.fetch_rss_feed', side_effect=fetch_opml_feed) as mock_fetch:
+        response = client.post('/opml', data=OPML, content_type='text/x-opml')
+
+    assert response.status_code == 200
+    assert response.mimetype == 'text/x-opml'
+    assert response.headers['X-Feeds-Proxied'] == '3'
+    assert response.headers['X-Feeds-Failed'] == '2'
+    outlines = {outline.get('text'): outline for outline in etree.fromstring(response.data).iter('outline')}
+    assert outlines['Podcast'].get('xmlUrl') == 'https://localhost/feed/example.com/rss'
+    assert outlines['Channel'].get('xmlUrl') == 'https://localhost/feed/youtube/UC123'
+    assert outlines['Proxied'].get('xmlUrl') == 'https://localhost/feed/example.com/other'
+    assert outlines['Offline'].get('xmlUrl') == 'https://offline.example.com/rss'
+    assert outlines['Offline'].get('proxyError') == "Feed couldn't be fetched"
+    assert outlines['Query'].get('xmlUrl') == 'https://example.com/feed?format=rss'
+    assert outlines['Query'].get('proxyError')
+    assert mock_fetch.call_count == 3
+
+    assert feed_cache.get(('localhost', 'https://example.com/rss')) is not None
+    assert feed_cache.get(('localhost', 'https://www.youtube.com/feeds/videos.xml?channel_id=UC123')) is not None
+
+    # Served from the warmed cache
+    with patch('app.feed.routes.fetch_rss_feed') as mock_fetch:
+        response = client.get('/feed/example.com/rss')
+        assert response.status_code == 200
+        mock_fetch.assert_not_called()
+
+def test_import_opml_upload(client):
+    with patch('app.feed.routes.fetch_rss_feed', side_effect=fetch_opml_feed):
+        response = client.post('/opml', data={'opml': (io.BytesIO(OPML), 'subscriptions.opml')})
+
+    assert response.status_code == 200
+    assert response.headers['X-Feeds-Proxied'] == '3'
+
+@pytest.mark.parametrize('content', [b'not xml', b'<rss/>'])
+def test_import_opml_invalid(client, content):
+    response = client.post('/opml', data=content)
+    assert response.status_code == 400
+
+def test_import_opml_does_not_resolve_entities(client):
+    opml = b'''<?xml version="1.0"?>
+<!DOCTYPE opml [<!ENTITY secret SYSTEM "file:///etc/passwd">]>
+<opml><body><outline text="&secret;" xmlUrl="https://offline.example.com/rss"/></body></opml>'''
+    with patch('app.feed.routes.fetch_rss_feed', side_effect=fetch_opml_feed):
+        response = client.post('/opml', data=opml)
+
+    assert b'root:' not in response.data
@@ -1,3 +1,11 @@
 def test_index(client):
     response = client.get("/")
     assert response.status_code == 200
+
+
+def test_metrics(client):
+    client.get("/")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.mimetype == "text/plain"
+    assert 'podcast_proxy_request_seconds_count{endpoint="main.index"}' in response.text
@@ -1,5 +1,30 @@
 from unittest.mock import patch
 import base64
+import gzip
+import io
+import os
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+import requests
+import urllib3
+import yt_dlp
+from app.feed.routes import rewrite_youtube_feed
+from app.stream.bandwidth import BandwidthScheduler, stream_priority
+from app.stream.extractor import EXPIRY_MARGIN, YouTubeExtractor, youtube_extractor
+from app.stream.prefetch import YouTubePrefetcher
+from app.stream.episode_cache import episode_cache
+from app.stream.mime import stream_mime_verdicts
+from app.stream.redirects import stream_redirects
+from app.stream.routes import iter_upstream_chunks, request_stream
+from app.stream.tokens import StreamTokens, stream_tokens
+from app.utils.disk_cache import DiskCache, disk_cache
+from app.utils.metrics import metrics
+from app.utils.resolver import host_resolver
+from app.utils.shared_cache import FileBackend
+from app.utils.upstream import create_session
 
 
 def test_proxy_media_generic_stream(client):
@@ -20,3 +45,655 @@ def test_proxy_media_youtube_stream(client):
         response = client.get(f"/stream/{url}")
         assert response.status_code == 200
         assert response.data == b"youtube stream success"
+
+
+AUDIO = bytes(range(256)) * 64
+
+
+class FakeYoutubeDL:
+    """Writes AUDIO in two halves, pausing in between until resume is set"""
+
+    resume = threading.Event()
+    downloads = 0
+    extractions = 0
+    instances = 0
+    expire = None  # Expiry time of the signed URLs extract_info returns
+    fail_next = False
+
+    def __init__(self, opts):
+        self.opts = opts
+        FakeYoutubeDL.instances += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def extract_info(self, url, download=True):
+        FakeYoutubeDL.extractions += 1
+        audio_url = "https://rr1.googlevideo.com/videoplayback?itag=140"
+        if FakeYoutubeDL.expire:
+            audio_url += f"&expire={FakeYoutubeDL.expire}"
+        return {
+            "id": url.split("v=")[1],
+            "duration": 61.5,
+            "filesize": len(AUDIO),
+            "url": audio_url,
+            "formats": [
+                {"format_id": "140", "vcodec": "none", "url": audio_url},
+                {"format_id": "137", "vcodec": "avc1", "url": audio_url},
+            ],
+            "thumbnails": [{"url": "https://i.ytimg.com/vi/x/default.jpg"}],
+        }
+
+    @staticmethod
+    def sanitize_info(info):
+        return info
+
+    def process_ie_result(self, info, download=True):
+        if FakeYoutubeDL.fail_next:
+            FakeYoutubeDL.fail_next = False
+            raise yt_dlp.utils.DownloadError("HTTP Error 403: Forbidden")
+        FakeYoutubeDL.downloads += 1
+        half = len(AUDIO) // 2
+        with open(self.opts["outtmpl"], "wb") as f:
+            for part, (start, stop) in enumerate([(0, half), (half, len(AUDIO))]):
+                if part:
+                    FakeYoutubeDL.resume.wait(timeout=5)
+                f.write(AUDIO[start:stop])
+                f.flush()
+                self.hook({"status": "downloading", "downloaded_bytes": stop, "total_bytes": len(AUDIO)})
+        self.hook({"status": "finished"})
+
+    def hook(self, progress):
+        for hook in self.opts["progress_hooks"]:
+            hook(progress)
+
+
+@pytest.fixture
+def fake_youtube(app, tmp_path):
+    FakeYoutubeDL.resume.clear()
+    FakeYoutubeDL.downloads = FakeYoutubeDL.extractions = FakeYoutubeDL.instances = 0
+    FakeYoutubeDL.expire = None
+    FakeYoutubeDL.fail_next = False
+    youtube_extractor.clear()
+    with patch("app.stream.youtube.yt_dlp.YoutubeDL", FakeYoutubeDL):
+        yield tmp_path / "cache"
+    FakeYoutubeDL.resume.set()
+
+
+def youtube_url(video_id="abc123"):
+    url = f"https://www.youtube.com/watch?v={video_id}".encode()
+    return f"/stream/{base64.urlsafe_b64encode(url).decode()}"
+
+
+def test_youtube_stream_range_during_download(client, fake_youtube):
+    response = client.get(youtube_url(), headers={"Range": "bytes=100-199"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 100-199/{len(AUDIO)}"
+    assert response.data == AUDIO[100:200]
+
+    FakeYoutubeDL.resume.set()
+    full = client.get(youtube_url())
+    assert full.data == AUDIO
+
+
+def test_youtube_stream_download_has_its_own_validator(client, fake_youtube):
+    partial = client.get(youtube_url(), headers={"Range": "bytes=0-99"})
+    download_etag = partial.headers["ETag"]
+    assert partial.status_code == 206
+
+    mismatched = client.get(youtube_url(), headers={"Range": "bytes=100-199", "If-Range": '"other"'})
+    matched = client.get(youtube_url(), headers={"Range": "bytes=100-199", "If-Range": download_etag})
+    FakeYoutubeDL.resume.set()
+    assert mismatched.status_code == 200
+    assert mismatched.data == AUDIO
+    assert matched.status_code == 206
+    assert matched.data == AUDIO[100:200]
+
+    # The published file may have been remuxed, so a range of the download never continues from it
+    published = client.get(youtube_url(), headers={"Range": "bytes=100-199", "If-Range": download_etag})
+    assert published.status_code == 200
+    assert published.headers["ETag"] != download_etag
+
+
+def test_youtube_stream_coalesces_downloads(client, fake_youtube):
+    first = client.get(youtube_url())
+    second = client.get(youtube_url())
+    FakeYoutubeDL.resume.set()
+
+    assert first.data == AUDIO
+    assert second.data == AUDIO
+    assert FakeYoutubeDL.downloads == 1
+    assert "abc123.m4a" in os.listdir(fake_youtube)
+    assert not [name for name in os.listdir(fake_youtube) if ".download." in name]  # Temporary file was renamed
+
+
+def test_youtube_stream_serves_cached_file(client, fake_youtube):
+    (fake_youtube / "abc123.m4a").write_bytes(AUDIO)
+    disk_cache.add("abc123.m4a")
+
+    response = client.get(youtube_url(), headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.data == AUDIO[:10]
+    assert FakeYoutubeDL.downloads == 0
+
+
+def test_youtube_stream_copies_from_shared_cache(client, fake_youtube, shared_backend, tmp_path):
+    (tmp_path / "shared.m4a").write_bytes(AUDIO)
+    shared_backend.put_file("youtube:abc123", str(tmp_path / "shared.m4a"), ttl=60)
+
+    response = client.get(youtube_url())
+    assert response.data == AUDIO
+    assert FakeYoutubeDL.downloads == 0
+    assert (fake_youtube / "abc123.m4a").read_bytes() == AUDIO
+
+
+def test_youtube_stream_waits_for_download_by_another_worker(client, fake_youtube, shared_backend, tmp_path):
+    other_worker = FileBackend(shared_backend.directory)
+    token = other_worker.acquire("youtube:abc123", ttl=60, timeout=0)
+    responses = []
+    request_thread = threading.Thread(target=lambda: responses.append(client.get(youtube_url())))
+    request_thread.start()
+
+    time.sleep(0.3)
+    assert not responses  # Waiting rather than downloading it again
+    (tmp_path / "shared.m4a").write_bytes(AUDIO)
+    other_worker.put_file("youtube:abc123", str(tmp_path / "shared.m4a"), ttl=60)
+    other_worker.release("youtube:abc123", token)
+
+    request_thread.join(timeout=5)
+    assert responses[0].data == AUDIO
+    assert FakeYoutubeDL.downloads == 0
+
+
+def test_youtube_stream_waits_for_download_into_shared_cache_directory(client, fake_youtube, shared_backend):
+    other_worker = FileBackend(shared_backend.directory)
+    token = other_worker.acquire("youtube:abc123", ttl=60, timeout=0)
+    responses = []
+    request_thread = threading.Thread(target=lambda: responses.append(client.get(youtube_url())))
+    request_thread.start()
+
+    time.sleep(0.3)
+    (fake_youtube / "abc123.m4a").write_bytes(AUDIO)  # Published by the other worker
+    other_worker.release("youtube:abc123", token)
+
+    request_thread.join(timeout=5)
+    assert responses[0].data == AUDIO
+    assert disk_cache.stats()["files"] == 1
+    assert FakeYoutubeDL.downloads == 0
+
+
+def test_youtube_stream_shares_downloads(client, fake_youtube, shared_backend, tmp_path):
+    FakeYoutubeDL.resume.set()
+    assert client.get(youtube_url()).data == AUDIO
+
+    deadline = time.monotonic() + 5  # Shared once the response has been served
+    while not shared_backend.get_file("youtube:abc123", str(tmp_path / "shared.m4a")):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+    assert (tmp_path / "shared.m4a").read_bytes() == AUDIO
+
+
+def test_youtube_extractor_reuses_instances_and_caches_metadata(fake_youtube):
+    extractor = YouTubeExtractor(instances=1, default_ttl=60, max_videos=10)
+    for video_id in ["a", "b", "a"]:
+        video = extractor.extract(video_id, f"https://www.youtube.com/watch?v={video_id}")
+
+    assert FakeYoutubeDL.extractions == 2
+    assert FakeYoutubeDL.instances == 1
+    assert video.duration == 61.5
+    assert [audio_format["format_id"] for audio_format in video.info["formats"]] == ["140"]
+    assert "thumbnails" not in video.info
+
+
+def test_youtube_extractor_expires_with_signed_urls(fake_youtube):
+    extractor = YouTubeExtractor(instances=1, default_ttl=60, max_videos=10)
+    FakeYoutubeDL.expire = int(time.time()) + EXPIRY_MARGIN + 100
+    video = extractor.extract("a", "https://www.youtube.com/watch?v=a")
+    assert video.expires_at == FakeYoutubeDL.expire - EXPIRY_MARGIN
+    assert extractor.cached("a") is video
+
+    FakeYoutubeDL.expire = int(time.time()) + EXPIRY_MARGIN - 1
+    extractor.extract("b", "https://www.youtube.com/watch?v=b")
+    assert extractor.cached("b") is None  # Too close to expiry to start a download with
+
+
+def test_youtube_stream_extracts_again_if_cached_urls_fail(client, fake_youtube):
+    FakeYoutubeDL.resume.set()
+    youtube_extractor.extract("abc123", "https://www.youtube.com/watch?v=abc123")
+    FakeYoutubeDL.fail_next = True
+
+    assert client.get(youtube_url()).data == AUDIO
+    assert FakeYoutubeDL.extractions == 2
+
+
+def test_youtube_feed_uses_extracted_sizes(app, fake_youtube):
+    youtube_extractor.extract("test_video_id", "https://www.youtube.com/watch?v=test_video_id")
+    with open(os.path.join(os.path.dirname(__file__), "resources", "youtube_feed.xml"), "rb") as f:
+        youtube_feed = f.read()
+    with app.test_request_context():
+        rewritten_feed = rewrite_youtube_feed(youtube_feed)
+    assert f'length="{len(AUDIO)}"'.encode() in rewritten_feed
+    assert b"<itunes:duration>61</itunes:duration>" in rewritten_feed
+
+
+def test_prefetcher_queues_newest_uncached_videos(app, fake_youtube):
+    prefetcher = YouTubePrefetcher(count=2, workers=1, per_channel=1, max_queued=10)
+    prefetcher.enabled = True
+    (fake_youtube / "new1.m4a").write_bytes(AUDIO)
+
+    prefetcher.enqueue("channel", [(video_id, f"https://www.youtube.com/watch?v={video_id}") for video_id in ["new1", "new2", "old"]])
+
+    assert [job[1] for job in prefetcher._pending] == ["new2"]
+
+
+def test_prefetcher_limits_concurrency_per_channel():
+    prefetcher = YouTubePrefetcher(count=5, workers=2, per_channel=1, max_queued=10)
+    prefetcher.enabled = True
+    with patch("app.stream.prefetch.os.path.exists", return_value=False):
+        prefetcher.enqueue("a", [("a1", "url"), ("a2", "url")])
+        prefetcher.enqueue("b", [("b1", "url")])
+
+    first = prefetcher.next_job()
+    second = prefetcher.next_job()
+    assert (first[1], second[1]) == ("a1", "b1")  # a2 waits for a1
+
+    prefetcher.finish_job(first)
+    assert prefetcher.next_job()[1] == "a2"
+
+
+def test_prefetcher_downloads_in_background(app, fake_youtube):
+    FakeYoutubeDL.resume.set()
+    prefetcher = YouTubePrefetcher(count=1, workers=1, per_channel=1, max_queued=10)
+    prefetcher.start()
+    prefetcher.enqueue("channel", [("abc123", "https://www.youtube.com/watch?v=abc123")])
+
+    for _ in range(50):
+        if (fake_youtube / "abc123.m4a").exists():
+            break
+        time.sleep(0.1)
+    assert (fake_youtube / "abc123.m4a").read_bytes() == AUDIO
+
+
+def test_generic_stream_relays_raw_bytes_in_growing_chunks():
+    body = gzip.compress(os.urandom(1024 * 1024))
+    upstream_response = requests.Response()
+    upstream_response.raw = urllib3.HTTPResponse(
+        body=io.BytesIO(body),
+        headers={"Content-Encoding": "gzip"},
+        preload_content=False,
+    )
+
+    chunks = list(iter_upstream_chunks(upstream_response, 1024, 64 * 1024))
+
+    assert b"".join(chunks) == body  # Not decompressed, matching the relayed Content-Encoding
+    assert len(chunks[0]) == 1024
+    assert max(len(chunk) for chunk in chunks) == 64 * 1024
+    assert upstream_response.raw.closed
+
+
+def stream_url(url):
+    return f"/stream/{base64.urlsafe_b64encode(url.encode()).decode()}"
+
+
+def upstream_stream_response(body, status_code=200, headers=None):
+    upstream_response = requests.Response()
+    upstream_response.status_code = status_code
+    upstream_response.headers.update(headers or {})
+    upstream_response.raw = urllib3.HTTPResponse(
+        body=io.BytesIO(body), preload_content=False
+    )
+    return upstream_response
+
+
+@pytest.fixture
+def safety_check(monkeypatch):
+    monkeypatch.setattr("app.ENABLE_STREAMING_SAFETY_CHECK", True)
+    stream_mime_verdicts.clear()
+    with patch("app.stream.routes.check_hostname"):
+        yield
+    stream_mime_verdicts.clear()
+
+
+def test_safety_check_relays_sniffed_bytes(client, safety_check):
+    audio = b"ID3" + os.urandom(200 * 1024)
+    with patch("app.session.get", return_value=upstream_stream_response(audio)):
+        response = client.get(stream_url("https://example.com/episode.mp3"))
+
+    assert response.status_code == 200
+    assert response.data == audio
+    assert stream_mime_verdicts.get("https://example.com/episode.mp3") == "audio/mpeg"
+
+
+def test_safety_check_rejects_non_audio(client, safety_check):
+    with patch("app.session.get", return_value=upstream_stream_response(b"GIF89a" + bytes(2048))):
+        response = client.get(stream_url("https://example.com/episode.mp3"))
+    assert response.status_code == 403
+
+
+def test_safety_check_sniffs_head_for_later_ranges(client, safety_check):
+    audio = b"OggS" + os.urandom(4096)
+    partial_response = upstream_stream_response(
+        audio[2048:], 206, {"Content-Range": f"bytes 2048-{len(audio) - 1}/{len(audio)}"}
+    )
+    head_response = upstream_stream_response(audio[:1024], 206)
+    url = stream_url("https://example.com/episode.ogg")
+
+    with patch("app.session.get", side_effect=[partial_response, head_response]) as session_get:
+        response = client.get(url, headers={"Range": "bytes=2048-"})
+        assert response.data == audio[2048:]
+    assert session_get.call_args.kwargs["headers"]["Range"] == "bytes=0-1023"
+
+    partial_response = upstream_stream_response(
+        audio[2048:], 206, {"Content-Range": f"bytes 2048-{len(audio) - 1}/{len(audio)}"}
+    )
+    with patch("app.session.get", return_value=partial_response) as session_get:
+        assert client.get(url, headers={"Range": "bytes=2048-"}).data == audio[2048:]
+    assert session_get.call_count == 1  # Verdict is cached
+
+
+def test_stream_tokens_are_compact_and_signed(app):
+    url = "https://dts.podtrac.com/redirect.mp3/chrt.fm/track/12345/traffic.megaphone.fm/GLT1234567890.mp3"
+    token = stream_tokens.encode(url)
+
+    assert len(token) < len(base64.urlsafe_b64encode(url.encode()))
+    assert stream_tokens.decode(token) == (url, True)
+    assert stream_tokens.decode(token[:-2] + "AA") == (url, False)
+    assert stream_tokens.decode(base64.urlsafe_b64encode(url.encode()).decode()) == (url, False)
+
+
+def test_stream_tokens_leave_private_urls_unsigned():
+    assert stream_tokens.decode(stream_tokens.encode("https://10.0.0.1/episode.mp3")) == (
+        "https://10.0.0.1/episode.mp3",
+        False,
+    )
+
+
+def test_stream_url_secret_is_shared_through_cache_dir(tmp_path):
+    url = "https://example.com/episode.mp3"
+    worker, other_worker = StreamTokens(None), StreamTokens(None)
+
+    assert "." not in worker.encode(url)  # Unsigned until a secret is loaded
+    worker.open(str(tmp_path))
+    other_worker.open(str(tmp_path))
+
+    assert other_worker.decode(worker.encode(url)) == (url, True)
+    assert os.stat(tmp_path / "stream_url_secret").st_mode & 0o777 == 0o600
+
+
+def test_configured_stream_url_secret_is_not_stored(tmp_path):
+    tokens = StreamTokens("configured")
+    tokens.open(str(tmp_path))
+
+    assert tokens.secret == b"configured"
+    assert not (tmp_path / "stream_url_secret").exists()
+
+
+def test_proxy_media_skips_host_check_for_signed_urls(client):
+    token = stream_tokens.encode("https://example.com/episode.mp3")
+    with patch("app.stream.routes.generic_stream", return_value="ok"), patch(
+        "app.stream.routes.check_hostname"
+    ) as check_hostname:
+        assert client.get(f"/stream/{token}").data == b"ok"
+        check_hostname.assert_not_called()
+
+        assert client.get(stream_url("https://example.com/episode.mp3")).data == b"ok"
+        check_hostname.assert_called_once_with("https://example.com/episode.mp3")
+
+
+def test_proxy_media_checks_signed_urls_sent_through_external_proxy(client, monkeypatch):
+    monkeypatch.setattr("app.EXTERNAL_PROXY", "http://proxy.example.com:3128")
+    host_resolver.clear()
+    token = stream_tokens.encode("https://internal.example.com/episode.mp3")
+    private_address = [(socket.AF_INET, socket.SOCK_STREAM, 6, "", ("10.0.0.5", 0))]
+    with patch("socket.getaddrinfo", return_value=private_address), patch(
+        "app.stream.routes.generic_stream", return_value="ok"
+    ) as generic_stream:
+        assert client.get(f"/stream/{token}").status_code == 500
+        generic_stream.assert_not_called()
+    host_resolver.clear()
+
+
+def redirected_response(url, status_code=200, redirected=True):
+    response = upstream_stream_response(b"", status_code)
+    response.url = url
+    response.history = [requests.Response()] if redirected else []
+    return response
+
+
+def test_request_stream_caches_redirect_chain():
+    stream_redirects.clear()
+    tracking_url = "https://dts.podtrac.com/redirect.mp3/cdn.example.com/episode.mp3"
+    cdn_url = "https://cdn.example.com/episode.mp3"
+
+    with patch(
+        "app.stream.routes.request_upstream",
+        side_effect=[
+            redirected_response(cdn_url),
+            redirected_response(cdn_url, 206, redirected=False),
+            redirected_response(cdn_url, 403, redirected=False),
+            redirected_response(cdn_url + "?signature=new"),
+        ],
+    ) as request_upstream:
+        request_stream(tracking_url, {})
+        assert request_stream(tracking_url, {"Range": "bytes=100-"}).status_code == 206
+        assert request_upstream.call_args.args[0] == cdn_url  # Straight to the CDN
+
+        assert request_stream(tracking_url, {}).status_code == 200  # Expired CDN URL, chain followed again
+        assert request_upstream.call_args.args[0] == tracking_url
+
+    assert stream_redirects.get(tracking_url) == cdn_url + "?signature=new"
+    stream_redirects.clear()
+
+
+EPISODE = b"ID3" + os.urandom(300 * 1024)
+
+
+@pytest.fixture
+def range_origin(monkeypatch):
+    """Local origin serving EPISODE with byte range support, recording the Range header of each request"""
+    requested_ranges = []
+    cache_control = {"value": "public, max-age=600"}
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            requested_ranges.append(self.headers.get("Range"))
+            start, stop, status = 0, len(EPISODE), 200
+            if self.headers.get("Range"):
+                first, _, last = self.headers["Range"][len("bytes="):].partition("-")
+                start, stop, status = int(first), int(last or len(EPISODE) - 1) + 1, 206
+            self.send_response(status)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("Content-Length", str(stop - start))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("ETag", '"v1"')
+            self.send_header("Cache-Control", cache_control["value"])
+            if status == 206:
+                self.send_header("Content-Range", f"bytes {start}-{stop - 1}/{len(EPISODE)}")
+            self.end_headers()
+            self.wfile.write(EPISODE[start:stop])
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    monkeypatch.setattr("app.session", create_session(10, 4, {}, 0, 0, 5, 5))
+    monkeypatch.setattr(episode_cache, "enabled", True)
+    with patch("app.stream.routes.check_hostname"):
+        yield (
+            stream_url(f"http://127.0.0.1:{server.server_address[1]}/episode.mp3"),
+            requested_ranges,
+            cache_control,
+        )
+    server.shutdown()
+
+
+def test_episode_cache_serves_replays_locally(client, range_origin):
+    url, requested_ranges, _ = range_origin
+
+    assert client.get(url).data == EPISODE
+    response = client.get(url)
+    assert response.data == EPISODE
+    assert response.headers["Content-Type"] == "audio/mpeg"
+    assert response.headers["ETag"] == '"v1"'
+
+    response = client.get(url, headers={"Range": "bytes=1000-1999"})
+    assert response.status_code == 206
+    assert response.headers["Content-Range"] == f"bytes 1000-1999/{len(EPISODE)}"
+    assert response.data == EPISODE[1000:2000]
+    assert requested_ranges == [None]
+
+
+def test_episode_cache_fills_missing_ranges(client, range_origin):
+    url, requested_ranges, _ = range_origin
+
+    assert client.get(url, headers={"Range": "bytes=0-99999"}).data == EPISODE[:100000]
+    assert client.get(url, headers={"Range": "bytes=50000-149999"}).data == EPISODE[50000:150000]
+    assert client.get(url, headers={"Range": "bytes=0-"}).data == EPISODE
+    assert client.get(url).data == EPISODE
+
+    assert requested_ranges == [
+        "bytes=0-99999",
+        "bytes=100000-149999",  # Only the part not cached yet
+        f"bytes=150000-{len(EPISODE) - 1}",
+    ]
+
+
+def test_episode_cache_shared_between_workers(client, range_origin, monkeypatch):
+    url, requested_ranges, _ = range_origin
+    assert client.get(url, headers={"Range": "bytes=0-99999"}).data == EPISODE[:100000]
+    name = episode_cache.name(stream_tokens.decode(url[len("/stream/"):])[0])
+    inode = os.stat(disk_cache.path(name)).st_ino
+
+    other_worker = DiskCache(max_bytes=10 ** 9, policy="lru", pinned_per_group=0)
+    other_worker.open(disk_cache.directory)
+    monkeypatch.setattr("app.stream.episode_cache.disk_cache", other_worker)
+    assert client.get(url, headers={"Range": "bytes=0-"}).data == EPISODE
+
+    assert requested_ranges == ["bytes=0-99999", f"bytes=100000-{len(EPISODE) - 1}"]
+    assert os.stat(disk_cache.path(name)).st_ino == inode  # Filled in rather than replaced
+
+
+def test_episode_cache_never_replaces_another_workers_episode(client, range_origin):
+    url, _, _ = range_origin
+    stream_url = stream_tokens.decode(url[len("/stream/"):])[0]
+    assert client.get(url, headers={"Range": "bytes=0-99999"}).data == EPISODE[:100000]
+    entry = episode_cache.get(stream_url)
+
+    upstream_response = requests.get(stream_url, headers={"Range": "bytes=0-99"})
+    assert episode_cache.create(stream_url, upstream_response).inode == entry.inode
+    upstream_response.headers["ETag"] = '"v2"'
+    assert episode_cache.create(stream_url, upstream_response) is None
+    assert episode_cache.get(stream_url).segments == [[0, 100000]]
+
+
+def test_episode_cache_fills_throttled(client, range_origin, monkeypatch):
+    url, _, _ = range_origin
+    monkeypatch.setattr(
+        "app.stream.routes.bandwidth_scheduler",
+        BandwidthScheduler(max_rate=10 ** 9, client_rate=0, upstream_rate=0, bulk_share=0.5),
+    )
+    scheduled = ("scheduled_bytes_total", (("priority", "live"),))
+    assert client.get(url, headers={"Range": "bytes=0-99999"}).data == EPISODE[:100000]
+    scheduled_before = metrics._counters[scheduled]
+
+    assert client.get(url, headers={"Range": "bytes=50000-149999"}).data == EPISODE[50000:150000]
+    assert metrics._counters[scheduled] - scheduled_before == 50000  # Only the range filled from upstream
+
+
+def test_episode_cache_respects_no_store(client, range_origin):
+    url, requested_ranges, cache_control = range_origin
+    cache_control["value"] = "no-store"
+
+    for _ in range(2):
+        assert client.get(url).data == EPISODE
+    assert len(requested_ranges) == 2
+
+
+@pytest.fixture
+def clock():
+    now = [1000.0]
+    with patch("app.stream.bandwidth.time.monotonic", side_effect=lambda: now[0]):
+        yield now
+
+
+def test_bandwidth_scheduler_global_limit(clock):
+    scheduler = BandwidthScheduler(max_rate=1000, client_rate=0, upstream_rate=0, bulk_share=0.5)
+    stream = scheduler.open("192.0.2.1", "example.com", "live")
+
+    assert stream.delay(2000) == 0  # Burst
+    assert stream.delay(1000) == 1.0
+    clock[0] += 3
+    assert stream.delay(1000) == 0
+    stream.close()
+
+
+def test_bandwidth_scheduler_limits_clients_separately(clock):
+    scheduler = BandwidthScheduler(max_rate=0, client_rate=1000, upstream_rate=0, bulk_share=0.5)
+    downloader = scheduler.open("192.0.2.1", "example.com", "bulk")
+    listener = scheduler.open("192.0.2.2", "example.com", "live")
+
+    assert downloader.delay(4000) == 2.0
+    assert listener.delay(1000) == 0
+
+
+def test_bandwidth_scheduler_limits_upstream_hosts(clock):
+    scheduler = BandwidthScheduler(max_rate=0, client_rate=0, upstream_rate=1000, bulk_share=0.5)
+    first = scheduler.open("192.0.2.1", "example.com", "live")
+    second = scheduler.open("192.0.2.2", "example.com", "live")
+    other_host = scheduler.open("192.0.2.2", "example.org", "live")
+
+    assert first.delay(2000) == 0
+    assert second.delay(1000) == 1.0  # Shares example.com's bucket
+    assert other_host.delay(1000) == 0
+
+
+def test_bandwidth_scheduler_prioritizes_live_streams(clock):
+    scheduler = BandwidthScheduler(max_rate=1000, client_rate=0, upstream_rate=0, bulk_share=0.25)
+    bulk = scheduler.open("192.0.2.1", "example.com", "bulk")
+    assert bulk.delay(2000) == 0  # Alone, bulk downloads can use the whole link
+
+    clock[0] += 2
+    live = scheduler.open("192.0.2.2", "example.com", "live")
+    assert bulk.delay(1000) == 2.0  # Limited to its 250 bytes per second share, after a 500 byte burst
+    live.close()
+
+    clock[0] += 4
+    assert bulk.delay(1000) == 0
+
+
+@pytest.mark.parametrize(
+    "range_header, total_length, priority",
+    [
+        (None, None, "bulk"),
+        ("bytes=0-", None, "bulk"),  # How many apps download whole episodes
+        ("bytes=0-999", 1000, "bulk"),
+        ("bytes=0-1", 1000, "live"),  # Players probing the file before playing it
+        ("bytes=5000-", 1000000, "live"),
+        ("bytes=0-999", None, "live"),
+    ],
+)
+def test_stream_priority(range_header, total_length, priority):
+    assert stream_priority(range_header, total_length) == priority
+
+
+def test_generic_stream_throttled(client, monkeypatch):
+    monkeypatch.setattr(
+        "app.stream.routes.bandwidth_scheduler",
+        BandwidthScheduler(max_rate=10 ** 9, client_rate=0, upstream_rate=0, bulk_share=0.5),
+    )
+    scheduled = ("scheduled_bytes_total", (("priority", "bulk"),))
+    scheduled_before = metrics._counters[scheduled]
+    audio = os.urandom(200 * 1024)
+    upstream_response = upstream_stream_response(audio)
+    upstream_response.url = "https://example.com/episode.mp3"
+    with patch("app.session.get", return_value=upstream_response), patch("app.stream.routes.check_hostname"):
+        response = client.get(stream_url("https://example.com/episode.mp3"))
+        assert response.data == audio
+
+    assert metrics._counters[scheduled] - scheduled_before == len(audio)
@@ -1,5 +1,21 @@
+import json
+import os
+import socket
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest.mock import patch
 import pytest
-from app.utils import check_hostname, check_file_mime
+import requests
+from urllib3 import HTTPResponse
+from app.utils import check_hostname, check_file_mime, detect_audio_mime, detect_file_mime, detect_frame_mime
+from app.utils.disk_cache import DiskCache
+from app.utils.metrics import Metrics, metrics
+from app.utils.resolver import HostResolver
+from app.utils.shared_cache import RELEASE_SCRIPT, FileBackend, MemoryBackend, NetworkBackend, SharedCache
+from app.utils.upstream import create_session, parse_host_pool_sizes
+from benchmarks.origin import ORIGIN_BLOCK
 
 
 def test_check_hostname_valid():
@@ -18,3 +34,393 @@ def test_check_file_mime_valid():
 def test_check_file_mime_invalid():
     with pytest.raises(ValueError):
         check_file_mime(b"GIF89a", {"application/xml"})
+
+
+def write_cached_file(cache, name, size):
+    with open(cache.path(name), "wb") as f:
+        f.write(b"\0" * size)
+    cache.add(name)
+
+
+def test_disk_cache_evicts_least_recently_used(tmp_path):
+    cache = DiskCache(max_bytes=250, policy="lru", pinned_per_group=0)
+    cache.open(str(tmp_path))
+    write_cached_file(cache, "a.m4a", 100)
+    write_cached_file(cache, "b.m4a", 100)
+    with patch("app.utils.disk_cache.time.time", return_value=time.time() + 60):
+        assert cache.lookup("a.m4a")
+    write_cached_file(cache, "c.m4a", 100)
+
+    assert (tmp_path / "a.m4a").exists()
+    assert not (tmp_path / "b.m4a").exists()
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size_bytes"] == 200
+
+
+def test_disk_cache_evicts_least_frequently_used(tmp_path):
+    cache = DiskCache(max_bytes=250, policy="lfu", pinned_per_group=0)
+    cache.open(str(tmp_path))
+    write_cached_file(cache, "a.m4a", 100)
+    write_cached_file(cache, "b.m4a", 100)
+    cache.lookup("a.m4a")
+    cache.lookup("a.m4a")
+    cache.lookup("b.m4a")
+    write_cached_file(cache, "c.m4a", 100)
+
+    assert not (tmp_path / "b.m4a").exists() and (tmp_path / "a.m4a").exists()
+
+
+def test_disk_cache_keeps_pinned_files(tmp_path):
+    cache = DiskCache(max_bytes=250, policy="lru", pinned_per_group=1)
+    cache.open(str(tmp_path))
+    write_cached_file(cache, "a.m4a", 100)
+    write_cached_file(cache, "b.m4a", 100)
+    cache.pin("channel", ["a.m4a", "b.m4a"])
+    write_cached_file(cache, "c.m4a", 100)
+
+    assert (tmp_path / "a.m4a").exists()
+    assert not (tmp_path / "b.m4a").exists()
+
+
+def test_disk_cache_index_survives_restart(tmp_path):
+    cache = DiskCache(max_bytes=1000, policy="lru", pinned_per_group=0)
+    cache.open(str(tmp_path))
+    write_cached_file(cache, "a.m4a", 100)
+
+    restarted = DiskCache(max_bytes=1000, policy="lru", pinned_per_group=0)
+    with patch.object(DiskCache, "_scan_directory") as mock_scan:
+        restarted.open(str(tmp_path))
+        mock_scan.assert_not_called()
+    assert restarted.lookup("a.m4a")
+    assert not restarted.lookup("b.m4a")
+    assert restarted.stats()["hit_ratio"] == 0.5
+
+
+def test_disk_cache_workers_see_each_others_files(tmp_path):
+    first = DiskCache(max_bytes=250, policy="lru", pinned_per_group=0)
+    second = DiskCache(max_bytes=250, policy="lru", pinned_per_group=0)
+    first.open(str(tmp_path))
+    second.open(str(tmp_path))
+
+    write_cached_file(first, "a.m4a", 100)
+    assert second.lookup("a.m4a")  # Added after the second worker loaded the index
+
+    write_cached_file(second, "b.m4a", 100)
+    write_cached_file(second, "c.m4a", 100)  # Evicts a.m4a
+    assert not (tmp_path / "a.m4a").exists()
+
+    write_cached_file(first, "d.m4a", 10)
+    assert not first.lookup("a.m4a")
+    assert first.stats()["size_bytes"] == 210
+    restarted = DiskCache(max_bytes=250, policy="lru", pinned_per_group=0)
+    restarted.open(str(tmp_path))
+    assert restarted.stats()["files"] == 3
+
+
+def test_disk_cache_removes_metadata_with_files(tmp_path):
+    cache = DiskCache(max_bytes=150, policy="lru", pinned_per_group=0)
+    cache.open(str(tmp_path))
+    write_cached_file(cache, "a.audio", 100)
+    (tmp_path / "a.audio.meta").write_text("{}")
+    write_cached_file(cache, "b.audio", 100)
+
+    assert not (tmp_path / "a.audio").exists()
+    assert not (tmp_path / "a.audio.meta").exists()
+
+    (tmp_path / "b.audio.meta").write_text("{}")
+    cache.remove("b.audio")
+    assert not (tmp_path / "b.audio.meta").exists()
+    assert cache.stats()["files"] == 0
+
+
+@pytest.mark.parametrize(
+    "file_bytes, mime_type",
+    [
+        (b"ID3\x04\x00", "audio/mpeg"),
+        (b"\xff\xfb\x90\x00", None),  # Bare frames are left to libmagic
+        (b"\x00\x00\x00\x20ftypM4A \x00\x00", "audio/mp4"),
+        (b"OggS\x00\x02", "audio/ogg"),
+        (b"RIFF\x24\x00\x00\x00WAVEfmt ", "audio/wav"),
+        (b"\x00\x00\x00\x20ftypisom\x00\x00", None),
+        (b"GIF89a", None),
+    ],
+)
+def test_detect_audio_mime(file_bytes, mime_type):
+    assert detect_audio_mime(file_bytes) == mime_type
+
+
+@pytest.mark.parametrize(
+    "file_bytes, mime_type",
+    [
+        (b"\xff\xfb\x90\x64", "audio/mpeg"),
+        (b"\xff\xf1\x50\x80", "audio/aac"),
+        (b"\xff\xfb\x00\x64", None),  # Free format bitrate
+        (b"\xff\xfb\xf0\x64", None),  # Reserved bitrate
+        (b"\xff\xfb\x9c\x64", None),  # Reserved sample rate
+        (b"\xff\xeb\x90\x64", None),  # Reserved version
+        (b"\xff\xfeA\x00", "audio/mpeg"),  # Also a UTF-16 byte order mark, hence only trusted as a fallback
+    ],
+)
+def test_detect_frame_mime(file_bytes, mime_type):
+    assert detect_frame_mime(file_bytes) == mime_type
+
+
+def test_detect_file_mime_only_trusts_frames_libmagic_doesnt_recognise():
+    utf16_feed = "\ufeffAll about podcasts".encode("utf-16-le")
+    assert detect_file_mime(utf16_feed) == "text/plain"
+    assert detect_file_mime((b"\xff\xf1\x50\x80\x02\x1f\xfc" + b"\x00" * 9) * 10) == "audio/aac"
+    with patch("app.utils.utils.magic.from_buffer", return_value="application/octet-stream"):
+        assert detect_file_mime(b"\xff\xfb\x90\x64" + bytes(100)) == "audio/mpeg"
+        assert detect_file_mime(b"\xff\xfb\xf0\x64" + bytes(100)) == "application/octet-stream"
+
+
+def test_benchmark_origin_serves_audio():
+    assert detect_file_mime(ORIGIN_BLOCK[:1024]) == "audio/mpeg"
+
+
+@pytest.fixture
+def origin():
+    """Local HTTP server recording the client port of each request"""
+    client_ports = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            client_ports.append(self.client_address[1])
+            self.send_response(200)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/", client_ports
+    server.shutdown()
+
+
+def test_parse_host_pool_sizes():
+    assert parse_host_pool_sizes(" megaphone.fm=32, Simplecast.com=8,") == {
+        "megaphone.fm": 32,
+        "simplecast.com": 8,
+    }
+
+
+def test_upstream_session_reuses_connections(origin):
+    url, client_ports = origin
+    session = create_session(10, 4, {"127.0.0.1": 2}, 0, 0, 1, 1)
+
+    for _ in range(3):
+        assert session.get(url).content == b"ok"
+
+    assert len(set(client_ports)) == 1
+    assert session.get_adapter(url).poolmanager.connection_from_url(url).pool.maxsize == 2
+
+
+def test_upstream_pool_size_matches_subdomains():
+    adapter = create_session(10, 4, {"megaphone.fm": 32}, 0, 0, 1, 1).get_adapter("https://")
+
+    assert adapter.poolmanager.pool_size_for("traffic.megaphone.fm") == 32
+    assert adapter.poolmanager.pool_size_for("notmegaphone.fm") is None
+
+
+def test_upstream_retry_after_is_capped():
+    retries = create_session(10, 4, {}, 2, 0.5, 1, 1).get_adapter("https://").max_retries
+    response = HTTPResponse(status=503, headers={"Retry-After": "86400"})
+
+    assert retries.get_retry_after(response) == retries.backoff_max
+    assert retries.increment("GET", "/", response=response).get_retry_after(response) == retries.backoff_max
+    assert retries.get_retry_after(HTTPResponse(status=503, headers={"Retry-After": "3"})) == 3
+
+
+def fake_getaddrinfo(*addresses):
+    return lambda host, *args, **kwargs: [
+        (socket.AF_INET6 if ":" in address else socket.AF_INET, socket.SOCK_STREAM, 6, "", (address, 0))
+        for address in addresses
+    ]
+
+
+DNS_STAGE = ("stage_seconds", (("stage", "dns"),))
+
+
+def test_host_resolver_caches_addresses():
+    resolver = HostResolver(60, 10, 100)
+    timed_before = metrics._histograms.get(DNS_STAGE, [0])[-1]
+    with patch("socket.getaddrinfo", side_effect=fake_getaddrinfo("93.184.215.14")) as getaddrinfo:
+        assert resolver.resolve("example.com") == ["93.184.215.14"]
+        assert resolver.resolve_public("example.com") == ["93.184.215.14"]
+    assert getaddrinfo.call_count == 1
+    assert metrics._histograms[DNS_STAGE][-1] - timed_before == 1  # Only the lookup that missed the cache
+
+
+def test_host_resolver_caches_failures():
+    resolver = HostResolver(60, 10, 100)
+    with patch("socket.getaddrinfo", side_effect=socket.gaierror("no such host")) as getaddrinfo:
+        for _ in range(2):
+            with pytest.raises(socket.gaierror):
+                resolver.resolve("missing.example")
+    assert getaddrinfo.call_count == 1
+
+
+def test_host_resolver_rejects_any_private_address():
+    resolver = HostResolver(60, 10, 100)
+    with patch("socket.getaddrinfo", side_effect=fake_getaddrinfo("93.184.215.14", "::ffff:10.0.0.1")):
+        with pytest.raises(ValueError):
+            resolver.resolve_public("rebinding.example")
+
+
+def test_upstream_session_connects_to_resolved_address(origin):
+    url, client_ports = origin
+    url = url.replace("127.0.0.1", "podcast.test")
+    resolver = HostResolver(60, 10, 100)
+    session = create_session(10, 4, {}, 0, 0, 1, 1, resolver=resolver)
+
+    with patch("socket.getaddrinfo", side_effect=fake_getaddrinfo("127.0.0.1")):
+        resolver.resolve("podcast.test")
+    with patch("app.utils.resolver.is_private_address", return_value=False):
+        assert session.get(url).content == b"ok"  # podcast.test only resolves through the resolver's cache
+
+    session.close()
+    with pytest.raises(ValueError):
+        session.get(url)  # The origin's address is private
+
+
+def test_metrics_add_up_worker_snapshots(tmp_path):
+    worker = Metrics((0.1, 1), max_hosts=1)
+    worker.directory, worker.interval = str(tmp_path), 5
+    worker.inc("relayed_bytes_total", (("source", "upstream"),), 123456789)
+    worker.observe("stage_seconds", (("stage", "feed_rewrite"),), 0.5)
+    (tmp_path / "1.json").write_text(json.dumps(worker.snapshot()))
+
+    metrics = Metrics((0.1, 1), max_hosts=1)
+    metrics.directory, metrics.interval = str(tmp_path), 5
+    metrics.inc("relayed_bytes_total", (("source", "upstream"),), 1)
+    metrics.observe("stage_seconds", (("stage", "feed_rewrite"),), 2)
+
+    rendered = metrics.render()
+    assert 'podcast_proxy_relayed_bytes_total{source="upstream"} 123456790' in rendered
+    assert 'podcast_proxy_stage_seconds_bucket{stage="feed_rewrite",le="1"} 1' in rendered
+    assert 'podcast_proxy_stage_seconds_bucket{stage="feed_rewrite",le="+Inf"} 2' in rendered
+    assert 'podcast_proxy_stage_seconds_sum{stage="feed_rewrite"} 2.5' in rendered
+
+
+def test_metrics_caps_upstream_hosts():
+    metrics = Metrics((1,), max_hosts=1)
+    for url in ("https://a.example/1", "https://b.example/2"):
+        response = requests.Response()
+        response.url, response.status_code, response.elapsed = url, 200, timedelta(0)
+        metrics.record_upstream_response(response)
+
+    rendered = metrics.render()
+    assert 'podcast_proxy_upstream_responses_total{host="a.example",status="200"} 1' in rendered
+    assert 'podcast_proxy_upstream_responses_total{host="other",status="200"} 1' in rendered
+
+
+class LocalRedis:
+    """In-memory stand-in for the Redis commands the network backend uses"""
+
+    def __init__(self):
+        self.values = {}
+
+    def get(self, name):
+        value, expires_at = self.values.get(name, (None, 0))
+        return value if expires_at > time.time() else None
+
+    def set(self, name, value, px, nx=False):
+        if nx and self.get(name) is not None:
+            return None
+        self.values[name] = (value.encode() if isinstance(value, str) else value, time.time() + px / 1000)
+        return True
+
+    def eval(self, script, numkeys, name, token):
+        assert script == RELEASE_SCRIPT
+        if self.get(name) == token.encode():
+            del self.values[name]
+            return 1
+        return 0
+
+
+@pytest.fixture(params=["file", "network"])
+def shared_backends(request, tmp_path):
+    """Two workers' backends sharing the same store"""
+    if request.param == "file":
+        return FileBackend(str(tmp_path)), FileBackend(str(tmp_path))
+    client = LocalRedis()
+    return NetworkBackend(client, max_file_bytes=1024), NetworkBackend(client, max_file_bytes=1024)
+
+
+def test_shared_backend_values_and_files(shared_backends, tmp_path):
+    first, second = shared_backends
+    first.set("feed", b"content", ttl=60)
+    first.set("expired", b"content", ttl=-1)
+    assert second.get("feed") == b"content"
+    assert second.get("expired") is None
+    assert second.get("missing") is None
+
+    (tmp_path / "audio.m4a").write_bytes(b"audio")
+    first.put_file("video", str(tmp_path / "audio.m4a"), ttl=60)
+    assert second.get_file("video", str(tmp_path / "copy.m4a"))
+    assert (tmp_path / "copy.m4a").read_bytes() == b"audio"
+    assert not second.get_file("missing", str(tmp_path / "missing.m4a"))
+
+
+def test_file_backend_skips_files_on_cache_filesystem(tmp_path):
+    backend = FileBackend(str(tmp_path / "shared"), cache_dir=str(tmp_path))
+    (tmp_path / "audio.m4a").write_bytes(b"audio")
+    backend.put_file("video", str(tmp_path / "audio.m4a"), ttl=60)
+
+    assert not backend.get_file("video", str(tmp_path / "copy.m4a"))
+    assert not os.listdir(tmp_path / "shared" / "files")
+
+
+def test_shared_backend_locks(shared_backends):
+    first, second = shared_backends
+    token = first.acquire("video", ttl=60, timeout=0)
+    assert token is not None
+    assert second.acquire("video", ttl=60, timeout=0.2) is None
+
+    first.release("video", token)
+    second_token = second.acquire("video", ttl=60, timeout=0)
+    assert second_token is not None
+    second.release("video", second_token)
+
+
+def test_network_backend_skips_large_files(tmp_path):
+    backend = NetworkBackend(LocalRedis(), max_file_bytes=4)
+    (tmp_path / "audio.m4a").write_bytes(b"audio")
+    backend.put_file("video", str(tmp_path / "audio.m4a"), ttl=60)
+    assert not backend.get_file("video", str(tmp_path / "copy.m4a"))
+
+
+def test_memory_backend_lock_expires():
+    backend = MemoryBackend()
+    token = backend.acquire("feed", ttl=0.1, timeout=0)
+    released = threading.Event()
+
+    def wait_for_lock():
+        backend.release("feed", backend.acquire("feed", ttl=60, timeout=None))
+        released.set()
+
+    threading.Thread(target=wait_for_lock, daemon=True).start()
+    assert released.wait(timeout=2)  # Never released by its holder, but expired
+    backend.release("feed", token)  # No longer its lock, so a no-op
+
+
+def test_shared_cache_survives_backend_errors(tmp_path):
+    class BrokenBackend:
+        shared = True
+
+        def __getattr__(self, name):
+            raise ConnectionError("backend down")
+
+    cache = SharedCache()
+    cache.open(BrokenBackend())
+    assert cache.get("feed") is None
+    cache.set("feed", b"content", 60)
+    assert not cache.get_file("video", str(tmp_path / "copy.m4a"))
+    lock = cache.lock("video", 60)
+    assert lock.acquire(timeout=0)  # Counts as acquired, so work goes ahead unshared
+    lock.release()